@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""Compare default and autotuned PID gains in simulation.
+
+For houses of different thermal mass, runs an identification experiment
+(the boiler held on from cold, measured the way Monitor does in a real
+install), fits a model with boilerio.autotune, and then simulates a
+setpoint step with the default and the recommended gains (and those
+recommended for a larger ripple, which cycle the boiler less).  Reports
+overshoot, boiler cycles per hour and RMS error once settled, and checks
+that the recommended parameters don't cycle the boiler more than the
+defaults.
+
+    python benchmarks/bench_autotune.py
+"""
+
+import logging
+import math
+
+from boilerio import autotune, boilersim, monitor
+
+OUTSIDE = 5
+START = 16
+TARGET = 20
+RUN_MINS = 72 * 60
+SETTLE_MINS = 48 * 60
+
+
+def identify(scale):
+    """Return (gradient table, readings, heating events) for a house."""
+    house = boilersim.House(12, OUTSIDE, boilersim.House.D_HOUSE / scale,
+                            boilersim.House.D_RAD / scale)
+    m = monitor.Monitor()
+    m.set_outside_temperature(OUTSIDE, 0)
+    buckets = {}
+    readings = []
+    events = [(0, False), (1800, True)]
+    for minute in range(12 * 60):
+        t = minute * 60
+        if t == 1800:
+            house.heating(True)
+            m.boiler_on(t)
+        readings.append((t, house.room_temp))
+        result = m.temperature_update(house.room_temp, t)
+        if result is not None:
+            delta, gradient = result.delta, result.gradient
+            bucket = buckets.setdefault(round(delta * 2) / 2, [])
+            bucket.append(gradient)
+        house.tick()
+    table = [{'delta': d, 'gradient': sum(g) / len(g), 'npoints': len(g)}
+             for d, g in sorted(buckets.items())]
+    return table, readings, events
+
+
+def evaluate(scale, **params):
+    house = boilersim.House(START, OUTSIDE, boilersim.House.D_HOUSE / scale,
+                            boilersim.House.D_RAD / scale)
+    rows = list(boilersim.simulate(house, TARGET, RUN_MINS, False, **params))
+    temps = [row[4] for row in rows]
+    on = [row[2] > 0 for row in rows]
+    settled = slice(SETTLE_MINS, None)
+    cycles = sum(1 for was, now in zip(on[settled], on[SETTLE_MINS + 1:])
+                 if now and not was)
+    hours = (RUN_MINS - SETTLE_MINS) / 60
+    overshoot = max(0, max(temps) - TARGET)
+    rms = math.sqrt(sum((t - TARGET) ** 2 for t in temps[settled]) /
+                    len(temps[settled]))
+    return overshoot, cycles / hours, rms
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    print("%-6s %-8s %8s %8s %8s  %s" % (
+        "mass", "gains", "over/C", "cyc/h", "rms/C", "params"))
+    for scale in (0.5, 1, 2, 4):
+        table, readings, events = identify(scale)
+        gain, tau = autotune.fit_gain_and_time_constant(table)
+        dead_time = autotune.estimate_dead_time(readings, events)
+        process = autotune.ProcessModel(gain, tau, dead_time)
+        tuned = autotune.tune(process)._asdict()
+        # Trading tighter control for less cycling:
+        relaxed = autotune.tune(process, max_ripple=0.05)._asdict()
+        default_cycles = None
+        for name, params in (("default", {}), ("tuned", tuned),
+                             ("r=0.05", relaxed)):
+            overshoot, cycles, rms = evaluate(scale, **params)
+            if default_cycles is None:
+                default_cycles = cycles
+            # Tuning mustn't make the boiler cycle more:
+            assert cycles <= default_cycles, (scale, name)
+            print("%-6s %-8s %8.2f %8.2f %8.3f  %s" % (
+                "%gx" % scale, name, overshoot, cycles, rms,
+                ", ".join("%s=%.3g" % kv for kv in params.items())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+"""Microbenchmark of MQTT payload decoding.
+
+Decodes realistic emonTH readings with each available codec: the standard
+json module, orjson and msgpack (if installed) and the fixed emonTH struct.
+Reports payload size and decodes per second.  Run from the checkout with
+boilerio installed (e.g. ``pip install -e .[fast]``):
+
+    python benchmarks/bench_codec.py [messages]
+"""
+
+import json
+import random
+import sys
+import time
+
+from boilerio import codec
+
+
+def make_readings(n):
+    rng = random.Random(1)
+    return [{'temperature': round(rng.uniform(15, 22), 2),
+             'humidity': round(rng.uniform(40, 60), 2),
+             'battery': round(rng.uniform(2.8, 3.2), 3)}
+            for _ in range(n)]
+
+
+def bench(name, encode, decode, readings):
+    payloads = [encode(r) for r in readings]
+    size = sum(len(p) for p in payloads) / len(payloads)
+    begin = time.perf_counter()
+    for p in payloads:
+        decode(p)
+    rate = len(payloads) / (time.perf_counter() - begin)
+    print("%-10s %6.1f %14.0f" % (name, size, rate))
+
+
+def main():
+    nmessages = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    readings = make_readings(nmessages)
+    print("%-10s %6s %14s" % ("codec", "bytes", "decodes/s"))
+    bench('json', lambda r: json.dumps(r).encode(), json.loads, readings)
+    if codec.orjson is not None:
+        bench('orjson', codec.orjson.dumps, codec.orjson.loads, readings)
+    if codec.msgpack is not None:
+        bench('msgpack', codec.MsgpackCodec.encode,
+              codec.MsgpackCodec.decode, readings)
+    bench('emonth', codec.EmonTHCodec.encode, codec.EmonTHCodec.decode,
+          readings)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""Microbenchmark of MQTT sensor message dispatch.
+
+Compares routing sensor messages with a paho message_callback_add per
+sensor (each callback parsing the payload) against a single
+dispatch.MqttDispatcher, for fleets of different sizes.  Each fleet also
+has a wildcard consumer (as the monitor or a logger might), so every
+message goes to two consumers.  Reports messages per second.  Run from the
+checkout with boilerio installed (e.g. ``pip install -e .``):
+
+    python benchmarks/bench_dispatch.py [messages]
+"""
+
+import json
+import logging
+import random
+import sys
+import time
+
+import paho.mqtt.client as mqtt
+
+from boilerio.clock import VirtualClock
+from boilerio.dispatch import MqttDispatcher
+from boilerio.tempsensor import EmonTHSensor
+
+
+def make_messages(nsensors, nmessages):
+    rng = random.Random(1)
+    messages = []
+    for _ in range(nmessages):
+        msg = mqtt.MQTTMessage(topic=b'emon/emonth%d' % rng.randrange(nsensors))
+        msg.payload = json.dumps({
+            'temperature': round(rng.uniform(15, 22), 1),
+            'humidity': round(rng.uniform(40, 60), 1),
+            'battery': 3.1, 'pulsecount': 0}).encode()
+        messages.append(msg)
+    return messages
+
+
+def make_sensors(nsensors, clock):
+    return [EmonTHSensor(i, 'emon/emonth%d' % i, clock)
+            for i in range(nsensors)]
+
+
+def wildcard_consumer(topic, data):
+    pass
+
+
+def bench_paho(nsensors, messages):
+    clock = VirtualClock()
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    for sensor in make_sensors(nsensors, clock):
+        sensor.register_mqtt_callbacks(client)
+    client.message_callback_add(
+        'emon/#', lambda c, u, msg: wildcard_consumer(
+            msg.topic, json.loads(msg.payload)))
+
+    begin = time.perf_counter()
+    for msg in messages:
+        client._handle_on_message(msg)
+    return len(messages) / (time.perf_counter() - begin)
+
+
+def bench_dispatcher(nsensors, messages):
+    clock = VirtualClock()
+    dispatcher = MqttDispatcher()
+    for sensor in make_sensors(nsensors, clock):
+        sensor.register(dispatcher)
+    dispatcher.add('emon/#', wildcard_consumer)
+
+    begin = time.perf_counter()
+    for msg in messages:
+        dispatcher.on_message(None, None, msg)
+    return len(messages) / (time.perf_counter() - begin)
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    nmessages = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print("%8s %14s %14s" % ("sensors", "paho msgs/s", "trie msgs/s"))
+    for nsensors in (10, 1000, 10000):
+        messages = make_messages(nsensors, nmessages)
+        print("%8d %14.0f %14.0f" % (nsensors,
+                                     bench_paho(nsensors, messages),
+                                     bench_dispatcher(nsensors, messages)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+"""Compare sensor reading filters in simulation.
+
+A simulated room (boilersim.House) is controlled by a Thermostat reading an
+EmonTHSensor, which receives a noisy reading every minute as an emonTH
+does.  For each filter configuration, reports the HTTP requests per hour
+the readings passed on would cause (a zone state report and two sensor
+uploads each), and the control performance once settled: RMS error of the
+true room temperature from the target, and boiler cycles per hour.
+
+    python benchmarks/bench_sensorfilter.py
+"""
+
+import logging
+import math
+import random
+
+from boilerio import boilersim, sensorfilter
+from boilerio.clock import VirtualClock
+from boilerio.tempsensor import EmonTHSensor
+from boilerio.thermostat import Thermostat
+
+OUTSIDE = 5
+START = 16
+TARGET = 20
+RUN_MINS = 48 * 60
+SETTLE_MINS = 12 * 60
+# Requests per reading passed on: the zone state report and the two uploads.
+REQUESTS_PER_READING = 3
+
+CONFIGS = [
+    ("unchanged only", lambda: None),
+    ("deadband 0.1", lambda: [sensorfilter.Deadband(0.1, 1.0, 900)]),
+    ("hysteresis", lambda: [sensorfilter.Hysteresis(0.1, 0.2, 1.0, 900)]),
+    ("deadband+rate", lambda: [sensorfilter.Deadband(0.1, 1.0, 900),
+                               sensorfilter.RateLimit(300)]),
+    ("smooth+deadband", lambda: [sensorfilter.Smoothing(180),
+                                 sensorfilter.Deadband(0.1, 1.0, 900)]),
+]
+
+
+def evaluate(filters, seed=1):
+    rng = random.Random(seed)
+    clock = VirtualClock()
+    house = boilersim.House(START, OUTSIDE)
+    sensor = EmonTHSensor(1, 'emon/emonth1', clock, filters)
+    passed = []
+    sensor.add_callback(lambda s: passed.append(clock.monotonic()))
+    thermostat = Thermostat(boilersim.FakeBoiler(house), sensor)
+    thermostat.set_target_temperature(TARGET)
+
+    errors = []
+    cycles = 0
+    for minute in range(RUN_MINS):
+        sensor.handle_message(sensor.locator, {
+            'temperature': round(house.room_temp + rng.gauss(0, 0.04), 2),
+            'humidity': round(50 + rng.gauss(0, 0.3), 1)})
+        sensor.process_readings()
+        was_on = house.heating_on
+        for _ in range(60):
+            clock.advance(1)
+            thermostat.interval_elapsed(clock.monotonic())
+            if house.heating_on and not was_on and minute >= SETTLE_MINS:
+                cycles += 1
+            was_on = house.heating_on
+        house.tick()
+        if minute >= SETTLE_MINS:
+            errors.append(house.room_temp - TARGET)
+
+    hours = RUN_MINS / 60
+    settled_hours = (RUN_MINS - SETTLE_MINS) / 60
+    rms = math.sqrt(sum(e * e for e in errors) / len(errors))
+    return (len(passed) * REQUESTS_PER_READING / hours, rms,
+            cycles / settled_hours)
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    print("%-16s %10s %8s %8s" % ("filters", "req/h", "rms/C", "cyc/h"))
+    for name, filters in CONFIGS:
+        print("%-16s %10.1f %8.3f %8.2f" % ((name,) + evaluate(filters())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+"""Benchmark boiler_to_mqtt's serial I/O against a fake transceiver.
+
+The fake transceiver sits on the master side of a pseudo-terminal and
+echoes an ISSUE line for each command after a short simulated RF delay.
+Compares the old loop (readline() with a 0.5 s timeout, writing a command
+only when a read times out) with transceiver.Transceiver.  Reports
+throughput for a burst of commands, and the latency from queueing a single
+command to its acknowledgement.
+
+    python benchmarks/bench_serial.py [rf_delay_ms]
+"""
+
+import logging
+import os
+import pty
+import select
+import sys
+import threading
+import time
+
+import serial
+
+from boilerio.commandqueue import CommandQueue
+from boilerio.transceiver import COMMAND_NAMES, Transceiver, parse_line
+
+BURST = 20
+SINGLES = 10
+
+
+def fake_transceiver(master, rf_delay, stop):
+    buffer = b''
+    while not stop.is_set():
+        readable, _, _ = select.select([master], [], [], 0.1)
+        if not readable:
+            continue
+        buffer += os.read(master, 1024)
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            line = line.decode().strip()
+            time.sleep(rf_delay)
+            os.write(master, ('ISSUE %s %s\r\n' % (
+                line[1:], COMMAND_NAMES[line[0]])).encode())
+
+
+def legacy_loop(port, commands, on_report, stop):
+    data = ""
+    while not stop.is_set():
+        data = data + port.readline().decode('utf-8')
+        if data.endswith('\n'):
+            on_report(*parse_line(data.strip()))
+            data = ""
+        elif not data:
+            request = commands.pop()
+            if request is None:
+                continue
+            port.write("{}{}\n".format(
+                request['command'], request['thermostat']).encode())
+
+
+def transceiver_loop(port, commands, on_report, stop):
+    t = Transceiver(port, commands, on_report)
+    while not stop.is_set():
+        t.poll(0.1)
+    t.close()
+
+
+def bench(loop, read_timeout, rf_delay):
+    master, slave = pty.openpty()
+    port = serial.Serial(os.ttyname(slave), 57600, timeout=read_timeout)
+    commands = CommandQueue()
+    acked = {}
+    ack = threading.Condition()
+
+    def on_report(direction, tid, cmd):
+        with ack:
+            acked[int(tid, 16)] = time.perf_counter()
+            ack.notify_all()
+
+    def wait_for(keys):
+        with ack:
+            ack.wait_for(lambda: all(k in acked for k in keys), timeout=60)
+
+    stop = threading.Event()
+    threads = [threading.Thread(target=fake_transceiver,
+                                args=(master, rf_delay, stop)),
+               threading.Thread(target=loop,
+                                args=(port, commands, on_report, stop))]
+    for t in threads:
+        t.start()
+
+    begin = time.perf_counter()
+    for i in range(BURST):
+        commands.put({'command': 'O', 'thermostat': hex(i + 1)})
+    wait_for(range(1, BURST + 1))
+    throughput = BURST / (time.perf_counter() - begin)
+
+    latencies = []
+    for i in range(SINGLES):
+        key = 1000 + i
+        time.sleep(0.05)
+        queued = time.perf_counter()
+        commands.put({'command': 'X', 'thermostat': hex(key)})
+        wait_for([key])
+        latencies.append(acked[key] - queued)
+
+    stop.set()
+    for t in threads:
+        t.join()
+    port.close()
+    os.close(master)
+    os.close(slave)
+    return throughput, sum(latencies) / len(latencies), max(latencies)
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    rf_delay = (float(sys.argv[1]) if len(sys.argv) > 1 else 5) / 1000
+    print("%-12s %10s %14s %14s" % (
+        "loop", "cmds/s", "mean lat/ms", "max lat/ms"))
+    for name, loop, timeout in (("readline", legacy_loop, 0.5),
+                                ("transceiver", transceiver_loop, 0)):
+        throughput, mean, worst = bench(loop, timeout, rf_delay)
+        print("%-12s %10.1f %14.1f %14.1f" % (
+            name, throughput, mean * 1000, worst * 1000))
+
+
+if __name__ == "__main__":
+    main()
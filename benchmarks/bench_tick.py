@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+"""Microbenchmark of the per-second control tick.
+
+Runs a thermostat in its PWM band (the busiest path: PID, PWM and state
+change detection all run) and reports ticks per second.  Run from the
+checkout with boilerio installed (e.g. ``pip install -e .``):
+
+    python benchmarks/bench_tick.py [zones] [seconds]
+"""
+
+import logging
+import sys
+import time
+
+from boilerio.clock import VirtualClock
+from boilerio.thermostat import Thermostat
+from boilerio.tempsensor import SensorReading
+
+
+class NullBoiler(object):
+    def on(self):
+        pass
+
+    def off(self):
+        pass
+
+
+class FixedSensor(object):
+    def __init__(self, reading):
+        self.reading = reading
+
+
+def run(nzones, nticks):
+    clock = VirtualClock()
+    thermostats = []
+    for _ in range(nzones):
+        sensor = FixedSensor(
+            SensorReading(clock.now(), 20.0, 50.0, clock.monotonic()))
+        thermostat = Thermostat(NullBoiler(), sensor,
+                                lambda mode, dutycycle: None)
+        thermostat.set_target_temperature(20.0)
+        thermostats.append((thermostat, sensor))
+
+    begin = time.perf_counter()
+    for tick in range(nticks):
+        clock.advance(1)
+        now = clock.monotonic()
+        for thermostat, sensor in thermostats:
+            # Keep the reading fresh, as a real sensor would:
+            if tick % 60 == 0:
+                sensor.reading = SensorReading(None, 20.0, 50.0, now)
+            thermostat.interval_elapsed(now)
+    elapsed = time.perf_counter() - begin
+    return nzones * nticks / elapsed
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    nzones = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    nticks = int(sys.argv[2]) if len(sys.argv) > 2 else 86400
+    rate = run(nzones, nticks)
+    print("%d zones x %d ticks: %.0f zone-ticks/s" % (nzones, nticks, rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+
+"""Offline PID autotuner for heating zones.
+
+Fits a first-order-plus-dead-time (FOPDT) model of a zone:
+
+    tau * dT/dt = -(T - T_outside) + K * u(t - theta)
+
+where u is the boiler demand (0 to 1), and derives PID gains from it
+using the SIMC tuning rules.  The model is fitted from data already
+collected by boilerio:
+
+ - The heating-gradient table (see TemperatureGradientMeasurement) gives
+   dT/dt with the boiler on as a function of the inside/outside
+   temperature delta.  For the model above that is a straight line,
+   (K - delta) / tau, so a weighted regression gives K and tau.
+ - Sensor readings and the reported heating state give the dead time:
+   how long after the boiler turns on before the room starts warming.
+"""
+
+import argparse
+import bisect
+import collections
+import datetime
+import logging
+import math
+import statistics
+from collections import namedtuple
+
+from . import config
+from .thermostat import Thermostat
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# gain: degrees C above outside at full demand; time_constant, dead_time: s
+ProcessModel = namedtuple('ProcessModel',
+                          ['gain', 'time_constant', 'dead_time'])
+
+ControllerParams = namedtuple('ControllerParams',
+                              ['pid_kp', 'pid_ki', 'pid_kd', 'pwm_period'])
+
+
+class InsufficientData(Exception):
+    pass
+
+
+def fit_gain_and_time_constant(gradient_table):
+    """Fit the FOPDT gain and time constant to a gradient table.
+
+    gradient_table is a list of dictionaries with 'delta', 'gradient'
+    (degrees C per hour) and optionally 'npoints' keys, as served by
+    /zones/<id>/gradients.  Buckets are weighted by npoints.
+
+    Returns (gain, time constant in seconds)."""
+    points = [(float(g['delta']), float(g['gradient']),
+               g.get('npoints') or 1) for g in gradient_table]
+    weight = sum(w for _, _, w in points)
+    if len(points) < 2 or weight == 0:
+        raise InsufficientData("Need at least two gradient buckets")
+
+    mean_delta = sum(d * w for d, _, w in points) / weight
+    mean_gradient = sum(g * w for _, g, w in points) / weight
+    sxx = sum(w * (d - mean_delta) ** 2 for d, _, w in points)
+    sxy = sum(w * (d - mean_delta) * (g - mean_gradient)
+              for d, g, w in points)
+    if sxx == 0:
+        raise InsufficientData("Gradient buckets all have the same delta")
+    slope = sxy / sxx
+    if slope >= 0:
+        raise InsufficientData(
+            "Heating gradient does not fall as the delta increases")
+    intercept = mean_gradient - slope * mean_delta
+
+    time_constant_hours = -1 / slope
+    gain = intercept * time_constant_hours
+    return gain, time_constant_hours * 3600
+
+
+def estimate_dead_time(readings, heating_events, rise=0.1, window=3600):
+    """Estimate the dead time from readings and boiler on/off events.
+
+    readings: a time-ordered list of (time, temperature).
+    heating_events: a time-ordered list of (time, heating on?).
+    Times are in seconds.
+
+    For each time heating turns on, finds how long it takes the room to
+    warm by 'rise' degrees above its temperature at switch-on.  Runs where
+    that doesn't happen within 'window' seconds, or before heating turns
+    off again, are ignored.  Returns the median in seconds."""
+    times = [t for t, _ in readings]
+    delays = []
+    heating = False
+    for i, (event_time, on) in enumerate(heating_events):
+        if not on or heating:
+            heating = on
+            continue
+        heating = True
+
+        end = event_time + window
+        if i + 1 < len(heating_events):
+            end = min(end, heating_events[i + 1][0])
+
+        start = bisect.bisect_right(times, event_time)
+        if start == 0:
+            continue
+        base = readings[start - 1][1]
+        for t, temperature in readings[start:]:
+            if t > end:
+                break
+            if temperature >= base + rise:
+                delays.append(t - event_time)
+                break
+
+    if not delays:
+        raise InsufficientData("No heating runs with a measurable rise")
+    return statistics.median(delays)
+
+
+# The largest temperature ripple (degrees C peak to peak) recommended PWM
+# periods allow.  A bigger ripple lets heavy rooms cycle the boiler less,
+# at the cost of a larger RMS error.
+MAX_RIPPLE = 0.02
+
+# Closed-loop time constants tried by tune(), as fractions of the effective
+# dead time.  SIMC's usual choice is 1; tighter ones control more closely
+# but may cycle the boiler more.
+CLOSED_LOOP_FRACTIONS = (0.25, 0.5, 1)
+
+# The least fraction by which tuned parameters must cut boiler cycling, in
+# simulation of the model, to be recommended over the defaults; smaller
+# differences are within the model's error.
+MIN_CYCLING_CUT = 0.1
+# How much more (degrees C) than the defaults tuned parameters may overshoot
+# in simulation: less than sensors resolve.
+OVERSHOOT_TOLERANCE = 0.05
+
+SimulationResult = namedtuple('SimulationResult',
+                              ['overshoot', 'cycles_per_hour', 'rms_error'])
+
+
+def recommend_pwm_period(process, max_ripple=MAX_RIPPLE, shortest=600,
+                         longest=3600):
+    """Choose the longest PWM period keeping the temperature ripple small.
+
+    A first-order process driven at a 50% duty cycle swings by about
+    K * period / (4 * tau) degrees peak to peak, so rooms with a large
+    thermal mass can use long periods (and cycle the boiler less) without
+    a noticeable ripple.  Returns whole minutes, in seconds, clamped to
+    [shortest, longest]."""
+    period = 4 * process.time_constant * max_ripple / process.gain
+    period = max(shortest, min(longest, period))
+    return int(period // 60) * 60
+
+
+def default_params():
+    """The thermostat's default ControllerParams."""
+    return ControllerParams(Thermostat.PID_KP, Thermostat.PID_KI,
+                            Thermostat.PID_KD, Thermostat.PWM_PERIOD)
+
+
+def simc(process, pwm_period, closed_loop_time):
+    """PID gains for a process model by the SIMC rules.
+
+    The thermostat only updates its PID once per PWM period, which adds (on
+    average) half a period of extra dead time.  closed_loop_time is the
+    desired closed-loop time constant in seconds.  The gains are converted
+    to the discrete form used by pid.PID, where the integral and derivative
+    terms are accumulated per PWM period."""
+    dead_time = process.dead_time + pwm_period / 2
+    tc = closed_loop_time
+    kc = process.time_constant / (process.gain * (tc + dead_time))
+    ti = min(process.time_constant, 4 * (tc + dead_time))
+    td = (process.time_constant * dead_time /
+          (2 * process.time_constant + dead_time))
+    return ControllerParams(kc, kc * pwm_period / ti, kc * td / pwm_period,
+                            pwm_period)
+
+
+class _Boiler(object):
+    __slots__ = ('heating', )
+
+    def __init__(self):
+        self.heating = False
+
+    def on(self):
+        self.heating = True
+
+    def off(self):
+        self.heating = False
+
+
+class _Sensor(object):
+    __slots__ = ('reading', )
+
+    def __init__(self):
+        self.reading = None
+
+
+def simulate(process, params=None, delta=15, hours=12, settle_hours=12,
+             step=20):
+    """Simulate a thermostat holding a process model at a target.
+
+    The room starts 4 degrees below a target delta degrees above outside.
+    After settle_hours the boiler's cycles per hour and the RMS error are
+    measured for hours more; overshoot is over the whole run.  params are
+    ControllerParams, or None for the thermostat defaults.
+
+    Returns a SimulationResult."""
+    # Imported here: the simulation is only needed when tuning.
+    from .clock import VirtualClock
+    from .tempsensor import SensorReading
+
+    clock = VirtualClock()
+    boiler = _Boiler()
+    sensor = _Sensor()
+    thermostat = Thermostat(boiler, sensor,
+                            **(params._asdict() if params else {}))
+    thermostat.set_target_temperature(delta)
+    # The boiler's state over the last dead_time, oldest first:
+    delayed = collections.deque(
+        [False] * max(1, int(process.dead_time // step)))
+    temperature = delta - 4
+    decay = step / process.time_constant
+    settle = settle_hours * 3600 // step
+    overshoot = cycles = squares = 0
+    was_on = False
+    for i in range(int((settle_hours + hours) * 3600 // step)):
+        sensor.reading = SensorReading(None, temperature, 0,
+                                       clock.monotonic())
+        clock.advance(step)
+        thermostat.interval_elapsed(clock.monotonic())
+        delayed.append(boiler.heating)
+        heat = process.gain if delayed.popleft() else 0
+        temperature += decay * (heat - temperature)
+        overshoot = max(overshoot, temperature - delta)
+        if i >= settle:
+            cycles += boiler.heating and not was_on
+            squares += (temperature - delta) ** 2
+        was_on = boiler.heating
+    samples = hours * 3600 // step
+    return SimulationResult(overshoot, cycles / hours,
+                            math.sqrt(squares / samples))
+
+
+def tune(process, pwm_period=None, closed_loop_time=None,
+         max_ripple=MAX_RIPPLE):
+    """Recommend ControllerParams for a process model.
+
+    Candidate gains are computed with SIMC (see simc) for PWM periods
+    longer than the default, up to recommend_pwm_period(process,
+    max_ripple), and for the closed-loop times in CLOSED_LOOP_FRACTIONS,
+    unless pwm_period or closed_loop_time are given.  Each is simulated
+    against the model (see simulate).  Of those that cycle the boiler at
+    least MIN_CYCLING_CUT less than the default parameters without
+    overshooting more (within OVERSHOOT_TOLERANCE), the one cycling least (then with the smallest RMS
+    error) is chosen.  If there are none, the defaults are returned: at
+    the default period, tuned gains were found in simulation to cycle no
+    less, and sometimes more, than the defaults."""
+    defaults = default_params()
+    if pwm_period is not None:
+        periods = [pwm_period]
+    else:
+        longest = recommend_pwm_period(process, max_ripple)
+        periods = sorted({p for p in (
+            longest, (defaults.pwm_period + longest) // 120 * 60)
+            if p > defaults.pwm_period})
+
+    baseline = simulate(process)
+    candidates = []
+    for period in periods:
+        dead_time = process.dead_time + period / 2
+        if closed_loop_time is not None:
+            times = [closed_loop_time]
+        else:
+            times = [dead_time * f for f in CLOSED_LOOP_FRACTIONS]
+        for tc in times:
+            params = simc(process, period, tc)
+            result = simulate(process, params)
+            if (result.cycles_per_hour <= baseline.cycles_per_hour *
+                    (1 - MIN_CYCLING_CUT) and
+                    result.overshoot <= baseline.overshoot +
+                    OVERSHOOT_TOLERANCE):
+                candidates.append(
+                    (result.cycles_per_hour, result.rms_error, params))
+    if not candidates:
+        return defaults
+    return min(candidates, key=lambda c: c[:2])[2]
+
+
+def _load_history(db, zone_id, since):
+    """Load temperature readings and heating events for a zone from the db.
+
+    Returns (readings, heating_events) with times in seconds since 'since'.
+    """
+    def seconds(when):
+        return (when - since).total_seconds()
+
+    cursor = db.cursor()
+    cursor.execute(
+        "select r.time, r.value from sensor_reading r "
+        "join zones z on z.sensor_id = r.sensor_id "
+        "where z.zone_id=%s and r.metric_type='temperature' "
+        "and r.time >= %s order by r.time", (zone_id, since))
+    readings = [(seconds(t), v) for t, v in cursor]
+
+    # The thermostat reports 'On' when heating at full demand:
+    cursor.execute(
+        "select received, state from device_reported_state "
+        "where zone_id=%s and received >= %s order by received",
+        (zone_id, since))
+    events = [(seconds(t), state == Thermostat.MODE_ON) for t, state in cursor]
+    return readings, events
+
+
+def main():
+    # Imported here so the tuning functions can be used (and tested)
+    # without the web app's database dependencies installed.
+    from .schedulerweb import model
+
+    parser = argparse.ArgumentParser(
+        description="Recommend PID gains for a zone from its history")
+    parser.add_argument("zone_id", type=int)
+    parser.add_argument("--days", type=int, default=60,
+                        help="Days of history to use for the dead time")
+    parser.add_argument("--pwm-period", type=int,
+                        help="PWM period in seconds (default: chosen from "
+                             "the zone's time constant)")
+    parser.add_argument("--max-ripple", type=float, default=MAX_RIPPLE,
+                        help="Temperature ripple (C) to allow when choosing "
+                             "the PWM period; larger values cycle the boiler "
+                             "less but control less tightly (default: "
+                             "%(default)s)")
+    parser.add_argument("--apply", action="store_true",
+                        help="Save the recommended gains for the zone")
+    args = parser.parse_args()
+
+    conf = config.load_config()
+    db = model.db_connect(conf.get('heating', 'scheduler_db_host'),
+                          conf.get('heating', 'scheduler_db_name'),
+                          conf.get('heating', 'scheduler_db_user'),
+                          conf.get('heating', 'scheduler_db_password'))
+
+    gradient_table = model.TemperatureGradientMeasurement.get_gradient_table(
+        db, args.zone_id)
+    gain, time_constant = fit_gain_and_time_constant(gradient_table)
+    since = datetime.datetime.now() - datetime.timedelta(days=args.days)
+    readings, events = _load_history(db, args.zone_id, since)
+    dead_time = estimate_dead_time(readings, events)
+
+    process = ProcessModel(gain, time_constant, dead_time)
+    params = tune(process, args.pwm_period, max_ripple=args.max_ripple)
+    logger.info("Zone %d model: gain %.1f C, time constant %.1f h, "
+                "dead time %.1f min", args.zone_id, gain,
+                time_constant / 3600, dead_time / 60)
+    if params == default_params():
+        logger.info("No tuned parameters cycle the boiler less than the "
+                    "defaults; recommending the defaults")
+    print("pid_kp=%.3f pid_ki=%.3f pid_kd=%.3f pwm_period=%d" % params)
+
+    if args.apply:
+        model.Zone.save_controller_params(db, args.zone_id, *params)
+        db.commit()
+        logger.info("Saved controller parameters for zone %d", args.zone_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+"""Backfill heating-gradient measurements from recorded history.
+
+The monitor only measures gradients live, so zones added later, or times
+when it wasn't running, have no gradient data.  This replays a zone's
+stored sensor readings and reported heating state through the same
+estimator (monitor.Monitor) and bulk-inserts the results into
+gradient_measurement, then rebuilds the zone's gradient buckets.
+
+History is read through a server-side cursor, so memory use doesn't grow
+with the length of the history.
+"""
+
+import argparse
+import datetime
+import logging
+
+from . import config
+from .monitor import Monitor
+from .thermostat import Thermostat
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Sensor readings and reported states for a zone, merged in time order.
+# state is null for sensor readings.
+_HISTORY_SQL = (
+    "select r.time as t, null as state, r.value as temperature, "
+    "null as outside_temperature from sensor_reading r "
+    "join zones z on z.sensor_id = r.sensor_id "
+    "where z.zone_id=%(zone)s and r.metric_type='temperature' "
+    "and r.time >= %(since)s and r.time < %(until)s "
+    "union all "
+    "select received, state, null, current_outside_temp "
+    "from device_reported_state "
+    "where zone_id=%(zone)s and received >= %(since)s "
+    "and received < %(until)s "
+    "order by t")
+
+
+def find_gradients(history, monitor=None):
+    """Replay history through a Monitor and yield the gradients found.
+
+    history is a time-ordered iterable of (time, state, temperature,
+    outside temperature) as read by _HISTORY_SQL: sensor readings have a
+    state of None, and reported states have no temperature.  The heating is
+    taken to be on while the reported state is Thermostat.MODE_ON.
+
+    Yields (time, GradientEstimate)."""
+    if monitor is None:
+        monitor = Monitor()
+    start = None
+    heating = False
+    for when, state, temperature, outside in history:
+        if start is None:
+            start = when
+        t = (when - start).total_seconds()
+        if state is None:
+            if temperature is not None:
+                result = monitor.temperature_update(temperature, t)
+                if result is not None:
+                    yield when, result
+            continue
+
+        if outside is not None:
+            monitor.set_outside_temperature(outside, t)
+        if state == Thermostat.MODE_ON:
+            if not heating:
+                monitor.boiler_on(t)
+                heating = True
+        elif heating:
+            heating = False
+            result = monitor.boiler_off(t)
+            if result is not None:
+                yield when, result
+
+
+def _read_history(connection, zone_id, since, until, itersize=10000):
+    cursor = connection.cursor(name='backfill_history')
+    cursor.itersize = itersize
+    cursor.execute(_HISTORY_SQL,
+                   {'zone': zone_id, 'since': since, 'until': until})
+    try:
+        yield from cursor
+    finally:
+        cursor.close()
+
+
+def _insert(connection, zone_id, gradients):
+    from psycopg2.extras import execute_values
+
+    execute_values(
+        connection.cursor(),
+        'insert into gradient_measurement '
+        '(zone, "when", delta, gradient, stderr, npoints) values %s',
+        [(zone_id, when, g.delta, g.gradient, g.stderr, g.npoints)
+         for when, g in gradients])
+
+
+def backfill_zone(connection, zone_id, since, until, replace=False,
+                  batch_size=1000):
+    """Backfill gradient measurements for a zone between since and until.
+
+    If replace is set, existing measurements in that period are deleted
+    first; otherwise take care not to backfill a period the monitor was
+    running for.  Returns the number of measurements added.  The caller
+    should commit."""
+    # Imported here so the replay logic can be used (and tested) without
+    # the web app's database dependencies installed.
+    from .schedulerweb import model
+
+    if replace:
+        cursor = connection.cursor()
+        cursor.execute(
+            'delete from gradient_measurement where zone=%s '
+            'and "when" >= %s and "when" < %s', (zone_id, since, until))
+        logger.info("Zone %d: deleted %d existing measurements", zone_id,
+                    cursor.rowcount)
+
+    count = 0
+    batch = []
+    for gradient in find_gradients(
+            _read_history(connection, zone_id, since, until)):
+        batch.append(gradient)
+        if len(batch) >= batch_size:
+            _insert(connection, zone_id, batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        _insert(connection, zone_id, batch)
+        count += len(batch)
+
+    model.TemperatureGradientMeasurement.rebuild_gradient_table(
+        connection, zone_id)
+    return count
+
+
+def main():
+    from .schedulerweb import model
+
+    def date(s):
+        return datetime.datetime.strptime(s, '%Y-%m-%d')
+
+    parser = argparse.ArgumentParser(
+        description="Backfill gradient measurements from history")
+    parser.add_argument("zone_id", type=int, nargs='+')
+    parser.add_argument("--since", type=date, required=True,
+                        help="Start of the period to backfill (YYYY-MM-DD)")
+    parser.add_argument("--until", type=date,
+                        default=datetime.datetime.now(),
+                        help="End of the period to backfill (YYYY-MM-DD; "
+                             "default now)")
+    parser.add_argument("--replace", action="store_true",
+                        help="Delete existing measurements in the period")
+    args = parser.parse_args()
+
+    # The monitor logs every reading at debug level:
+    logging.getLogger('boilerio.monitor').setLevel(logging.INFO)
+
+    conf = config.load_config()
+    db = model.db_connect(conf.get('heating', 'scheduler_db_host'),
+                          conf.get('heating', 'scheduler_db_name'),
+                          conf.get('heating', 'scheduler_db_user'),
+                          conf.get('heating', 'scheduler_db_password'))
+
+    for zone_id in args.zone_id:
+        count = backfill_zone(db, zone_id, args.since, args.until,
+                              args.replace)
+        db.commit()
+        logger.info("Zone %d: added %d gradient measurements", zone_id,
+                    count)
+
+
+if __name__ == "__main__":
+    main()
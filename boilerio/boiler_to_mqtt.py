@@ -1,14 +1,22 @@
 import argparse
 import serial
-import sys
 import paho.mqtt.client as mqtt
 import json
 import logging
+import threading
+from . import codec
 from . import config
+from .clock import SYSTEM_CLOCK
+from .commandqueue import DEMAND_COMMANDS, LEARN_COMMANDS
+from .relaystate import RelayStateTable
+from .router import Device, Router
 from .version import software_version
 
 logging.basicConfig(level=logging.DEBUG)
 
+# Seconds between reports of the transceivers' metrics:
+METRICS_INTERVAL = 60
+
 
 def on_connect(client, userdata, flags, reason_code, properties):
     if reason_code.is_failure:
@@ -23,90 +31,105 @@ def on_message(client, userdata, msg):
         return
 
     try:
-        request = json.loads(msg.payload)
-        request['thermostat'] = hex(int(request['thermostat'], 0))
+        request = codec.decode(msg.topic, msg.payload)
     except ValueError:
         logging.error("Error parsing request")
         return
 
-    if 'command' not in request or \
-       request['command'] not in ['O', 'X', 'L']:
+    if request.get('command') not in DEMAND_COMMANDS + LEARN_COMMANDS:
         logging.error("Invalid or no command specified")
-    if 'thermostat' not in request:
+        return
+    try:
+        thermostat = request['thermostat']
+        if isinstance(thermostat, str):
+            thermostat = int(thermostat, 0)
+        request['thermostat'] = hex(int(thermostat))
+    except (KeyError, TypeError, ValueError):
         logging.error("Invalid or no thermostat ID specified")
-    userdata['command_queue'].append(request)
-    logging.debug("Queued command %s", str(request))
+        return
+    relay_state = userdata.get('relay_state')
+    if relay_state is not None and not relay_state.should_send(request):
+        logging.debug("Relay already in requested state: %s", str(request))
+        return
+    if userdata['command_queue'].put(request):
+        logging.debug("Queued command %s", str(request))
+    else:
+        logging.error("Command queue full: dropped %s", str(request))
+
+
+def report_metrics(client, router, metrics_topic, relay_state=None):
+    metrics = router.metrics()
+    if relay_state is not None:
+        metrics = {'devices': metrics, 'suppressed': relay_state.suppressed}
+    logging.info("Transceivers: %s", metrics)
+    if metrics_topic:
+        client.publish(metrics_topic, json.dumps(metrics))
+
+
+def make_publisher(client, zone_basetopic, relay_state=None):
+    """A Transceiver on_report callback publishing reports to MQTT.
+
+    ON/OFF reports are retained, so a new subscriber gets the current state
+    of each relay straight away.  If relay_state is given, it's updated
+    with each report."""
+    def publish(direction, tid, cmd):
+        if relay_state is not None:
+            relay_state.update(direction, tid, cmd)
+        msg = json.dumps({
+            'thermostat': tid,
+            'direction': direction,
+            'cmd': cmd
+        })
+        logging.info("Publishing update to {}/{} : {}".format(
+            zone_basetopic, tid, msg))
+        client.publish("{}/{}".format(zone_basetopic, tid), msg,
+                       retain=cmd != 'LEARN')
+    return publish
+
+
+def open_serial(path):
+    # The Transceiver waits in select(), so reads mustn't block:
+    return lambda: serial.Serial(path, 57600, timeout=0)
 
 
 def run(mqtt_host, mqtt_user, mqtt_password, zone_basetopic, demand_topic,
-        sensor_filename):
-    # command_queue is a shared queue containing request objects, which are
-    # dictionaries like: {'command': '[O|X|L]', 'thermostat': '0xXXXX'}
-    # Messages are added when received from mqtt and processed in the loop
-    # below, to avoid shared access to the serial device.
-    command_queue = []
-
-    userdata = {'demand_topic': demand_topic, 'command_queue': command_queue}
-
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, userdata=userdata)
+        device_paths, metrics_topic=None, routes=None,
+        refresh_window=RelayStateTable.REFRESH_WINDOW, clock=SYSTEM_CLOCK):
+    """Bridge MQTT to the transceivers at device_paths.
+
+    routes maps thermostat IDs to the device path that should send to them;
+    see router.Router.  A command matching the state its relay was put in
+    within the last refresh_window seconds isn't sent again (see
+    relaystate.RelayStateTable); 0 sends every command."""
+    # Requests are dictionaries like {'command': '[O|X|L]', 'thermostat':
+    # '0xXXXX'}.  They're added to the router when received from mqtt, and
+    # each device's commands are sent by its own thread, to avoid shared
+    # access to the serial devices.
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    devices = [Device(path, open_serial(path), clock)
+               for path in device_paths]
+    relay_state = RelayStateTable(refresh_window, clock)
+    command_router = Router(
+        devices, make_publisher(client, zone_basetopic, relay_state),
+        routes, clock)
+
+    client.user_data_set({'demand_topic': demand_topic,
+                          'command_queue': command_router,
+                          'relay_state': relay_state})
     client.username_pw_set(mqtt_user, mqtt_password)
     client.on_connect = on_connect
     client.on_message = on_message
     client.connect(mqtt_host, 1883, 60)
 
+    stop = threading.Event()
     client.loop_start()
     try:
-        sensor_filename = sys.argv[1]
-        # Note that the timeout of 0.5s allows time between commands being
-        # sent/received
-        with serial.Serial(sensor_filename, 57600, timeout=0.5) as sensor_file:
-            data = ""
-            while True:
-                data = data + sensor_file.readline().decode('utf-8')
-
-                # Was a full message received?  If so, process it, otherwise
-                # keep it until next time.
-                if data.endswith('\n'):
-                    try:
-                        data = data.strip()
-                        if data == "Danfoss thermostat transceiver":
-                            logging.info("Device welcome banner received: "
-                                         "Operating normally")
-                            continue
-                        try:
-                            direction, tid, cmd = data.split()
-                            if direction not in ['ISSUE', 'RECV']:
-                                raise ValueError("Unknown direction {}".format(
-                                    direction))
-                            if cmd not in ['ON', 'OFF', 'LEARN']:
-                                raise ValueError("Unknown command {}".format(
-                                    cmd))
-                        except ValueError:
-                            logging.error("Couldn't parse input: {}".format(
-                                data))
-                            continue
-                        msg = {
-                            'thermostat': tid,
-                            'direction': direction,
-                            'cmd': cmd
-                        }
-                        logging.info("Publishing update to {}/{} : {}".format(
-                            zone_basetopic, tid, json.dumps(msg)))
-                        client.publish("{}/{}".format(zone_basetopic, tid),
-                                       json.dumps(msg))
-                    finally:
-                        data = ""
-                elif not data:
-                    # Nothing was received; send a command from the queue
-                    try:
-                        request = command_queue.pop()
-                    except IndexError:
-                        # There was nothing in the list
-                        continue
-                    sensor_file.write("{}{}\n".format(
-                        request['command'], request['thermostat']).encode())
-                    logging.debug("Pushed command %s", str(request))
+        command_router.start(stop)
+        while not stop.wait(METRICS_INTERVAL):
+            report_metrics(client, command_router, metrics_topic,
+                           relay_state)
     finally:
+        stop.set()
         client.loop_stop()
 
 
@@ -115,17 +138,24 @@ def main():
     parser = argparse.ArgumentParser(
         description='Interface between MQTT and serial-controlled '
                     'heating relay')
-    parser.add_argument('device_path',
+    parser.add_argument('device_path', nargs='+',
                         help="Path to serial device for relay controller, "
-                             "e.g. /dev/ttyUSB0")
+                             "e.g. /dev/ttyUSB0; give several to share "
+                             "commands between them")
     args = parser.parse_args()
     conf = config.load_config()
+    codec.from_config(conf)
     run(conf.get('mqtt', 'host'),
         conf.get('mqtt', 'user'),
         conf.get('mqtt', 'password'),
         conf.get('heating', 'info_basetopic'),
         conf.get('heating', 'demand_request_topic'),
-        args.device_path)
+        args.device_path,
+        conf.get('heating', 'relay_metrics_topic', fallback=None),
+        dict(conf.items('transceivers'))
+        if conf.has_section('transceivers') else None,
+        conf.getfloat('heating', 'relay_refresh_window',
+                      fallback=RelayStateTable.REFRESH_WINDOW))
 
 
 if __name__ == "__main__":
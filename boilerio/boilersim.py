@@ -8,9 +8,10 @@ fitting.
 """
 
 import argparse
-import datetime
 import random
-from boilerio.thermostat import Thermostat, TempReading
+from boilerio.clock import VirtualClock
+from boilerio.tempsensor import SensorReading
+from boilerio.thermostat import Thermostat
 
 RAD_RAMPUP_TIME = 6
 RAD_RAMPDOWN_TIME = 25
@@ -33,16 +34,24 @@ class FakeBoiler(object):
     def off(self):
         self.house.heating(False)
 
+class FakeSensor(object):
+    def __init__(self):
+        self.reading = None
+
 class House(object):
-    def __init__(self, start_temp):
-        self.outside_temp = 15
+    # Constants of heat gain/loss per minute
+    D_HOUSE = 0.000270974484739
+    D_RAD = 0.000455917702374
+
+    def __init__(self, start_temp, outside_temp=15, d_house=D_HOUSE,
+                 d_rad=D_RAD):
+        self.outside_temp = outside_temp
         self.room_temp = start_temp
         self.heating_on = False
         self.rad_temp_delta = 0
 
-        # Constants of heat gain/loss
-        self.d_house = 0.000270974484739
-        self.d_rad = 0.000455917702374
+        self.d_house = d_house
+        self.d_rad = d_rad
 
     # Dumb linear ramp-up/down for radiator heat:
     def update_rad(self):
@@ -69,15 +78,20 @@ class House(object):
     def heating(self, heating):
         self.heating_on = heating
 
-def run_simulation(start_temp, target_temp, sim_duration_mins,
-                   randomness):
-    house = House(start_temp)
+def simulate(house, target_temp, sim_duration_mins, randomness,
+             **thermostat_params):
+    """Simulate a thermostat controlling a house.
+
+    thermostat_params are passed to the Thermostat (e.g. PID gains).  Yields
+    a tuple per simulated minute with the columns described in the README.
+    """
+    # The virtual clock lets the simulation run as fast as the CPU allows:
+    clock = VirtualClock()
     boiler = FakeBoiler(house)
-    thermostat = Thermostat(boiler)
+    sensor = FakeSensor()
+    thermostat = Thermostat(boiler, sensor, **thermostat_params)
     thermostat.set_target_temperature(target_temp)
 
-    # Start time doesn't really matter:
-    now = start = datetime.datetime(2000, 1, 1, 0, 0)
     for minute in range(sim_duration_mins):
         # Compute time into day and determine if we need to change target:
         #day_minute = minute % (60 * 24)
@@ -89,21 +103,29 @@ def run_simulation(start_temp, target_temp, sim_duration_mins,
         #    target_temp = new_target
         #    state.update_target_temperature(target_temp)
 
-        boiler_on = 0
-        for _ in range(60):
-            now = now + datetime.timedelta(0, 1)
-            thermostat.interval_elapsed(now)
-            boiler_on += 1 if house.heating_on else 0
-        house.tick()
         if randomness:
             room_temp_with_error = house.room_temp - 0.05 + 0.1 * random.random()
         else:
             room_temp_with_error = house.room_temp
-        thermostat.update_temperature(TempReading(now, room_temp_with_error))
-        print((now - start).total_seconds() / 60, target_temp, boiler_on,
-              thermostat._pwm_control.dutycycle, house.room_temp, room_temp_with_error,
-              thermostat._pid.last_prop, thermostat._pid.error_integral,
-              thermostat._pid.last_diff)
+        sensor.reading = SensorReading(clock.now(), room_temp_with_error, 0,
+                                       clock.monotonic())
+
+        boiler_on = 0
+        for _ in range(60):
+            clock.advance(1)
+            thermostat.interval_elapsed(clock.monotonic())
+            boiler_on += 1 if house.heating_on else 0
+        house.tick()
+        yield (clock.monotonic() / 60, target_temp, boiler_on,
+               thermostat._pwm_control.dutycycle, house.room_temp,
+               room_temp_with_error, thermostat._pid.last_prop,
+               thermostat._pid.error_integral, thermostat._pid.last_diff)
+
+def run_simulation(start_temp, target_temp, sim_duration_mins,
+                   randomness, **thermostat_params):
+    for row in simulate(House(start_temp), target_temp, sim_duration_mins,
+                        randomness, **thermostat_params):
+        print(*row)
 
 def main():
     parser = argparse.ArgumentParser()
@@ -112,9 +134,18 @@ def main():
     parser.add_argument("start_temp", type=float)
     parser.add_argument("target_temp", type=float)
     parser.add_argument("runtime", type=int)
+    parser.add_argument("--kp", type=float, dest="pid_kp",
+                        help="PID proportional gain")
+    parser.add_argument("--ki", type=float, dest="pid_ki",
+                        help="PID integral gain")
+    parser.add_argument("--kd", type=float, dest="pid_kd",
+                        help="PID derivative gain")
+    parser.add_argument("--pwm-period", type=int, dest="pwm_period",
+                        help="PWM period in seconds")
     args = parser.parse_args()
     run_simulation(args.start_temp, args.target_temp, args.runtime,
-                   args.random)
+                   args.random, pid_kp=args.pid_kp, pid_ki=args.pid_ki,
+                   pid_kd=args.pid_kd, pwm_period=args.pwm_period)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,43 @@
+"""Backing off from something that keeps failing."""
+
+from .clock import SYSTEM_CLOCK
+
+
+class CircuitBreaker(object):
+    """Decides when to retry something that keeps failing.
+
+    After failure_threshold consecutive failures the breaker opens and
+    allow() returns False for a delay, starting at base_delay seconds and
+    doubling (up to max_delay) each time a retry fails.  Once the delay
+    has passed a single retry is allowed; a success closes the breaker."""
+
+    __slots__ = ('failure_threshold', 'base_delay', 'max_delay', '_clock',
+                 '_failures', '_retry_at')
+
+    def __init__(self, failure_threshold=3, base_delay=60, max_delay=3600,
+                 clock=SYSTEM_CLOCK):
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._clock = clock
+        self._failures = 0
+        self._retry_at = None
+
+    @property
+    def is_open(self):
+        return self._failures >= self.failure_threshold
+
+    def allow(self):
+        return (self._retry_at is None or
+                self._clock.monotonic() >= self._retry_at)
+
+    def succeeded(self):
+        self._failures = 0
+        self._retry_at = None
+
+    def failed(self):
+        self._failures += 1
+        if self.is_open:
+            delay = min(self.max_delay, self.base_delay *
+                        2 ** (self._failures - self.failure_threshold))
+            self._retry_at = self._clock.monotonic() + delay
@@ -0,0 +1,47 @@
+"""Time sources for the control stack.
+
+Internal timing (PWM periods, stale readings, cache lifetimes, command
+re-issue) uses monotonic time in float seconds: it is cheap to read and
+compare, and does not jump when NTP steps the clock or DST changes.
+Wall-clock datetimes are only used where calendar time matters, such as
+looking up the schedule or timestamping data sent to the web service.
+"""
+
+import datetime
+import time
+
+
+class SystemClock(object):
+    """The real clock."""
+
+    __slots__ = ()
+
+    monotonic = staticmethod(time.monotonic)
+    now = staticmethod(datetime.datetime.now)
+
+
+class VirtualClock(object):
+    """A clock that only moves when advanced.
+
+    Lets simulations and tests run at CPU speed.  Wall-clock time is
+    derived from the monotonic time so the two always agree."""
+
+    __slots__ = ('_start', '_monotonic')
+
+    def __init__(self, start=datetime.datetime(2000, 1, 1), monotonic=0.0):
+        """start: the wall-clock time corresponding to monotonic time 0."""
+        self._start = start
+        self._monotonic = float(monotonic)
+
+    def monotonic(self):
+        return self._monotonic
+
+    def now(self):
+        return self._start + datetime.timedelta(seconds=self._monotonic)
+
+    def advance(self, seconds):
+        """Move the clock forward by a number of seconds."""
+        self._monotonic += seconds
+
+
+SYSTEM_CLOCK = SystemClock()
@@ -0,0 +1,142 @@
+"""Encoding and decoding of MQTT payloads.
+
+Messages are JSON unless their topic is configured to use another format,
+in the [codecs] section of the config file (see from_config):
+
+    msgpack   MessagePack (needs the msgpack package)
+    emonth    a fixed binary struct of an emonTH-style reading
+
+The format is never guessed from the topic, so existing topics are read as
+they always were.  JSON is decoded with orjson if it is installed, and the
+standard json module otherwise.
+"""
+
+import json
+import struct
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class CodecUnavailable(ValueError):
+    """The payload is in a format whose library isn't installed."""
+
+
+class JsonCodec(object):
+    name = 'json'
+
+    if orjson is not None:
+        @staticmethod
+        def decode(payload):
+            return orjson.loads(payload)
+
+        @staticmethod
+        def encode(data):
+            return orjson.dumps(data)
+    else:
+        @staticmethod
+        def decode(payload):
+            return json.loads(payload)
+
+        @staticmethod
+        def encode(data):
+            return json.dumps(data).encode()
+
+
+class MsgpackCodec(object):
+    name = 'msgpack'
+
+    @staticmethod
+    def decode(payload):
+        if msgpack is None:
+            raise CodecUnavailable("msgpack isn't installed")
+        return msgpack.unpackb(payload)
+
+    @staticmethod
+    def encode(data):
+        if msgpack is None:
+            raise CodecUnavailable("msgpack isn't installed")
+        return msgpack.packb(data)
+
+
+class EmonTHCodec(object):
+    """An emonTH-style reading packed into six bytes.
+
+    Little-endian: temperature in hundredths of a degree C (signed),
+    relative humidity in hundredths of a percent, and battery voltage in
+    millivolts."""
+    name = 'emonth'
+
+    _struct = struct.Struct('<hHH')
+
+    @classmethod
+    def decode(cls, payload):
+        try:
+            temperature, humidity, battery = cls._struct.unpack(payload)
+        except struct.error as e:
+            raise ValueError(str(e))
+        return {'temperature': temperature / 100,
+                'humidity': humidity / 100,
+                'battery': battery / 1000}
+
+    @classmethod
+    def encode(cls, data):
+        return cls._struct.pack(round(data['temperature'] * 100),
+                                round(data['humidity'] * 100),
+                                round(data.get('battery', 0) * 1000))
+
+
+JSON = JsonCodec
+CODECS = {codec.name: codec for codec in (JsonCodec, MsgpackCodec,
+                                             EmonTHCodec)}
+
+# Topic -> codec, for topics that don't use JSON:
+_topic_codecs = {}
+
+
+def set_codec(topic, name):
+    """Use the codec called name (a key of CODECS) for a topic."""
+    try:
+        _topic_codecs[topic] = CODECS[name]
+    except KeyError:
+        raise ValueError("Unknown codec %s" % name)
+
+
+def from_config(conf):
+    """Set the topics' codecs from the [codecs] section of the config.
+
+    Each option is a codec name and lists, separated by whitespace, the
+    topics that use it:
+
+        [codecs]
+        emonth = emon/emonth1 emon/emonth2
+    """
+    if not conf.has_section('codecs'):
+        return
+    for name, topics in conf.items('codecs'):
+        for topic in topics.split():
+            set_codec(topic, name)
+
+
+def for_topic(topic):
+    """The codec for messages on a topic."""
+    return _topic_codecs.get(topic, JSON)
+
+
+def decode(topic, payload):
+    """Decode a message payload.
+
+    Raises ValueError if the payload can't be decoded."""
+    return for_topic(topic).decode(payload)
+
+
+def encode(topic, data):
+    """Encode a message payload for a topic."""
+    return for_topic(topic).encode(data)
@@ -0,0 +1,162 @@
+"""The queue of commands waiting to be sent to the relay transceiver.
+
+Commands arrive on the MQTT thread and are sent from the serial thread, one
+at a time as the transceiver becomes free.  Only the latest command for
+each thermostat matters (an ON followed by an OFF before either was sent
+should just send the OFF), so commands are coalesced by thermostat ID:
+a new command replaces the one waiting for that thermostat but keeps its
+place in the queue, so relays are served in the order they first asked.
+Learn packets are sent only when no ON/OFF commands are waiting, so a
+burst of them can't hold up real demand.
+"""
+
+import collections
+import threading
+
+from .clock import SYSTEM_CLOCK
+
+# ON/OFF commands, and the lower-priority learn packets:
+DEMAND_COMMANDS = ('O', 'X')
+LEARN_COMMANDS = ('L',)
+
+
+class CommandQueue(object):
+    """A thread-safe, bounded queue of relay commands.
+
+    Commands are dictionaries like {'command': 'O', 'thermostat': '0x1a2b'}.
+    At most max_size thermostats can have a command waiting; a new command
+    beyond that displaces the oldest waiting learn packet if it's an ON/OFF
+    command, and is otherwise dropped.
+
+    Listeners (see add_listener) are called with no arguments whenever a
+    command is queued, e.g. to wake the thread that sends them."""
+
+    MAX_SIZE = 256
+
+    def __init__(self, max_size=MAX_SIZE, clock=SYSTEM_CLOCK):
+        self.max_size = max_size
+        self._clock = clock
+        self._lock = threading.Lock()
+        # Thermostat -> (command, time queued), in order of arrival:
+        self._demand = collections.OrderedDict()
+        self._learn = collections.OrderedDict()
+        self.stats = QueueStats()
+        self._listeners = []
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._demand) + len(self._learn)
+
+    def put(self, request, replace=True):
+        """Queue a command, replacing any waiting for the same thermostat.
+
+        With replace=False, a command already waiting is kept instead.
+        Returns False if the command wasn't queued."""
+        if request['command'] in LEARN_COMMANDS:
+            queue = self._learn
+        else:
+            queue = self._demand
+        thermostat = request['thermostat']
+        with self._lock:
+            if not replace and thermostat in queue:
+                return False
+            stats = self.stats
+            stats.received += 1
+            waiting = queue.get(thermostat)
+            if waiting is not None:
+                stats.coalesced += 1
+                # Latency counts from when the thermostat first asked:
+                queued = waiting[1]
+            else:
+                if len(self._demand) + len(self._learn) >= self.max_size:
+                    if queue is self._learn or not self._learn:
+                        stats.dropped += 1
+                        return False
+                    self._learn.popitem(last=False)
+                    stats.dropped += 1
+                queued = self._clock.monotonic()
+            queue[thermostat] = (request, queued)
+            stats.depth = len(self._demand) + len(self._learn)
+            stats.max_depth = max(stats.max_depth, stats.depth)
+        for listener in self._listeners:
+            listener()
+        return True
+
+    def remove(self, thermostat):
+        """Remove and return the command waiting for a thermostat, if any."""
+        with self._lock:
+            entry = (self._demand.pop(thermostat, None) or
+                     self._learn.pop(thermostat, None))
+            self.stats.depth = len(self._demand) + len(self._learn)
+        return entry[0] if entry is not None else None
+
+    def drain(self):
+        """Remove and return all the waiting commands, in order."""
+        with self._lock:
+            requests = [request for request, _ in
+                        list(self._demand.values()) +
+                        list(self._learn.values())]
+            self._demand.clear()
+            self._learn.clear()
+            self.stats.depth = 0
+        return requests
+
+    def metrics(self):
+        """A snapshot of the queue's QueueStats, as a dictionary."""
+        with self._lock:
+            return self.stats.as_dict()
+
+    def pop(self):
+        """Take the next command to send, or None if there are none."""
+        with self._lock:
+            if self._demand:
+                _, (request, queued) = self._demand.popitem(last=False)
+            elif self._learn:
+                _, (request, queued) = self._learn.popitem(last=False)
+            else:
+                return None
+            stats = self.stats
+            stats.depth = len(self._demand) + len(self._learn)
+            stats.sent += 1
+            stats.add_latency(self._clock.monotonic() - queued)
+        return request
+
+
+class QueueStats(object):
+    """Counters for a CommandQueue.
+
+    Latency is from a command arriving to it being taken to send; for a
+    command that replaced others, from the first of them arriving."""
+
+    __slots__ = ('received', 'coalesced', 'dropped', 'sent', 'depth',
+                 'max_depth', 'latency_total', 'latency_max')
+
+    def __init__(self):
+        self.received = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.sent = 0
+        self.depth = 0
+        self.max_depth = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def add_latency(self, latency):
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    @property
+    def latency_mean(self):
+        return self.latency_total / self.sent if self.sent else None
+
+    def as_dict(self):
+        result = {name: getattr(self, name) for name in self.__slots__
+                  if name != 'latency_total'}
+        result['latency_mean'] = self.latency_mean
+        return result
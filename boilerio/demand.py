@@ -0,0 +1,154 @@
+"""Combining the demand of zones that share a boiler relay.
+
+Each zone's thermostat turns its "boiler" on and off, and reports its duty
+cycle: 1 when heating up, the PWM duty cycle when maintaining a temperature,
+and 0 otherwise.  When several zones are wired to one relay, giving each
+its own MqttBoiler would have them fight over it: one zone's PWM off-phase
+would cancel another's demand.  Instead each zone gets a ZoneDemand from
+the RelayDemand for its relay, which combines them and drives the relay:
+
+'or':       the relay is on whenever any zone's thermostat has it on.
+'max':      the relay is modulated at the highest zone duty cycle.
+'weighted': the relay is modulated at the mean of the zones' duty cycles,
+            weighted by each zone's weight.
+
+The relay is held on or off for at least min_on or min_off seconds once
+switched, to limit boiler cycling, and its cycles are counted.  Zones'
+(or, for 'max' and 'weighted', relays') PWM cycles are staggered by a
+pwm.PWMScheduler so that they don't all call for heat at once.
+"""
+
+import collections
+
+from . import pwm
+
+POLICIES = ('or', 'max', 'weighted')
+
+
+class ZoneDemand(object):
+    """One zone's demand on a relay; stands in for the zone's boiler."""
+
+    __slots__ = ('zone_id', 'weight', 'active', 'dutycycle')
+
+    def __init__(self, zone_id, weight=1.0):
+        self.zone_id = zone_id
+        self.weight = weight
+        self.active = False
+        self.dutycycle = 0
+
+    def on(self):
+        self.active = True
+
+    def off(self):
+        self.active = False
+
+    def set_dutycycle(self, dutycycle):
+        self.dutycycle = dutycycle
+
+
+class RelayDemand(object):
+    """Drives a boiler relay from the combined demand of its zones.
+
+    boiler: an object with on and off methods, e.g. a scheduler.MqttBoiler.
+    policy: one of POLICIES.
+    period: the PWM period for the 'max' and 'weighted' policies.
+    pwm_scheduler: a pwm.PWMScheduler to stagger that PWM's cycles with.
+    min_on, min_off: the minimum time in seconds the relay is switched on
+        or off for.
+
+    update() should be called once per tick, after the zones' thermostats;
+    the boiler is commanded only from there, once per tick rather than once
+    per zone."""
+
+    CYCLE_WINDOW = 3600
+
+    def __init__(self, boiler, policy='or', period=600, pwm_scheduler=None,
+                 min_on=0, min_off=0):
+        if policy not in POLICIES:
+            raise ValueError("Unknown demand policy %s" % policy)
+        self.boiler = boiler
+        self.policy = policy
+        self.min_on = min_on
+        self.min_off = min_off
+        self.zones = []
+        # The PWM's output, for the 'max' and 'weighted' policies:
+        self._modulated = ZoneDemand(None)
+        self._pwm = pwm.PWM(0, period, self._modulated, min_on=min_on,
+                            min_off=min_off)
+        self._pwm_scheduler = None
+        if pwm_scheduler is not None and policy != 'or':
+            self._pwm_scheduler = pwm_scheduler
+            pwm_scheduler.add(self._pwm)
+        self.active = None
+        self._switched = None
+        self.cycles = 0
+        # Times the relay was switched on within the last CYCLE_WINDOW:
+        self._cycle_times = collections.deque()
+
+    def add_zone(self, zone_id, weight=1.0):
+        """Returns the ZoneDemand a zone's thermostat should use as its
+        boiler."""
+        zone = ZoneDemand(zone_id, weight)
+        self.zones.append(zone)
+        return zone
+
+    def remove_zone(self, zone):
+        self.zones.remove(zone)
+
+    def close(self):
+        """Turn the relay off, once it's no longer used."""
+        if self._pwm_scheduler is not None:
+            self._pwm_scheduler.remove(self._pwm)
+            self._pwm_scheduler = None
+        self.boiler.off()
+
+    @property
+    def dutycycle(self):
+        """The combined duty cycle, or None with the 'or' policy."""
+        zones = self.zones
+        if self.policy == 'max':
+            return max((z.dutycycle for z in zones), default=0)
+        if self.policy == 'weighted':
+            total = sum(z.weight for z in zones)
+            if not total:
+                return 0
+            return sum(z.weight * z.dutycycle for z in zones) / total
+        return None
+
+    def cycles_per_hour(self, now):
+        """The number of times the relay was switched on in the last hour."""
+        cycle_times = self._cycle_times
+        while cycle_times and cycle_times[0] <= now - self.CYCLE_WINDOW:
+            cycle_times.popleft()
+        return len(cycle_times)
+
+    def metrics(self, now):
+        return {'on': bool(self.active), 'dutycycle': self.dutycycle,
+                'cycles': self.cycles,
+                'cycles_per_hour': self.cycles_per_hour(now)}
+
+    def update(self, now):
+        """Command the boiler.
+
+        now: the current monotonic time in seconds (see boilerio.clock)"""
+        if self.policy == 'or':
+            active = any(z.active for z in self.zones)
+        else:
+            self._pwm.setDutyCycle(self.dutycycle)
+            self._pwm.update(now)
+            active = self._modulated.active
+
+        # Switch unless the relay hasn't been on or off for long enough:
+        if active != self.active:
+            hold = self.min_on if self.active else self.min_off
+            if self.active is None or now - self._switched >= hold:
+                if active:
+                    self.cycles += 1
+                    self._cycle_times.append(now)
+                self.active = active
+                self._switched = now
+
+        if self.active:
+            self.boiler.on()
+        else:
+            self.boiler.off()
@@ -0,0 +1,152 @@
+"""Routing of MQTT messages to the objects that consume them.
+
+One MqttDispatcher handles every message for a client: topic filters
+(which may use the MQTT '+' and '#' wildcards) are compiled into a trie,
+each payload is decoded once (see codec.py), and the result is passed to
+every consumer whose filter matches.  Consumers are called as consumer(topic, data).
+"""
+
+import logging
+import threading
+
+from . import codec
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class TopicTrie(object):
+    """Maps MQTT topic filters to consumers.
+
+    Filters are stored level by level.  The consumers for each topic seen
+    are cached, so repeat lookups (the usual case: a fleet of sensors
+    publishing to fixed topics) are a single dict lookup.
+
+    Thread-safe: filters are added and removed on the control thread (e.g.
+    when zones are reloaded) while messages are matched on the network
+    thread.  Everything but a cache hit holds a lock, so a lookup can't
+    cache consumers that a concurrent change has made stale."""
+
+    # Limit on cached topics, in case wildcard filters match very many:
+    MAX_CACHED = 100000
+
+    __slots__ = ('_root', '_cache', '_lock')
+
+    def __init__(self):
+        # Each node is [children by level, consumers ending here]
+        self._root = [{}, []]
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def add(self, topic_filter, consumer):
+        with self._lock:
+            node = self._root
+            for level in topic_filter.split('/'):
+                node = node[0].setdefault(level, [{}, []])
+            node[1].append(consumer)
+            self._cache.clear()
+
+    def remove(self, topic_filter, consumer):
+        with self._lock:
+            node = self._root
+            for level in topic_filter.split('/'):
+                node = node[0].get(level)
+                if node is None:
+                    return
+            if consumer in node[1]:
+                node[1].remove(consumer)
+            self._cache.clear()
+
+    def filters(self):
+        """The topic filters that have consumers."""
+        result = []
+
+        def walk(node, path):
+            if node[1]:
+                result.append('/'.join(path))
+            for level, child in node[0].items():
+                walk(child, path + [level])
+
+        with self._lock:
+            for level, child in self._root[0].items():
+                walk(child, [level])
+        return result
+
+    def match(self, topic):
+        """The consumers whose filters match a topic."""
+        consumers = self._cache.get(topic)
+        if consumers is None:
+            with self._lock:
+                if len(self._cache) >= self.MAX_CACHED:
+                    self._cache.clear()
+                consumers = []
+                self._match(self._root, topic.split('/'), 0,
+                            not topic.startswith('$'), consumers)
+                consumers = self._cache[topic] = tuple(consumers)
+        return consumers
+
+    def _match(self, node, levels, i, wildcards_ok, result):
+        children = node[0]
+        # Topics starting with $ aren't matched by a leading wildcard:
+        if wildcards_ok:
+            multi = children.get('#')
+            if multi is not None:
+                result.extend(multi[1])
+        if i == len(levels):
+            result.extend(node[1])
+            return
+        child = children.get(levels[i])
+        if child is not None:
+            self._match(child, levels, i + 1, True, result)
+        if wildcards_ok:
+            single = children.get('+')
+            if single is not None:
+                self._match(single, levels, i + 1, True, result)
+
+
+class MqttDispatcher(object):
+    """The single MQTT message handler for a client.
+
+    Set on_message as the client's message callback, and call subscribe()
+    from its on_connect callback."""
+
+    # Topics per SUBSCRIBE packet:
+    SUBSCRIBE_BATCH = 100
+
+    def __init__(self):
+        self._trie = TopicTrie()
+
+    def add(self, topic_filter, consumer):
+        """Call consumer(topic, data) for messages matching topic_filter."""
+        self._trie.add(topic_filter, consumer)
+
+    def remove(self, topic_filter, consumer):
+        self._trie.remove(topic_filter, consumer)
+
+    def filters(self):
+        """The topic filters that have consumers."""
+        return self._trie.filters()
+
+    def subscribe(self, client, qos=0):
+        """Subscribe to all the topic filters, in batches."""
+        topics = [(f, qos) for f in self._trie.filters()]
+        for i in range(0, len(topics), self.SUBSCRIBE_BATCH):
+            client.subscribe(topics[i:i + self.SUBSCRIBE_BATCH])
+
+    def on_message(self, client, userdata, msg):
+        consumers = self._trie.match(msg.topic)
+        if not consumers:
+            return
+        try:
+            data = codec.decode(msg.topic, msg.payload)
+        except ValueError:
+            logger.error("Couldn't parse message on %s: %s", msg.topic,
+                         msg.payload)
+            return
+        for consumer in consumers:
+            try:
+                consumer(msg.topic, data)
+            except Exception:
+                logger.critical("Exception escaped from handler for %s",
+                                msg.topic, exc_info=True)
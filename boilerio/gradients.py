@@ -0,0 +1,129 @@
+"""Heating-gradient tables and the estimates derived from them.
+
+A gradient table, as served by /zones/<id>/gradients, gives the rate a
+zone heats up at (degrees C per hour) with the boiler on, bucketed by the
+delta between inside and outside temperature.
+"""
+
+from array import array
+import bisect
+import math
+
+
+class GradientTable(object):
+    """A gradient table indexed for interpolated lookup.
+
+    The buckets are held as sorted arrays.  Between buckets the gradient
+    is interpolated linearly, with each bucket's influence weighted by the
+    number (or time-decayed weight) of measurements behind it so that
+    sparsely-measured buckets don't pull the estimate around.  Outside the
+    table the nearest bucket's gradient is used.
+    """
+
+    __slots__ = ('deltas', 'gradients', 'weights')
+
+    def __init__(self, gradient_table):
+        """gradient_table: a list of dictionaries with 'delta', 'gradient'
+        and (optionally) 'weight' or 'npoints' keys."""
+        buckets = sorted((float(g['delta']), float(g['gradient']),
+                          float(g.get('weight') or g.get('npoints') or 1))
+                         for g in gradient_table)
+        self.deltas = array('d', (d for d, _, _ in buckets))
+        self.gradients = array('d', (g for _, g, _ in buckets))
+        self.weights = array('d', (w for _, _, w in buckets))
+
+    def __len__(self):
+        return len(self.deltas)
+
+    def gradient_at(self, delta):
+        """Heating gradient in degrees C per hour at an inside/outside
+        delta, or None if the table is empty."""
+        deltas = self.deltas
+        if not deltas:
+            return None
+        i = bisect.bisect_right(deltas, delta)
+        if i == 0:
+            return self.gradients[0]
+        if i == len(deltas):
+            return self.gradients[-1]
+        d0 = deltas[i - 1]
+        t = (delta - d0) / (deltas[i] - d0)
+        w0 = self.weights[i - 1] * (1 - t)
+        w1 = self.weights[i] * t
+        return ((w0 * self.gradients[i - 1] + w1 * self.gradients[i]) /
+                (w0 + w1))
+
+
+class LeadTimeTable(object):
+    """Time needed to heat a zone, tabulated against temperature delta.
+
+    Holds the cumulative time to heat from the smallest delta in the
+    gradient table to each point on a STEP-spaced grid: the integral of
+    1/gradient over the heating curve.  The time to heat between any two
+    deltas is then the difference of two lookups.  Built once per gradient
+    table update; lookups are a bisect and some arithmetic so it is cheap
+    enough to use on every tick.
+    """
+
+    STEP = 0.5
+
+    __slots__ = ('_deltas', '_hours', '_first_gradient', '_last_gradient')
+
+    def __init__(self, gradients):
+        """gradients: a GradientTable."""
+        self._deltas = array('d')
+        self._hours = array('d')
+        if not len(gradients):
+            return
+
+        first, last = gradients.deltas[0], gradients.deltas[-1]
+        self._first_gradient = gradients.gradients[0]
+        self._last_gradient = gradients.gradients[-1]
+
+        def rate(delta):
+            # Hours per degree; infinite if the zone can't heat at delta.
+            gradient = gradients.gradient_at(delta)
+            return 1 / gradient if gradient > 0 else math.inf
+
+        delta = first
+        hours = 0.0
+        self._deltas.append(delta)
+        self._hours.append(hours)
+        while delta < last:
+            step = min(self.STEP, last - delta)
+            # Simpson's rule across the step:
+            hours += step / 6 * (rate(delta) + 4 * rate(delta + step / 2) +
+                                 rate(delta + step))
+            delta += step
+            self._deltas.append(delta)
+            self._hours.append(hours)
+
+    def _hours_to(self, delta):
+        deltas = self._deltas
+        if delta <= deltas[0]:
+            gradient = self._first_gradient
+            if gradient <= 0:
+                return -math.inf
+            return (delta - deltas[0]) / gradient
+        if delta >= deltas[-1]:
+            gradient = self._last_gradient
+            if gradient <= 0:
+                return math.inf
+            return self._hours[-1] + (delta - deltas[-1]) / gradient
+        i = bisect.bisect_right(deltas, delta)
+        d0, h0 = deltas[i - 1], self._hours[i - 1]
+        return h0 + (self._hours[i] - h0) * (delta - d0) / (deltas[i] - d0)
+
+    def lead_time(self, from_delta, to_delta):
+        """Seconds to heat from one inside/outside delta to another.
+
+        Returns None if there is no data or the gradient table says the
+        zone can't get that warm."""
+        if not self._deltas:
+            return None
+        if to_delta <= from_delta:
+            return 0.0
+        hours = self._hours_to(to_delta) - self._hours_to(from_delta)
+        if math.isinf(hours) or math.isnan(hours):
+            return None
+        return hours * 3600
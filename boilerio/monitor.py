@@ -1,44 +1,110 @@
 #!/usr/bin/env python
 
-from datetime import timedelta, datetime
 import logging
-import json
+import math
+import threading
+from collections import namedtuple
 import requests
 import requests.exceptions
 from requests.auth import HTTPBasicAuth
 import paho.mqtt.client as mqtt
 
+from . import codec
 from . import config
+from . import dispatch
 from . import scheduler
 from . import weather
+from .clock import SYSTEM_CLOCK
 from .version import software_version
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# A heating gradient measurement: the inside/outside delta at the start of
+# the measurement, the gradient in degrees C per hour, its standard error,
+# and the number of readings it was fitted to.
+GradientEstimate = namedtuple('GradientEstimate',
+                              ['delta', 'gradient', 'stderr', 'npoints'])
+
 class Monitor(object):
-    CAPTURE_FIRST, CAPTURE_INTERVAL = list(range(2))
+    """Measures the heating gradient while the boiler is on.
+
+    After a warm-up period every temperature reading taken while the boiler
+    stays on goes into a least-squares fit of temperature against time,
+    whose slope is the heating gradient.  Only running sums are kept, so
+    the state is the same size however long the run.  An estimate is made
+    when the boiler turns off, or once the readings span MAX_WINDOW_S so
+    that long runs give measurements at several deltas.  Estimates from
+    fewer than MIN_SAMPLES readings, spanning less than MIN_WINDOW_S, or
+    with a standard error above max_stderr are discarded.
+
+    Times passed in are monotonic seconds (see boilerio.clock)."""
 
-    def __init__(self, warmup_interval_s=600):
+    MIN_SAMPLES = 3
+    MIN_WINDOW_S = 600
+    MAX_WINDOW_S = 3600
+
+    def __init__(self, warmup_interval_s=600, max_stderr=0.5):
         self._boiler_on_time = None
-        self._first_temp_recording = None
-        self._first_temp_time = None
-        self._mode = self.CAPTURE_FIRST
         self._outside_temperature = None
         self._outside_temperature_time = None
-        self._warmup_interval = timedelta(seconds=warmup_interval_s)
+        self._warmup_interval = warmup_interval_s
+        self._max_stderr = max_stderr
+        self._reset_fit()
+
+    def _reset_fit(self):
+        # Times are hours since the first reading and temperatures relative
+        # to it, which keeps the sums well-conditioned.
+        self._n = 0
+        self._first_time = None
+        self._first_temp = None
+        self._delta = None
+        self._span = 0.0
+        self._sum_t = self._sum_y = 0.0
+        self._sum_tt = self._sum_ty = self._sum_yy = 0.0
+
+    def _add_reading(self, temp, when):
+        if self._n == 0:
+            self._first_time = when
+            self._first_temp = temp
+            self._delta = temp - self._outside_temperature
+        t = (when - self._first_time) / 3600.0
+        y = temp - self._first_temp
+        self._n += 1
+        self._span = t
+        self._sum_t += t
+        self._sum_y += y
+        self._sum_tt += t * t
+        self._sum_ty += t * y
+        self._sum_yy += y * y
+
+    def _estimate(self):
+        """The gradient fitted to the readings so far, or None."""
+        n = self._n
+        if n < self.MIN_SAMPLES or self._span * 3600 < self.MIN_WINDOW_S:
+            return None
+        sxx = self._sum_tt - self._sum_t * self._sum_t / n
+        sxy = self._sum_ty - self._sum_t * self._sum_y / n
+        syy = self._sum_yy - self._sum_y * self._sum_y / n
+        gradient = sxy / sxx
+        residual = max(0.0, syy - gradient * sxy)
+        stderr = math.sqrt(residual / (n - 2) / sxx)
+        if stderr > self._max_stderr:
+            logger.info("Discarding gradient %.2f: standard error %.2f too "
+                        "large", gradient, stderr)
+            return None
+        return GradientEstimate(self._delta, gradient, stderr, n)
 
     def set_outside_temperature(self, value, when):
         self._outside_temperature = value
         self._outside_temperature_time = when
 
     def temperature_update(self, temp, when):
-        """Call to indicate tempreature update.  Returns a record to record or None.
+        """Call to indicate temperature update.
 
-        Returns a temperature gradient in degrees per hour if appropriate,
-        otherwise None.  The return value will be pair:
-            (delta temp, heating gradient)
+        Returns a GradientEstimate if a measurement window has just
+        completed, otherwise None.
         """
         if self._boiler_on_time is None:
             logger.debug("No boiler on time")
@@ -48,32 +114,20 @@ class Monitor(object):
             logger.debug("No outside temperature")
             return None
 
-        if (self._mode == self.CAPTURE_FIRST and
-            (when - self._boiler_on_time > self._warmup_interval)):
-            self._first_temp_recording = temp
-            self._first_temp_time = when
-            self._mode = self.CAPTURE_INTERVAL
-            logger.debug("Captured first")
+        if when - self._boiler_on_time <= self._warmup_interval:
+            logger.debug("Still warming up (now: %s, boiler on %s).",
+                         when, self._boiler_on_time)
+            return None
+
+        self._add_reading(temp, when)
+        if self._span * 3600 < self.MAX_WINDOW_S:
             return None
 
-        # First temperature value captured: get one after the capture interval
-        if (self._mode == self.CAPTURE_INTERVAL and
-            (when - self._first_temp_time > timedelta(minutes=10))):
-            delta_temp = temp - self._first_temp_recording
-            delta_time = when - self._first_temp_time
-            delta_time_hours = delta_time.total_seconds() / 3600.0
-            self._mode = self.CAPTURE_FIRST
-            return (self._first_temp_recording - self._outside_temperature,
-                    delta_temp / delta_time_hours)
-
-        logger.debug("Not yet after the capture interval (now: %s, last: %s, boiler on %s, mode %d).",
-                     'None' if when is None else when.strftime("%Y-%m-%dT%H:%M"),
-                     'None' if self._first_temp_time is None else
-                        self._first_temp_time.strftime("%Y-%m-%dT%H:%M"),
-                     'None' if self._boiler_on_time is None else
-                        self._boiler_on_time.strftime("%Y-%m-%dT%H:%M"),
-                     self._mode)
-        return None
+        # Start the next window from this reading:
+        result = self._estimate()
+        self._reset_fit()
+        self._add_reading(temp, when)
+        return result
 
     def boiler_on(self, when):
         """Signal that the boiler was turned on."""
@@ -81,69 +135,206 @@ class Monitor(object):
             self._boiler_on_time = when
 
     def boiler_off(self, when):
-        """Signal that the boiler was turned on."""
+        """Signal that the boiler was turned off.
+
+        Returns a GradientEstimate for the end of the run, or None."""
+        result = None
+        if self._boiler_on_time is not None:
+            result = self._estimate()
         self._boiler_on_time = None
+        self._reset_fit()
+        return result
 
-class MqttMonitor(Monitor):
-    def __init__(self, mqttc, zone_info_topic, sensor_topic, weather,
-            gradient_callback_fn, warmup_interval_s=600,
-            weather_update_interval_s=3600):
+class MqttMonitor(object):
+    """Measures heating gradients for a set of zones from MQTT messages.
+
+    A single MQTT message handler routes relay and sensor messages by topic
+    to a Monitor per zone, so the cost per message doesn't depend on the
+    number of zones.  The outside temperature comes from a weather object
+    shared by all zones, such as one built by weather.from_config, which
+    caches the reading so it isn't fetched for every zone.
+    """
+    def __init__(self, weather, gradient_callback_fn, warmup_interval_s=600,
+                 clock=SYSTEM_CLOCK):
         """Initialize MqttMonitor.
 
         gradient_callback_fn is a function that is called when a new
-        gradient is found.  It should take two parameter: 'delta' and
-        'gradient' which are the delta that the gradient was observed at
-        and the inside gradient when heating was on in degrees C per hour.
+        gradient is found.  It should take six parameters: 'zone_id',
+        'when', 'delta', 'gradient', 'stderr' and 'npoints' which are the
+        zone, the wall-clock time of the measurement, the delta that the
+        gradient was observed at, the inside gradient when heating was on
+        in degrees C per hour, its standard error and the number of
+        readings it was fitted to.  It is called from the MQTT thread so
+        shouldn't block.
         """
         self.weather = weather
-        self.weather_update_interval = timedelta(seconds=weather_update_interval_s)
         self.gradient_callback_fn = gradient_callback_fn
+        self._warmup_interval = warmup_interval_s
+        self._clock = clock
+        self.monitors = {}
 
-        # Set up MQTT callbacks:
-        mqttc.message_callback_add(sensor_topic, self.mqtt_temperature_update)
-        mqttc.message_callback_add(zone_info_topic, self.mqtt_relay_update)
+        # topic -> list of (zone_id, Monitor):
+        self._relay_topics = {}
+        self._sensor_topics = {}
 
-        super(MqttMonitor, self).__init__(warmup_interval_s)
+    def add_zone(self, zone_id, relay_topic, sensor_topic):
+        """Start monitoring a zone.  Returns its Monitor."""
+        monitor = Monitor(self._warmup_interval)
+        self.monitors[zone_id] = monitor
+        self._relay_topics.setdefault(relay_topic, []).append(
+            (zone_id, monitor))
+        self._sensor_topics.setdefault(sensor_topic, []).append(
+            (zone_id, monitor))
+        return monitor
 
-    def mqtt_temperature_update(self, mqttc, userdata, msg):
-        logger.debug("%s: %s", msg.topic, msg.payload)
-        now = datetime.now()
-        data = json.loads(msg.payload)
+    def topics(self):
+        """The topics that need to be subscribed to."""
+        return sorted(set(self._relay_topics) | set(self._sensor_topics))
 
-        # Should we update the outside temperature?
-        # XXX using CachingWeather instead...
-        if (self._outside_temperature is None or
-            now - self._outside_temperature_time < self.weather_update_interval):
-            try:
-                w = self.weather.get_weather()
-                logger.info("Updating weather information: %s", str(w))
-                self.set_outside_temperature(w['temperature'], now)
-            except:
-                logging.error("Unable to get weather.  Skipping update this "
-                              "iteration")
+    def register(self, dispatcher):
+        """Receive messages through a dispatch.MqttDispatcher."""
+        for topic in self.topics():
+            dispatcher.add(topic, self.handle_message)
+
+    def on_message(self, client, userdata, msg):
+        """MQTT message handler."""
+        try:
+            self.handle_message(msg.topic,
+                                codec.decode(msg.topic, msg.payload))
+        except Exception:
+            logger.critical("Exception escaped from MQTT handler for %s",
+                            msg.topic, exc_info=True)
+
+    def handle_message(self, topic, data):
+        """Handle a decoded message."""
+        logger.debug("%s: %s", topic, data)
+        sensor_monitors = self._sensor_topics.get(topic)
+        if sensor_monitors is not None:
+            self._temperature_update(data, sensor_monitors)
+        relay_monitors = self._relay_topics.get(topic)
+        if relay_monitors is not None:
+            self._relay_update(data, relay_monitors)
+
+    def _outside_temperature(self):
+        try:
+            w = self.weather.get_weather()
+        except Exception as e:
+            logger.error("Unable to get weather: %s", e)
+            return None
+        return None if w is None else w['temperature']
+
+    def _temperature_update(self, data, monitors):
+        if 'temperature' not in data:
+            return
         try:
             temp = float(data['temperature'])
-        except ValueError as e:
-            logging.error("Unable to parse temperature value %s, ignoring", data['temperature'])
+        except ValueError:
+            logger.error("Unable to parse temperature value %s, ignoring",
+                         data['temperature'])
+            return
+
+        now = self._clock.monotonic()
+        outside = self._outside_temperature()
+        for zone_id, monitor in monitors:
+            if outside is not None:
+                monitor.set_outside_temperature(outside, now)
+            self._report(zone_id, monitor.temperature_update(temp, now))
+
+    def _relay_update(self, data, monitors):
+        now = self._clock.monotonic()
+        for zone_id, monitor in monitors:
+            if data['cmd'] == 'OFF':
+                self._report(zone_id, monitor.boiler_off(now))
+            elif data['cmd'] == 'ON':
+                monitor.boiler_on(now)
+
+    def _report(self, zone_id, estimate):
+        if estimate is None:
             return
+        logger.info("Zone %d: temperature gradient result: %s",
+                    zone_id, str(estimate))
+        self.gradient_callback_fn(zone_id, self._clock.now(),
+                                  estimate.delta, estimate.gradient,
+                                  estimate.stderr, estimate.npoints)
+
+
+class GradientUploader(object):
+    """Posts gradient measurements to the scheduler in batches.
+
+    add() only queues a measurement so it is safe to call from an MQTT
+    callback.  A background thread (see start()) posts the queue every
+    flush_interval_s seconds, or sooner once max_batch measurements are
+    waiting.  Measurements that fail to post are kept for the next attempt;
+    beyond max_pending the oldest are dropped.
+    """
+    def __init__(self, scheduler_url, auth, flush_interval_s=900,
+                 max_batch=100, max_pending=1000):
+        self._url = scheduler_url + '/zones/gradient_measurements'
+        self._auth = auth
+        self._flush_interval = flush_interval_s
+        self._max_batch = max_batch
+        self._max_pending = max_pending
+        self._pending = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
 
-        r = self.temperature_update(temp, now)
-        if r is not None:
-            logger.info("%s: Temperature gradient result: %s", msg.topic, str(r))
-            self.gradient_callback_fn(now, r[0], r[1])
+    def add(self, zone_id, when, delta, gradient, stderr=None, npoints=None):
+        with self._lock:
+            self._pending.append({'zone_id': zone_id,
+                                  'when': when.isoformat(), 'delta': delta,
+                                  'gradient': gradient, 'stderr': stderr,
+                                  'npoints': npoints})
+            self._trim()
+            full = len(self._pending) >= self._max_batch
+        if full:
+            self._wakeup.set()
+
+    def _trim(self):
+        dropped = len(self._pending) - self._max_pending
+        if dropped > 0:
+            logger.warning("Dropping %d unposted gradient measurements",
+                           dropped)
+            del self._pending[:dropped]
+
+    def flush(self):
+        """Post all pending measurements.  Returns False if a post failed."""
+        while True:
+            with self._lock:
+                batch = self._pending[:self._max_batch]
+                del self._pending[:self._max_batch]
+            if not batch:
+                return True
+            try:
+                r = requests.post(self._url, json=batch, auth=self._auth,
+                                  headers={'X-Requested-With': 'device'},
+                                  timeout=10)
+                r.raise_for_status()
+            except requests.exceptions.RequestException as e:
+                logger.error("Failed to post %d gradient measurements: %s",
+                             len(batch), e)
+                with self._lock:
+                    self._pending[:0] = batch
+                    self._trim()
+                return False
+            logger.info("Posted %d gradient measurements", len(batch))
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def start(self):
+        """Start posting from a background thread."""
+        thread = threading.Thread(target=self._run, name='gradient-uploader',
+                                  daemon=True)
+        thread.start()
 
-    def mqtt_relay_update(self, mqttc, userdata, msg):
-        logger.debug("%s: %s", msg.topic, msg.payload)
-        now = datetime.now()
-        data = json.loads(msg.payload)
-        if data['cmd'] == 'OFF':
-            self.boiler_off(now)
-        elif data['cmd'] == 'ON':
-            self.boiler_on(now)
 
 def main():
     logger.info("Starting boilerio monitor %s", software_version())
     conf = config.load_config()
+    codec.from_config(conf)
 
     # Get zone information:
     # If the 'heating' section of the config has a 'scheduler_username' and
@@ -158,42 +349,38 @@ def main():
         auth = None
     scheduler_url = conf.get('heating', 'scheduler_url')
     zones = scheduler.load_zone_info(scheduler_url, auth)
+    sensors = scheduler.construct_sensors(scheduler_url, auth)
+
+    uploader = GradientUploader(scheduler_url, auth)
+    uploader.start()
+
+    clock = SYSTEM_CLOCK
+    weather_obj, weather_sensors = weather.from_config(conf, clock)
+    monitor = MqttMonitor(weather_obj, uploader.add, clock=clock)
+    for zone in zones:
+        monitor.add_zone(
+            zone.zone_id, conf.get('heating', 'info_basetopic') + '/0x' +
+            format(int(zone.boiler_relay, 0), 'X'),
+            sensors[zone.sensor_id].locator)
+
+    dispatcher = dispatch.MqttDispatcher()
+    monitor.register(dispatcher)
+    for sensor in weather_sensors:
+        sensor.register(dispatcher)
 
     # Connect to MQTT:
     def mqtt_on_connect(client, userdata, flags, reason_code, properties):
         if reason_code.is_failure:
             logger.error("Error connecting to MQTT: %s", reason_code)
             return
-        client.subscribe(conf.get('heating', 'info_basetopic') + '/#')
-        for zone in zones:
-            client.subscribe(zone.sensor)
+        dispatcher.subscribe(client)
     mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
     mqttc.username_pw_set(conf.get('mqtt', 'user'),
                           conf.get('mqtt', 'password'))
     mqttc.on_connect = mqtt_on_connect
+    mqttc.on_message = dispatcher.on_message
     mqttc.connect(conf.get('mqtt', 'host'), 1883, 60)
 
-    def post_gradient_fn(zone_id):
-        def post_gradient(when, delta, gradient):
-            data = {'when': when.isoformat(), 'delta': delta,
-                    'gradient': gradient}
-            r = requests.post(scheduler_url +
-                    '/zones/%d/gradient_measurements' % zone_id,
-                    auth=auth, json=data, timeout=10)
-            logger.info("Posted gradient %s for zone %d, status code %d",
-                    str(data), zone_id, r.status_code)
-        return post_gradient
-
-    monitors = [
-        MqttMonitor(
-            mqttc, conf.get('heating', 'info_basetopic') + '/0x' +
-            format(int(zone.boiler_relay, 0), 'X'), zone.sensor,
-            weather.Weather(conf.get('weather', 'apikey'),
-                            conf.get('weather', 'location')),
-            post_gradient_fn(zone.zone_id))
-        for zone in zones
-    ]
-
     mqttc.loop_forever()
 
 if __name__ == "__main__":
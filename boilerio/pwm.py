@@ -1,4 +1,3 @@
-import datetime
 import logging
 
 logging.basicConfig()
@@ -7,34 +6,121 @@ logger.setLevel(logging.DEBUG)
 
 class PWM(object):
     """Performs pulse-width modulation."""
-    def __init__(self, dutycycle, period, device):
+
+    # update() is called every tick, so the cycle boundaries are computed once
+    # when a cycle begins and each tick is then just a pair of comparisons.
+    __slots__ = ('period', 'phase', 'dutycycle', 'on_period', 'active',
+                 'periodBegin', 'device', 'min_on', 'min_off', 'scheduler',
+                 '_next_phase', '_period_end', '_on_end', '_on_since',
+                 '_switches_on')
+
+    def __init__(self, dutycycle, period, device, phase=None, min_on=0,
+                 min_off=0):
         """Initialise PWM state.
 
-        dutycycle: a timedelate representing the time duration the device
-                   should be on (weird naming...).
-        period: the duration of a full cycle (on + off)
-        device: an object implementing on and off methods."""
+        dutycycle: the fraction of the period the device should be on.
+        period: the duration of a full cycle (on + off) in seconds
+        device: an object implementing on and off methods.
+        phase: if given, cycles begin at times phase + n * period, rather
+            than whenever the first update after a change of duty cycle
+            happens; PWMs with different phases don't turn their devices
+            on at the same time.  A change of duty cycle or phase (see
+            set_phase) then applies from the next cycle, which begins at
+            the nearest aligned time; only a duty cycle of 0 applies at
+            once.  See PWMScheduler.
+        min_on, min_off: the shortest time in seconds the device should be
+            switched on or off for.  A shorter on-phase is skipped, and a
+            shorter off-phase is filled in.
+
+        Times passed to update are monotonic seconds (see boilerio.clock)."""
         self.period = period
+        self.phase = phase
+        self.min_on = min_on
+        self.min_off = min_off
+        self.scheduler = None
         self.dutycycle = None
-        self.setDutyCycle(dutycycle)
         self.active = False
         self.periodBegin = None
+        self._next_phase = None
+        self._period_end = None
+        self._on_end = None
+        self._on_since = None
+        self.setDutyCycle(dutycycle)
         self.device = device
 
     def setDutyCycle(self, dutycycle):
         if self.dutycycle != dutycycle:
             self.dutycycle = dutycycle
-            self.on_period = datetime.timedelta(0,
-                self.period.total_seconds() * dutycycle)
-            self.periodBegin = None
+            self._set_on_period()
+            if self.phase is None:
+                self.periodBegin = None
+            elif self.periodBegin is not None and not self._switches_on:
+                self._set_on_end()
+            if self.scheduler is not None:
+                self.scheduler.reschedule()
+
+    def set_phase(self, phase):
+        """Align cycles to a new phase, from the next cycle on."""
+        if self.periodBegin is None:
+            self.phase = phase
+        else:
+            self._next_phase = phase
+
+    def set_limits(self, min_on, min_off):
+        """Change the minimum on and off times."""
+        self.min_on = min_on
+        self.min_off = min_off
+        self._set_on_period()
+
+    def _set_on_period(self):
+        on_period = self.period * self.dutycycle
+        if 0 < on_period < self.min_on:
+            on_period = 0
+        elif 0 < self.period - on_period < self.min_off:
+            on_period = self.period
+        self.on_period = on_period
+        self._switches_on = on_period > 0
+
+    def _set_on_end(self):
+        # A device that's on stays on for at least min_on, even if the
+        # on-period is cut short:
+        on_end = self.periodBegin + self.on_period
+        if self.active:
+            on_end = max(on_end, self._on_since + self.min_on)
+        self._on_end = on_end
 
     def update(self, now):
         # Begin new cycle?
-        if self.periodBegin is None or \
-           self.periodBegin + self.period <= now:
-            logger.debug("Beginning PWM new cycle @ %s", str(now))
-            self.periodBegin = now
-            self.active = self.on_period > datetime.timedelta(0, 0)
+        if self.periodBegin is None or self._period_end <= now:
+            logger.debug("Beginning PWM new cycle @ %.1f", now)
+            if self._next_phase is not None:
+                self.phase = self._next_phase
+                self._next_phase = None
+            begin = now
+            if self.phase is not None:
+                # The nearest time aligned with the phase:
+                begin -= (now - self.phase) % self.period
+                if (now - begin > self.period / 2 and
+                        self.on_period < self.period):
+                    begin += self.period
+            if begin > now:
+                # Off until the first aligned cycle begins:
+                self.periodBegin = now
+                self._period_end = begin
+                self._on_end = now
+                active = False
+            else:
+                self.periodBegin = begin
+                self._period_end = begin + self.period
+                self._on_end = begin + self.on_period
+                # Skip what's left of the on-phase if it's too short:
+                remaining = self._on_end - now
+                active = self._switches_on and (
+                    self.on_period >= self.period or
+                    (remaining > 0 and remaining >= self.min_on))
+            if active and not self.active:
+                self._on_since = now
+            self.active = active
             if self.active:
                 self.device.on()
             else:
@@ -42,10 +128,46 @@ class PWM(object):
             return
 
         # End of 'on' cycle?
-        if (self.periodBegin + self.on_period) <= now:
-            if self.on_period <= self.period and self.active:
-                logger.debug("End of PWM duty cycle @ %s", str(now))
+        if self._on_end <= now:
+            if self.active and self.on_period <= self.period:
+                logger.debug("End of PWM duty cycle @ %.1f", now)
                 self.device.off()
                 self.active = False
             return
 
+
+class PWMScheduler(object):
+    """Staggers the cycles of PWMs driving one boiler.
+
+    The PWMs' phases are set so that each one's on-phase follows the last
+    one's, rather than them all starting together, which flattens the peak
+    demand on the boiler.  They're rescheduled whenever a duty cycle
+    changes; a PWM whose phase changes finishes its current cycle first,
+    and its next cycle begins at the nearest time aligned with the new
+    phase (skipping what's left of its on-phase if that's under min_on).
+    (The phases are spread over the first PWM's period; PWMs with other
+    periods are staggered less evenly.)
+
+    PWMs added are also given the scheduler's minimum on and off times."""
+
+    def __init__(self, min_on=0, min_off=0):
+        self.min_on = min_on
+        self.min_off = min_off
+        self.pwms = []
+
+    def add(self, pwm):
+        pwm.scheduler = self
+        pwm.set_limits(self.min_on, self.min_off)
+        self.pwms.append(pwm)
+        self.reschedule()
+
+    def remove(self, pwm):
+        self.pwms.remove(pwm)
+        pwm.scheduler = None
+        self.reschedule()
+
+    def reschedule(self):
+        offset = 0
+        for pwm in self.pwms:
+            pwm.set_phase(offset % pwm.period)
+            offset += pwm.on_period
@@ -0,0 +1,69 @@
+"""The last known state of each relay, as seen by boiler_to_mqtt.
+
+The transceivers report every ON/OFF command they transmit (ISSUE) or hear
+from a real thermostat (RECV); the last of these for a thermostat ID is the
+state its relay was last told to be in.  Zone controllers re-send their
+command periodically in case one was lost, so a command matching the state
+confirmed within the last refresh_window seconds needn't be transmitted
+again.  Commands still go out at least once per window, so a relay that
+missed one (or fails safe when it hears nothing) is kept in step.
+"""
+
+import threading
+
+from .clock import SYSTEM_CLOCK
+from .transceiver import COMMAND_NAMES, thermostat_key
+
+
+class RelayStateTable(object):
+    """Per-relay state built from transceiver reports.
+
+    Thread-safe: reports arrive on the transceiver threads, and commands
+    are checked on the MQTT thread."""
+
+    REFRESH_WINDOW = 600
+
+    def __init__(self, refresh_window=REFRESH_WINDOW, clock=SYSTEM_CLOCK):
+        self.refresh_window = refresh_window
+        self._clock = clock
+        self._lock = threading.Lock()
+        # Thermostat -> (command name, time confirmed):
+        self._states = {}
+        # Thermostat -> the command name last accepted to send:
+        self._requested = {}
+        self.suppressed = 0
+
+    def state(self, tid):
+        """The last reported command name ('ON' or 'OFF') for a thermostat,
+        or None."""
+        with self._lock:
+            entry = self._states.get(thermostat_key(tid))
+        return entry[0] if entry is not None else None
+
+    def update(self, direction, tid, cmd):
+        """Record a report from a transceiver."""
+        if cmd not in ('ON', 'OFF'):
+            return
+        key = thermostat_key(tid)
+        with self._lock:
+            self._states[key] = (cmd, self._clock.monotonic())
+
+    def should_send(self, request):
+        """Whether a command needs to be transmitted.
+
+        It doesn't if it's the same as the last command accepted for the
+        thermostat and the relay was confirmed in that state within the
+        refresh window; otherwise it's recorded as accepted."""
+        cmd = COMMAND_NAMES[request['command']]
+        if cmd not in ('ON', 'OFF'):
+            return True
+        key = thermostat_key(request['thermostat'])
+        with self._lock:
+            state = self._states.get(key)
+            if (self._requested.get(key) == cmd and state is not None and
+                    state[0] == cmd and self._clock.monotonic() - state[1] <
+                    self.refresh_window):
+                self.suppressed += 1
+                return False
+            self._requested[key] = cmd
+            return True
@@ -0,0 +1,184 @@
+"""Sharing relay commands between several transceivers.
+
+A single transceiver's RF duty cycle limits how many relays it can address
+quickly, and its range limits which ones it can reach.  Router runs a
+Transceiver per serial device, each on its own thread with its own
+CommandQueue, and decides which device sends each command:
+
+1.  the device configured for the thermostat, if any;
+2.  otherwise the device that last heard the thermostat (a RECV report),
+    as it's in range;
+3.  otherwise the device with the fewest commands waiting.
+
+A device that stops acknowledging commands, or whose port fails, is
+skipped (see breaker.CircuitBreaker) and its waiting commands are passed
+to the others until it's given another try.
+"""
+
+import logging
+import threading
+
+from .breaker import CircuitBreaker
+from .clock import SYSTEM_CLOCK
+from .commandqueue import CommandQueue
+from .transceiver import Transceiver, thermostat_key
+
+logger = logging.getLogger(__name__)
+
+
+class Device(object):
+    """A serial transceiver and the commands waiting for it.
+
+    open_port is called with no arguments to open the port, returning a
+    context manager; e.g. a pyserial Serial opened with timeout=0."""
+
+    # Seconds to wait before reopening a port that failed:
+    REOPEN_DELAY = 10
+    # Consecutive unacknowledged commands before the device is skipped:
+    FAILURE_THRESHOLD = 2
+
+    def __init__(self, name, open_port, clock=SYSTEM_CLOCK):
+        self.name = name
+        self.open_port = open_port
+        self.commands = CommandQueue(clock=clock)
+        self.breaker = CircuitBreaker(self.FAILURE_THRESHOLD, base_delay=30,
+                                      max_delay=600, clock=clock)
+        self.transceiver = None
+
+    def __repr__(self):
+        return "<Device %s>" % self.name
+
+
+class Router(object):
+    """Routes commands to a set of Devices.
+
+    Has the same put() and metrics() as a CommandQueue, so it can stand in
+    for one.  on_report is called as for a Transceiver, from the device's
+    thread.  routes maps thermostat IDs to the names of the devices that
+    should send to them."""
+
+    def __init__(self, devices, on_report, routes=None, clock=SYSTEM_CLOCK):
+        self.devices = list(devices)
+        self._by_name = {device.name: device for device in self.devices}
+        self._on_report = on_report
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._routes = {thermostat_key(tid): name
+                        for tid, name in (routes or {}).items()}
+        for name in self._routes.values():
+            if name not in self._by_name:
+                raise ValueError("Route to unknown device %s" % name)
+        # Thermostat -> name of the device that last heard it:
+        self._learned = {}
+        # Thermostat -> the device its last command was given to:
+        self._assigned = {}
+
+    def put(self, request, replace=True):
+        """Queue a command on the device that should send it."""
+        key = thermostat_key(request['thermostat'])
+        with self._lock:
+            device = self._choose(key)
+            previous = self._assigned.get(key)
+            self._assigned[key] = device
+        # Don't leave an older command waiting on another device:
+        if previous is not None and previous is not device and replace:
+            previous.commands.remove(request['thermostat'])
+        return device.commands.put(request, replace)
+
+    def _choose(self, key, exclude=None):
+        available = [d for d in self.devices
+                     if d is not exclude and d.breaker.allow()]
+        if not available:
+            # Everything has failed: keep trying somewhere.
+            available = [d for d in self.devices if d is not exclude] or \
+                self.devices
+        for name in (self._routes.get(key), self._learned.get(key)):
+            device = self._by_name.get(name)
+            if device in available:
+                return device
+        return min(available, key=lambda d: len(d.commands))
+
+    def metrics(self):
+        """The metrics of each device's queue and transceiver, by name."""
+        result = {}
+        for device in self.devices:
+            metrics = device.commands.metrics()
+            if device.transceiver is not None:
+                metrics.update(device.transceiver.stats.as_dict())
+            metrics['failed'] = not device.breaker.allow()
+            result[device.name] = metrics
+        return result
+
+    def _report(self, device, direction, tid, cmd):
+        if direction == 'RECV':
+            try:
+                key = thermostat_key(tid)
+            except ValueError:
+                key = None
+            if key is not None and self._learned.get(key) != device.name:
+                logger.info("Learned that %s can reach %s", device.name, tid)
+                self._learned[key] = device.name
+        self._on_report(direction, tid, cmd)
+
+    def _result(self, device, request, acknowledged):
+        with self._lock:
+            if acknowledged:
+                device.breaker.succeeded()
+                return
+            device.breaker.failed()
+            if device.breaker.allow():
+                return
+        logger.error("%s isn't acknowledging commands; failing over",
+                     device.name)
+        self._fail_over(device, [request])
+
+    def _fail_over(self, device, requests=()):
+        """Move the commands waiting for a device to the others."""
+        waiting = device.commands.drain()
+        # A command already waiting is newer than one that failed:
+        pending = {r['thermostat'] for r in waiting}
+        waiting += [r for r in requests if r['thermostat'] not in pending]
+        for request in waiting:
+            key = thermostat_key(request['thermostat'])
+            with self._lock:
+                other = self._choose(key, exclude=device)
+                self._assigned[key] = other
+            # (If there's no other device, other is this one.)
+            other.commands.put(request, replace=False)
+
+    def run_device(self, device, stop):
+        """Run a device's transceiver until stop (an Event) is set."""
+        while not stop.is_set():
+            try:
+                with device.open_port() as port:
+                    transceiver = Transceiver(
+                        port, device.commands,
+                        lambda *report: self._report(device, *report),
+                        self._clock,
+                        lambda *result: self._result(device, *result))
+                    device.transceiver = transceiver
+                    try:
+                        while not stop.is_set():
+                            transceiver.poll(1.0)
+                    finally:
+                        transceiver.close()
+            except OSError as e:
+                logger.error("%s failed: %s", device.name, e)
+                # Open the breaker straight away:
+                with self._lock:
+                    while device.breaker.allow():
+                        device.breaker.failed()
+                self._fail_over(device)
+                stop.wait(device.REOPEN_DELAY)
+
+    def start(self, stop):
+        """Run every device on its own thread; returns the threads."""
+        threads = []
+        for device in self.devices:
+            thread = threading.Thread(target=self.run_device,
+                                      args=(device, stop),
+                                      name='transceiver %s' % device.name,
+                                      daemon=True)
+            thread.start()
+            threads.append(thread)
+        return threads
@@ -8,6 +8,7 @@ import json
 import datetime
 from datetime import timedelta
 import logging
+import signal
 import time
 
 import paho.mqtt.client as mqtt
@@ -17,7 +18,14 @@ from requests.auth import HTTPBasicAuth
 
 from .schedulerweb import model # XXX
 from . import config
+from . import demand
+from .clock import SYSTEM_CLOCK
+from . import codec
+from . import dispatch
+from . import pwm
 from . import thermostat
+from . import sensorfilter
+from . import sensorhealth
 from . import tempsensor
 from . import update_sensor
 from . import weather
@@ -31,20 +39,30 @@ logger.setLevel(logging.DEBUG)
 strptime = datetime.datetime.strptime
 strftime = datetime.datetime.strftime
 
+# Seconds between reports of the relays' metrics:
+METRICS_INTERVAL = 300
+
+# The last zones and sensors fetched, for when the web service is down:
+ZONE_BACKUP_FILE = '/var/lib/boilerio/zones'
+SENSOR_BACKUP_FILE = '/var/lib/boilerio/sensors'
+
 class MqttBoiler(object):
     """Control boiler using MQTT commands."""
-    # Time after which we might re-issue the same command to the boiler
-    REISSUE_TIMEOUT = timedelta(0, 120)
+    # Time in seconds after which we might re-issue the same command to the
+    # boiler
+    REISSUE_TIMEOUT = 120
 
-    def __init__(self, thermostat_id, mqttc, zone_demand_topic):
+    def __init__(self, thermostat_id, mqttc, zone_demand_topic,
+                 clock=SYSTEM_CLOCK):
         self.mqttc = mqttc
+        self._clock = clock
         self.zone_demand_topic = zone_demand_topic
         self.last_cmd = None
         self.last_cmd_time = None
         self.thermostat_id = thermostat_id
 
     def _command(self, cmd):
-        now = datetime.datetime.now()
+        now = self._clock.monotonic()
         if cmd != self.last_cmd or \
            self.last_cmd_time < now - self.REISSUE_TIMEOUT:
             logger.debug("Issuing boiler command %s for relay %s", cmd, self.thermostat_id)
@@ -134,6 +152,25 @@ class SchedulerTemperaturePolicy(object):
 
         return entries
 
+    def next_change(self, now, zone):
+        """Find the next scheduled target for a zone after now.
+
+        Target overrides are not taken into account.  Returns a tuple of
+        (datetime, temperature), or None if the zone has no schedule."""
+        weekday = now.weekday()
+        today = now.date()
+        upcoming = None
+        for day, starttime, entry_zone, temp in self.schedule.entries:
+            if entry_zone != zone:
+                continue
+            when = datetime.datetime.combine(
+                today + timedelta(days=(day - weekday) % 7), starttime)
+            if when <= now:
+                when += timedelta(days=7)
+            if upcoming is None or when < upcoming[0]:
+                upcoming = (when, temp)
+        return upcoming
+
     def target_overridden(self, now, zone):
         if self.target_override is not None:
             return any(t.zone == zone and t.end > now
@@ -166,10 +203,16 @@ def mqtt_on_connect(client, userdata, flags, reason_code, properties):
     if reason_code.is_failure:
         logger.error("Error connecting to MQTT: %s", reason_code)
         return
-    for sensor in userdata['sensors'].values():
-        client.subscribe(sensor.locator)
+    userdata['dispatcher'].subscribe(client)
     client.subscribe(userdata['thermostat_schedule_change_topic'])
 
+def save_fallback(fallback, text):
+    try:
+        with open(fallback, 'w') as f:
+            f.write(text)
+    except:
+        logger.warning("Unable to write backup zone file.")
+
 def get_url_with_fallback(fallback, url, auth):
     """Gets a URL and updates fallback file.
 
@@ -181,11 +224,7 @@ def get_url_with_fallback(fallback, url, auth):
 
     r = requests.get(url, auth=auth, timeout=10)
     if r.status_code == 200:
-        try:
-            with open(fallback, 'w') as f:
-                f.write(r.text)
-        except:
-            logger.warning("Unable to write backup zone file.")
+        save_fallback(fallback, r.text)
         result = r.text
     else:
         # That failed, try to get from last backup:
@@ -200,55 +239,325 @@ def get_url_with_fallback(fallback, url, auth):
 
     return result
 
+def zones_from_json(zones):
+    """model.Zone objects from the zones served by /zones."""
+    return [model.Zone(z['zone_id'], z['name'], z['boiler_relay'], z['sensor_id'],
+                       z.get('pid_kp'), z.get('pid_ki'), z.get('pid_kd'),
+                       z.get('pwm_period'))
+            for z in zones]
+
 def load_zone_info(scheduler_url, auth):
     """Load zone information from service. """
-    BOILERIO_ZONE_BACKUP_FILE = '/var/lib/boilerio/zones'
-
-    zones = json.loads(get_url_with_fallback(BOILERIO_ZONE_BACKUP_FILE,
+    zones = json.loads(get_url_with_fallback(ZONE_BACKUP_FILE,
                                              scheduler_url + '/zones', auth))
     if zones is None:
         raise ZoneInfoUnavailable()
 
-    return [model.Zone(z['zone_id'], z['name'], z['boiler_relay'], z['sensor_id'])
-            for z in zones]
+    return zones_from_json(zones)
 
-def construct_sensors(scheduler_url, auth):
+def construct_sensors(scheduler_url, auth, conf=None, health=None):
     """Construct sensors from service.
 
-    Return a diction of sensor_id -> EmonTHSensor object"""
-    SENSOR_BACKUP_FILE = '/var/lib/boilerio/sensors'
-
+    Each sensor's reading filters come from conf (see
+    sensorfilter.from_config), if given, and its readings are recorded in
+    the sensorhealth.SensorHealthRegistry health, if given.  Return a
+    diction of sensor_id -> EmonTHSensor object"""
     sensors = json.loads(get_url_with_fallback(SENSOR_BACKUP_FILE,
                                                scheduler_url + '/sensor/', auth))
     if sensors is None:
         raise ZoneInfoUnavailable()
 
-    return {
-        s['sensor_id']: tempsensor.EmonTHSensor(s['sensor_id'], s['locator'])
-        for s in sensors
-    }
+    return {s['sensor_id']: make_sensor(s['sensor_id'], s['locator'], conf,
+                                        health)
+            for s in sensors}
 
+def make_sensor(sensor_id, locator, conf=None, health=None):
+    """Construct a sensor; see construct_sensors."""
+    return tempsensor.EmonTHSensor(
+        sensor_id, locator,
+        filters=(sensorfilter.from_config(conf, sensor_id)
+                 if conf is not None else None),
+        health=health)
 
-class AllZoneController(object):
-    """Controller for multiple zones.
 
-    Interfaces between the web API and a set of local zone controllers."""
+class ZoneFactory(object):
+    """Builds, and takes apart, the sensors and zone controllers.
 
-    SCHEDULER_UPDATE_INTERVAL = timedelta(seconds=60)
+    sensors (sensor ID -> EmonTHSensor) and relays (relay ID ->
+    demand.RelayDemand) are the ones in use.  Sensors receive messages
+    through dispatcher, and have their readings posted by sensor_updater.
+    Zones sharing a relay have their demand combined, and all the zones'
+    PWM cycles are staggered; see the relay_demand, min_on_time and
+    min_off_time settings."""
 
-    def __init__(self, scheduler_url, auth, zone_controllers):
+    def __init__(self, scheduler_url, auth, conf, mqttc, dispatcher,
+                 sensor_updater, health, weather_obj, forecast=None,
+                 clock=SYSTEM_CLOCK):
+        self.scheduler_url = scheduler_url
+        self.auth = auth
+        self.conf = conf
+        self.mqttc = mqttc
+        self.dispatcher = dispatcher
+        self.sensor_updater = sensor_updater
+        self.health = health
+        self.weather = weather_obj
+        self.forecast = forecast
+        self._clock = clock
+        self.optimum_start = conf.getboolean('heating', 'optimum_start',
+                                             fallback=False)
+        self.demand_topic = conf.get('heating', 'demand_request_topic')
+        self.policy = conf.get('heating', 'relay_demand', fallback='or')
+        self.min_on = conf.getfloat('heating', 'min_on_time', fallback=0)
+        self.min_off = conf.getfloat('heating', 'min_off_time', fallback=0)
+        self.pwm_scheduler = pwm.PWMScheduler(self.min_on, self.min_off)
+        self.sensors = {}
+        self.relays = {}
+
+    def add_sensor(self, sensor):
+        sensor.register(self.dispatcher)
+        self.sensor_updater.add_sensor(sensor)
+        self.sensors[sensor.sensor_id] = sensor
+
+    def new_sensor(self, sensor_id, locator):
+        """Add a sensor, subscribing to its messages."""
+        sensor = make_sensor(sensor_id, locator, self.conf, self.health)
+        self.add_sensor(sensor)
+        self.mqttc.subscribe(locator)
+        return sensor
+
+    def move_sensor(self, sensor, locator):
+        """Take a sensor's readings from a different MQTT topic."""
+        old = sensor.locator
+        sensor.unregister(self.dispatcher)
+        sensor.locator = locator
+        sensor.register(self.dispatcher)
+        self._unsubscribe_unused(old)
+        self.mqttc.subscribe(locator)
+
+    def remove_sensor(self, sensor_id):
+        sensor = self.sensors.pop(sensor_id)
+        sensor.unregister(self.dispatcher)
+        self._unsubscribe_unused(sensor.locator)
+        self.sensor_updater.remove_sensor(sensor)
+        self.health.remove(sensor_id)
+
+    def _unsubscribe_unused(self, topic):
+        if topic not in self.dispatcher.filters():
+            self.mqttc.unsubscribe(topic)
+
+    def add_zone(self, zone):
+        """Returns a ZoneController for a model.Zone."""
+        relay = self.relays.get(zone.boiler_relay)
+        if relay is None:
+            relay = self.relays[zone.boiler_relay] = demand.RelayDemand(
+                MqttBoiler(zone.boiler_relay, self.mqttc, self.demand_topic,
+                           self._clock),
+                self.policy,
+                zone.pwm_period or thermostat.Thermostat.PWM_PERIOD,
+                self.pwm_scheduler, self.min_on, self.min_off)
+        zone_boiler = relay.add_zone(
+            zone.zone_id,
+            self.conf.getfloat('zone %d' % zone.zone_id, 'weight',
+                               fallback=1.0))
+        zone_sensor = self.sensors[zone.sensor_id]
+        zone_thermostat = thermostat.Thermostat(
+            zone_boiler, zone_sensor, pid_kp=zone.pid_kp,
+            pid_ki=zone.pid_ki, pid_kd=zone.pid_kd,
+            pwm_period=zone.pwm_period,
+            pwm_scheduler=self.pwm_scheduler if self.policy == 'or' else None)
+        return zones.ZoneController(
+            zone, zone_boiler, zone_sensor, zone_thermostat,
+            self.scheduler_url, self.auth, self.weather, clock=self._clock,
+            optimum_start=self.optimum_start, forecast=self.forecast)
+
+    def remove_zone(self, controller):
+        """Take apart a ZoneController from add_zone, releasing its relay."""
+        controller.close()
+        if self.policy == 'or':
+            self.pwm_scheduler.remove(controller.thermostat.pwm)
+        relay = self.relays[controller.zone.boiler_relay]
+        relay.remove_zone(controller.boiler)
+        if not relay.zones:
+            relay.close()
+            del self.relays[controller.zone.boiler_relay]
+
+
+class AllZoneController(object):
+    """Controller for multiple zones.
+
+    Interfaces between the web API and a set of local zone controllers.
+    Sensor readings received over MQTT are taken at the start of each
+    iteration, so the zone controllers and thermostats only ever run on
+    the thread calling iteration().  If a sensorhealth.SensorHealthRegistry
+    is given, it's checked for stale sensors then too.  The boiler relays,
+    demand.RelayDemand objects, are updated after the zones.
+
+    Given the ZoneFactory that built them, the zones and sensors are
+    reloaded from the web service every RELOAD_INTERVAL seconds, or when
+    request_reload() is called; see reload()."""
+
+    # Seconds between schedule refreshes
+    SCHEDULER_UPDATE_INTERVAL = 60
+    # Seconds between checks for changes to the zones and sensors
+    RELOAD_INTERVAL = 300
+
+    def __init__(self, scheduler_url, auth, zone_controllers,
+                 clock=SYSTEM_CLOCK, sensors=(), health=None, relays=(),
+                 factory=None):
         self.scheduler = None
         self.last_scheduler_update = None
+        self._clock = clock
 
         self.scheduler_url = scheduler_url
         self.auth = auth
         self.zone_controllers = zone_controllers
+        self.sensors = list(sensors)
+        self.health = health
+        self.relays = list(relays)
+        self.factory = factory
+        self.last_reload = clock.monotonic()
+        self._reload_requested = False
+        # Path -> ETag of the last response applied by reload():
+        self._etags = {}
+        # The sensor IDs the web service last listed:
+        self._listed_sensors = None
+
+    def request_reload(self):
+        """Reload the zones and sensors at the next iteration.
+
+        Safe to call from any thread, or a signal handler."""
+        self._reload_requested = True
+
+    def _get_if_modified(self, path, fallback, etags):
+        """Get a path from the web service, or None if it's unchanged since
+        the last time (or couldn't be fetched).
+
+        The response's ETag is put in etags, to be kept once it's been
+        applied."""
+        etag = self._etags.get(path)
+        r = requests.get(self.scheduler_url + path, auth=self.auth,
+                         timeout=10,
+                         headers={'If-None-Match': etag} if etag else {})
+        if r.status_code == 304:
+            return None
+        if r.status_code != 200:
+            logger.error("Couldn't get %s (%d)", path, r.status_code)
+            return None
+        etags[path] = r.headers.get('ETag')
+        save_fallback(fallback, r.text)
+        return r.json()
+
+    def reload(self):
+        """Bring the zones and sensors up to date with the web service.
+
+        Only what has changed is touched, so the other zones keep their
+        controller state: new sensors and zones are added, and those no
+        longer listed removed; a sensor with a new locator is moved to it,
+        and a zone with a new sensor is moved to that; a zone whose relay
+        or controller parameters have changed is rebuilt.
+
+        If it fails part way, everything is fetched again next time."""
+        factory = self.factory
+        etags = {}
+        sensors = self._get_if_modified('/sensor/', SENSOR_BACKUP_FILE,
+                                        etags)
+        zone_info = self._get_if_modified('/zones', ZONE_BACKUP_FILE, etags)
+
+        if sensors is not None:
+            for s in sensors:
+                sensor = factory.sensors.get(s['sensor_id'])
+                if sensor is None:
+                    logger.info("Adding sensor %d", s['sensor_id'])
+                    factory.new_sensor(s['sensor_id'], s['locator'])
+                elif sensor.locator != s['locator']:
+                    logger.info("Moving sensor %d to %s", s['sensor_id'],
+                                s['locator'])
+                    factory.move_sensor(sensor, s['locator'])
+            self._listed_sensors = {s['sensor_id'] for s in sensors}
+
+        if zone_info is not None:
+            self._reload_zones(zones_from_json(zone_info))
+
+        # Sensors are removed once no longer listed or used by a zone,
+        # whichever changes last:
+        if self._listed_sensors is not None:
+            in_use = {c.zone.sensor_id for c in self.zone_controllers}
+            for sensor_id in (set(factory.sensors) - self._listed_sensors -
+                              in_use):
+                logger.info("Removing sensor %d", sensor_id)
+                factory.remove_sensor(sensor_id)
+
+        self.sensors = list(factory.sensors.values())
+        self.relays = list(factory.relays.values())
+        self._etags.update(etags)
+
+    def _reload_zones(self, zone_info):
+        factory = self.factory
+        new_zones = {zone.zone_id: zone for zone in zone_info}
+        controllers = []
+        for controller in self.zone_controllers:
+            old = controller.zone
+            zone = new_zones.pop(old.zone_id, None)
+            if zone is None or zone.sensor_id not in factory.sensors:
+                logger.info("Removing zone %d", old.zone_id)
+                factory.remove_zone(controller)
+                if zone is not None:
+                    logger.error("Zone %d has unknown sensor %d",
+                                 zone.zone_id, zone.sensor_id)
+                continue
+            if (zone.boiler_relay, zone.pid_kp, zone.pid_ki, zone.pid_kd,
+                    zone.pwm_period) != (old.boiler_relay, old.pid_kp,
+                                         old.pid_ki, old.pid_kd,
+                                         old.pwm_period):
+                logger.info("Rebuilding zone %d", zone.zone_id)
+                # (Adding first, so a relay still in use isn't turned off.)
+                rebuilt = factory.add_zone(zone)
+                factory.remove_zone(controller)
+                controller = rebuilt
+            elif zone.sensor_id != old.sensor_id:
+                logger.info("Moving zone %d to sensor %d", zone.zone_id,
+                            zone.sensor_id)
+                controller.set_sensor(factory.sensors[zone.sensor_id])
+            controller.zone = zone
+            controllers.append(controller)
+
+        for zone in new_zones.values():
+            if zone.sensor_id not in factory.sensors:
+                logger.error("Zone %d has unknown sensor %d", zone.zone_id,
+                             zone.sensor_id)
+                continue
+            logger.info("Adding zone %d", zone.zone_id)
+            controllers.append(factory.add_zone(zone))
+        self.zone_controllers = controllers
 
     def iteration(self, now):
+        """Update the schedule and zones.
+
+        now: the current wall-clock datetime, used for schedule lookup."""
+        for sensor in self.sensors:
+            sensor.process_readings()
+        monotonic_now = self._clock.monotonic()
+        if self.health is not None:
+            self.health.check(monotonic_now)
+
+        # Pick up changes to the zones and sensors:
+        if self.factory is not None and (
+                self._reload_requested or
+                self.last_reload + self.RELOAD_INTERVAL < monotonic_now):
+            self._reload_requested = False
+            self.last_reload = monotonic_now
+            try:
+                self.reload()
+            except requests.exceptions.RequestException as e:
+                logger.error("Couldn't reload zones (%s)", str(e))
+            except Exception:
+                # E.g. a malformed response; keep the zones we have:
+                logger.exception("Couldn't reload zones")
+
         # Update schedule:
-        if self.last_scheduler_update:
-            next_scheduler_update = self.last_scheduler_update + self.SCHEDULER_UPDATE_INTERVAL
-        if self.scheduler is None or next_scheduler_update < now:
+        if (self.scheduler is None or
+                self.last_scheduler_update + self.SCHEDULER_UPDATE_INTERVAL
+                < monotonic_now):
             try:
                 r = requests.get(self.scheduler_url + "/schedule",
                                  auth=self.auth, timeout=10)
@@ -259,17 +568,29 @@ class AllZoneController(object):
                     logger.error("Couldn't get schedule (%d)",
                                  r.status_code)
                 else:
-                    self.last_scheduler_update = now
+                    self.last_scheduler_update = monotonic_now
                     self.scheduler = SchedulerTemperaturePolicy.from_json(r.text)
 
         # Update thermostats:
         if self.scheduler:
             for controller in self.zone_controllers:
                 controller.iteration(self.scheduler, now)
+            for relay in self.relays:
+                relay.update(monotonic_now)
+
+def report_relay_metrics(client, relays, metrics_topic, now):
+    """Log, and publish if metrics_topic is set, the state and cycle counts
+    of each relay (a dict of thermostat ID -> demand.RelayDemand)."""
+    metrics = {relay_id: relay.metrics(now)
+               for relay_id, relay in relays.items()}
+    logger.info("Relays: %s", metrics)
+    if metrics_topic:
+        client.publish(metrics_topic, json.dumps(metrics))
 
 def main():
     logger.info("Starting boilerio scheduler %s", software_version())
     conf = config.load_config()
+    codec.from_config(conf)
 
     # If the 'heating' section of the config has a 'scheduler_username' and
     # 'scheduler_password' entry, we use these with HTTP basic auth.
@@ -287,8 +608,16 @@ def main():
     else:
         scheduler_url = conf.get('heating', 'scheduler_url')
 
-    sensors = construct_sensors(scheduler_url, auth)
+    clock = SYSTEM_CLOCK
+    health = sensorhealth.SensorHealthRegistry(clock=clock)
+    sensors = construct_sensors(scheduler_url, auth, conf, health)
     zone_info = load_zone_info(scheduler_url, auth)
+    weather_obj, weather_sensors = weather.from_config(conf, clock)
+
+    # All sensor messages are routed by one dispatcher:
+    dispatcher = dispatch.MqttDispatcher()
+    for sensor in weather_sensors:
+        sensor.register(dispatcher)
 
     mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, userdata={
         'conf': conf,
@@ -296,39 +625,46 @@ def main():
             conf.get('heating', 'thermostat_schedule_change_topic'),
         'scheduler_url': scheduler_url,
         'auth': auth,
-        'sensors': sensors,
+        'dispatcher': dispatcher,
         })
     mqttc.username_pw_set(conf.get('mqtt', 'user'),
                           conf.get('mqtt', 'password'))
     mqttc.on_connect = mqtt_on_connect
+    mqttc.on_message = dispatcher.on_message
     mqttc.connect(conf.get('mqtt', 'host'), 1883, 60)
 
-    sensor_updater = update_sensor.TempSensorUpdater(scheduler_url, auth)
+    sensor_updater = update_sensor.TempSensorUpdater(scheduler_url, auth,
+                                                     clock)
+    sensor_updater.add_health(health)
 
-    zone_controllers = []
-    weather_obj = weather.CachingWeather(conf.get('weather', 'apikey'),
-            conf.get('weather', 'location'), cache_time=timedelta(minutes=20))
+    forecast = weather.forecast_from_config(conf, clock)
 
+    factory = ZoneFactory(scheduler_url, auth, conf, mqttc, dispatcher,
+                          sensor_updater, health, weather_obj, forecast,
+                          clock)
     for sensor in sensors.values():
-        sensor.register_mqtt_callbacks(mqttc)
-        sensor_updater.add_sensor(sensor)
-
-    for zone in zone_info:
-        zone_boiler = MqttBoiler(zone.boiler_relay, mqttc,
-                                 conf.get('heating', 'demand_request_topic'))
-        zone_sensor = sensors[zone.sensor_id]
-        zone_thermostat = thermostat.Thermostat(zone_boiler, zone_sensor)
-        zone_controller = zones.ZoneController(
-            zone, zone_boiler, zone_sensor, zone_thermostat, scheduler_url,
-            auth, weather_obj)
-        zone_controllers.append(zone_controller)
+        factory.add_sensor(sensor)
+    zone_controllers = [factory.add_zone(zone) for zone in zone_info]
 
+    sensor_updater.start()
     mqttc.loop_start()
 
     # Update thermostats every second and schedule every 60s:
-    controller = AllZoneController(scheduler_url, auth, zone_controllers)
+    controller = AllZoneController(scheduler_url, auth, zone_controllers,
+                                   clock, factory.sensors.values(), health,
+                                   factory.relays.values(), factory)
+    # Reload the zones and sensors on SIGHUP:
+    signal.signal(signal.SIGHUP, lambda signum, frame:
+                  controller.request_reload())
+    metrics_topic = conf.get('heating', 'boiler_metrics_topic', fallback=None)
+    last_metrics = clock.monotonic()
     while True:
-        controller.iteration(datetime.datetime.now())
+        controller.iteration(clock.now())
+        monotonic_now = clock.monotonic()
+        if monotonic_now - last_metrics >= METRICS_INTERVAL:
+            report_relay_metrics(mqttc, factory.relays, metrics_topic,
+                                 monotonic_now)
+            last_metrics = monotonic_now
         time.sleep(1)
 
     mqttc.loop_stop()
@@ -74,24 +74,45 @@ class FullSchedule(object):
 
 
 class Zone(object):
-    """A heating zone, with relay and temperature sensor."""
-    def __init__(self, zone_id, name, boiler_relay, sensor_id):
+    """A heating zone, with relay and temperature sensor.
+
+    The controller parameters (PID gains and PWM period in seconds) are
+    optional: None means the thermostat's defaults are used.
+    """
+    def __init__(self, zone_id, name, boiler_relay, sensor_id,
+                 pid_kp=None, pid_ki=None, pid_kd=None, pwm_period=None):
         self.zone_id = zone_id
         self.name = name
         self.boiler_relay = boiler_relay
         self.sensor_id = sensor_id
+        self.pid_kp = pid_kp
+        self.pid_ki = pid_ki
+        self.pid_kd = pid_kd
+        self.pwm_period = pwm_period
 
     @classmethod
     def all_from_db(cls, connection):
         cursor = connection.cursor()
-        cursor.execute("select zone_id, name, boiler_relay, sensor_id "
+        cursor.execute("select zone_id, name, boiler_relay, sensor_id, "
+                       "pid_kp, pid_ki, pid_kd, pwm_period "
                        "from zones")
         zones = []
         for record in cursor:
-            zone = Zone(record[0], record[1], record[2], record[3])
+            zone = Zone(*record)
             zones.append(zone)
         return zones
 
+    @staticmethod
+    def save_controller_params(connection, zone_id, pid_kp, pid_ki, pid_kd,
+                               pwm_period):
+        """Set the controller parameters for a zone."""
+        cursor = connection.cursor()
+        cursor.execute("update zones set pid_kp=%s, pid_ki=%s, pid_kd=%s, "
+                       "pwm_period=%s where zone_id=%s",
+                       (pid_kp, pid_ki, pid_kd, pwm_period, zone_id))
+        if cursor.rowcount != 1:
+            raise ValueError("No zone found (%s)" % zone_id)
+
 
 class TargetOverride(object):
     """ Override the set temperature for a period of time. """
@@ -188,13 +209,13 @@ class DeviceState(object):
         return cls(data[0], zone_id, *data[1:])
 
 
-SENSOR_METRIC_TYPES = ['temperature', 'humidity']
+SENSOR_METRIC_TYPES = ['temperature', 'humidity', 'battery_voltage']
 
 
 class SensorReading(object):
     """Represents a single sensor reading.
 
-    metric_type is one of 'temperature', 'humidity'.
+    metric_type is one of 'temperature', 'humidity', 'battery_voltage'.
     """
     def __init__(self, sensor_id, when, metric_type, value):
         self.sensor_id = sensor_id
@@ -252,43 +273,241 @@ class Sensor(object):
         return readings
 
 
+class SensorHealth(object):
+    """A sensor's health, as last reported by the scheduler."""
+
+    _COLUMNS = ['sensor_id', 'updated', 'last_seen', 'stale', 'messages',
+                'message_rate', 'jitter', 'battery_voltage']
+
+    def __init__(self, sensor_id, updated, last_seen, stale, messages,
+                 message_rate, jitter, battery_voltage):
+        self.sensor_id = sensor_id
+        self.updated = updated
+        self.last_seen = last_seen
+        self.stale = stale
+        self.messages = messages
+        self.message_rate = message_rate
+        self.jitter = jitter
+        self.battery_voltage = battery_voltage
+
+    def save(self, connection):
+        cursor = connection.cursor()
+        cursor.execute(
+            "insert into sensor_health (%s) values (%s) "
+            "on conflict (sensor_id) do update set %s" % (
+                ', '.join(self._COLUMNS),
+                ', '.join(['%s'] * len(self._COLUMNS)),
+                ', '.join('%s=excluded.%s' % (c, c)
+                          for c in self._COLUMNS[1:])),
+            tuple(getattr(self, c) for c in self._COLUMNS))
+
+    @classmethod
+    def all_from_db(cls, connection):
+        cursor = connection.cursor()
+        cursor.execute("select %s from sensor_health order by sensor_id" %
+                       ', '.join(cls._COLUMNS))
+        return [cls(*row) for row in cursor.fetchall()]
+
+    @classmethod
+    def from_db(cls, connection, sensor_id):
+        cursor = connection.cursor()
+        cursor.execute("select %s from sensor_health where sensor_id=%%s" %
+                       ', '.join(cls._COLUMNS), (sensor_id,))
+        row = cursor.fetchone()
+        if not row:
+            raise ValueError("No health reported for sensor %s" % sensor_id)
+        return cls(*row)
+
+
 class TemperatureGradientMeasurement(object):
-    """A record of a measured heating gradient."""
-    def __init__(self, zone_id, when, delta, gradient):
+    """A record of a measured heating gradient.
+
+    Measurements are also aggregated per zone and delta bucket (the delta
+    rounded to the nearest 0.5) in the gradient_bucket table as they are
+    saved, so that reading the gradient table doesn't need to scan every
+    measurement.  Alongside the plain sums the buckets keep sums weighted
+    by age, halving every GRADIENT_HALF_LIFE, to favour recent behaviour.
+
+    Each measurement is also weighted by its precision: one with a standard
+    error of GRADIENT_STDERR_SCALE, or without a known standard error,
+    counts once, more precise ones for more.  The standard error is shrunk
+    towards GRADIENT_STDERR_SCALE by GRADIENT_PRIOR_DOF degrees of freedom,
+    since one fitted to few readings is itself unreliable; this also caps
+    a measurement's weight at about npoints / GRADIENT_PRIOR_DOF.
+    """
+
+    GRADIENT_HALF_LIFE = datetime.timedelta(days=90)
+    GRADIENT_STDERR_SCALE = 0.25
+    GRADIENT_PRIOR_DOF = 5
+
+    # Weight of a measurement given its stderr and npoints, as described
+    # above.  A null stderr makes the expression null, hence the coalesce.
+    _WEIGHT_SQL = (
+        "coalesce(%(scale_sq)s * (greatest({npoints} - 2, 0) + "
+        "%(prior_dof)s) / (greatest({npoints} - 2, 0) * {stderr} * "
+        "{stderr} + %(prior_dof)s * %(scale_sq)s), 1.0)")
+
+    # Adds a measurement to its bucket.  Measurements may arrive out of
+    # order (e.g. from a backfill), so the decayed sums are kept relative to
+    # the newest measurement seen: either the existing sums or the new
+    # measurement is decayed to that time before they are added.
+    _UPDATE_BUCKET_SQL = (
+        "insert into gradient_bucket "
+        "(zone, delta, npoints, weight_sum, gradient_sum, gradient_sum_sq, "
+        "decayed_weight, decayed_sum, decayed_sum_sq, decayed_at) "
+        "select %(zone)s, round(2 * cast(%(delta)s as numeric), 0) / 2, 1, "
+        "w, w * %(gradient)s, w * %(gradient)s * %(gradient)s, w, "
+        "w * %(gradient)s, w * %(gradient)s * %(gradient)s, "
+        "coalesce(%(when)s, localtimestamp) "
+        "from (select {weight} as w) as m "
+        "on conflict (zone, delta) do update set "
+        "npoints = gradient_bucket.npoints + 1, "
+        "weight_sum = gradient_bucket.weight_sum + excluded.weight_sum, "
+        "gradient_sum = gradient_bucket.gradient_sum + excluded.gradient_sum, "
+        "gradient_sum_sq = gradient_bucket.gradient_sum_sq + "
+        "excluded.gradient_sum_sq, "
+        "decayed_weight = gradient_bucket.decayed_weight * {old} + "
+        "excluded.decayed_weight * {new}, "
+        "decayed_sum = gradient_bucket.decayed_sum * {old} + "
+        "excluded.decayed_sum * {new}, "
+        "decayed_sum_sq = gradient_bucket.decayed_sum_sq * {old} + "
+        "excluded.decayed_sum_sq * {new}, "
+        "decayed_at = greatest(gradient_bucket.decayed_at, "
+        "excluded.decayed_at)"
+        ).format(
+            weight=_WEIGHT_SQL.format(
+                stderr="cast(%(stderr)s as double precision)",
+                npoints="cast(%(npoints)s as integer)"),
+            old="power(0.5, greatest(0, extract(epoch from "
+                "excluded.decayed_at - gradient_bucket.decayed_at)) "
+                "/ %(half_life)s)",
+            new="power(0.5, greatest(0, extract(epoch from "
+                "gradient_bucket.decayed_at - excluded.decayed_at)) "
+                "/ %(half_life)s)")
+
+    def __init__(self, zone_id, when, delta, gradient, stderr=None,
+                 npoints=None):
         self.zone_id = zone_id
         self.when = when
         self.delta = delta
         self.gradient = gradient
+        self.stderr = stderr
+        self.npoints = npoints
+
+    @classmethod
+    def _weight_params(cls):
+        return {'scale_sq': cls.GRADIENT_STDERR_SCALE ** 2,
+                'prior_dof': cls.GRADIENT_PRIOR_DOF,
+                'half_life': cls.GRADIENT_HALF_LIFE.total_seconds()}
 
     def save(self, connection):
-        """Write gradient to database."""
+        """Write gradient to database and add it to the gradient table."""
         cursor = connection.cursor()
         cursor.execute(
             'insert into gradient_measurement '
-            '(zone, "when", delta, gradient) values '
-            '(%s, %s, %s, %s)',
-            (self.zone_id, self.when, self.delta, self.gradient)
+            '(zone, "when", delta, gradient, stderr, npoints) values '
+            '(%s, %s, %s, %s, %s, %s)',
+            (self.zone_id, self.when, self.delta, self.gradient,
+             self.stderr, self.npoints)
             )
+        params = self._weight_params()
+        params.update({
+            'zone': self.zone_id,
+            'delta': self.delta,
+            'gradient': self.gradient,
+            'stderr': self.stderr,
+            'npoints': self.npoints,
+            'when': self.when,
+            })
+        cursor.execute(self._UPDATE_BUCKET_SQL, params)
 
-    @staticmethod
-    def get_gradient_table(connection, zone_id):
-        """Return a list o list of temperature gradient averages.
+    @classmethod
+    def rebuild_gradient_table(cls, connection, zone_id):
+        """Recompute a zone's gradient buckets from its measurements.
+
+        Only needed to seed the buckets for measurements saved before they
+        existed."""
+        cursor = connection.cursor()
+        cursor.execute("delete from gradient_bucket where zone=%s",
+                       (zone_id,))
+        params = cls._weight_params()
+        params['zone'] = zone_id
+        cursor.execute(
+            "with m as ("
+            "  select zone, gradient, coalesce(\"when\", localtimestamp) as t, "
+            "  round(2 * cast(delta as numeric), 0) / 2 as d, "
+            "  " + cls._WEIGHT_SQL.format(stderr="stderr",
+                                          npoints="npoints") + " as w "
+            "  from gradient_measurement where zone=%(zone)s), "
+            "latest as (select d, max(t) as t from m group by d), "
+            "weighted as ("
+            "  select m.zone, m.d, m.gradient, m.w, latest.t as latest, "
+            "  m.w * power(0.5, extract(epoch from latest.t - m.t) "
+            "    / %(half_life)s) as dw "
+            "  from m join latest on m.d = latest.d) "
+            "insert into gradient_bucket "
+            "(zone, delta, npoints, weight_sum, gradient_sum, "
+            "gradient_sum_sq, decayed_weight, decayed_sum, decayed_sum_sq, "
+            "decayed_at) "
+            "select zone, d, count(*), sum(w), sum(w * gradient), "
+            "sum(w * gradient * gradient), sum(dw), sum(dw * gradient), "
+            "sum(dw * gradient * gradient), latest "
+            "from weighted group by zone, d, latest",
+            params)
+
+    @classmethod
+    def get_gradient_table(cls, connection, zone_id, decayed=False,
+                           now=None):
+        """Return a list of temperature gradient averages.
 
         Returns a list of the form:
-            [ (delta rounded to nearest 0.5, average gradient) ]
+            [ {'delta': delta rounded to nearest 0.5,
+               'gradient': average gradient,
+               'variance': variance of the gradient (None if unknown),
+               'npoints': number of measurements,
+               'weight': weight of the bucket} ]
+
+        The average and variance weight each measurement by its precision
+        and, if decayed is set, also by its age.  'weight' is the total
+        weight of the bucket's measurements, decayed to now if decayed is
+        set.
         """
+        if now is None:
+            now = datetime.datetime.now()
+        half_life = cls.GRADIENT_HALF_LIFE.total_seconds()
+
         cursor = connection.cursor()
         cursor.execute(
-            "select round(2 * cast(delta as numeric), 0) / 2 as d, "
-            "avg(gradient), count(gradient) "
-            "from gradient_measurement where zone=%s"
-            "group by d order by d", (zone_id,)
+            "select delta, npoints, weight_sum, gradient_sum, "
+            "gradient_sum_sq, decayed_weight, decayed_sum, decayed_sum_sq, "
+            "decayed_at from gradient_bucket where zone=%s order by delta",
+            (zone_id,)
             )
-        return [{
-            'delta': record[0],
-            'gradient': record[1],
-            'npoints': record[2]
-            } for record in cursor]
+        table = []
+        for (delta, npoints, weight_sum, total, total_sq, decayed_weight,
+             decayed_sum, decayed_sum_sq, decayed_at) in cursor:
+            if decayed:
+                mean = decayed_sum / decayed_weight
+                variance = max(0.0, decayed_sum_sq / decayed_weight -
+                               mean * mean)
+                age = (now - decayed_at).total_seconds()
+                weight = decayed_weight * 0.5 ** (max(0, age) / half_life)
+            else:
+                mean = total / weight_sum
+                # Weighted variance, with Bessel's correction by the number
+                # of measurements:
+                variance = (max(0.0, (total_sq - total * mean) / weight_sum *
+                                npoints / (npoints - 1))
+                            if npoints > 1 else None)
+                weight = weight_sum
+            table.append({
+                'delta': float(delta),
+                'gradient': mean,
+                'variance': variance,
+                'npoints': npoints,
+                'weight': weight,
+                })
+        return table
 
 
 class EndpointIdentity(object):
@@ -1,8 +1,8 @@
 import datetime
-from flask_restx import Namespace, Resource, fields
+from flask_restx import Namespace, Resource, fields, marshal
 
 from . import model
-from .util import get_db, csrf_protection
+from .util import conditional_json, get_db, csrf_protection
 
 api = Namespace('Sensors', title="Sensor readings and management")
 
@@ -19,10 +19,12 @@ a_sensor = api.model("Sensor", {
 @api.route('/')
 class Sensors(Resource):
     """Set of known sensors."""
-    @api.marshal_list_with(a_sensor)
+    @api.response(200, "OK", [a_sensor])
+    @api.response(304, "Not modified since the ETag in If-None-Match")
     def get(self):
         db = get_db()
-        return model.Sensor.all_from_db(db)
+        return conditional_json(marshal(model.Sensor.all_from_db(db),
+                                        a_sensor))
 
 
 a_sensor_reading = api.model("Sensor reading", {
@@ -56,4 +58,60 @@ class SensorReadings(Resource):
             )
         db = get_db()
         reading.save(db)
+        db.commit()
+
+
+a_sensor_health = api.model("Sensor health", {
+    'sensor_id': fields.Integer(description="Sensor ID"),
+    'updated': fields.DateTime(description="When the health was reported",
+                               readonly=True),
+    'last_seen': fields.DateTime(description="When the sensor's last "
+                                 "reading was received"),
+    'stale': fields.Boolean(description="Whether the sensor has stopped "
+                            "sending readings"),
+    'messages': fields.Integer(description="Readings received since the "
+                               "scheduler started"),
+    'message_rate': fields.Float(description="Readings per hour"),
+    'jitter': fields.Float(description="Standard deviation of the interval "
+                           "between readings, in seconds"),
+    'battery_voltage': fields.Float(description="Last battery voltage"),
+})
+
+
+@api.route('/health')
+class SensorsHealth(Resource):
+    """Health of all sensors."""
+    @api.marshal_list_with(a_sensor_health)
+    def get(self):
+        db = get_db()
+        return model.SensorHealth.all_from_db(db)
+
+
+@api.route('/<int:sensor_id>/health')
+class SensorHealth(Resource):
+    @api.marshal_with(a_sensor_health)
+    def get(self, sensor_id):
+        db = get_db()
+        try:
+            return model.SensorHealth.from_db(db, sensor_id)
+        except ValueError:
+            return '', 404
+
+    @api.expect(a_sensor_health)
+    @csrf_protection
+    def post(self, sensor_id):
+        last_seen = api.payload.get('last_seen')
+        health = model.SensorHealth(
+            int(sensor_id),
+            datetime.datetime.now(),
+            (datetime.datetime.strptime(last_seen, '%Y-%m-%dT%H:%M:%S.%fZ')
+             if last_seen else None),
+            bool(api.payload['stale']),
+            api.payload.get('messages'),
+            api.payload.get('message_rate'),
+            api.payload.get('jitter'),
+            api.payload.get('battery_voltage'),
+            )
+        db = get_db()
+        health.save(db)
         db.commit()
\ No newline at end of file
@@ -194,3 +194,42 @@ def test_incomplete_id_token_fails_login(client):
         # Log in with a "valid" token:
         rv = client.post('/me', data={'id_token': FAKE_ID_TOKEN})
         assert rv.status_code == HTTPStatus.FORBIDDEN
+
+
+@patch('boilerio.schedulerweb.zones.model.Zone.all_from_db')
+@patch('boilerio.schedulerweb.zones.get_db')
+def test_zones_served_with_etag(get_db, all_from_db, noauth_client):
+    from .. import model
+    all_from_db.return_value = [model.Zone(1, 'Zone', '0xbab1', 2)]
+
+    rv = noauth_client.get('/zones/')
+    assert rv.status_code == HTTPStatus.OK
+    assert rv.json[0]['boiler_relay'] == '0xbab1'
+    etag = rv.headers['ETag']
+
+    rv = noauth_client.get('/zones/', headers={'If-None-Match': etag})
+    assert rv.status_code == HTTPStatus.NOT_MODIFIED
+    assert rv.data == b''
+
+    all_from_db.return_value = [model.Zone(1, 'Zone', '0xbab2', 2)]
+    rv = noauth_client.get('/zones/', headers={'If-None-Match': etag})
+    assert rv.status_code == HTTPStatus.OK
+
+
+@patch('boilerio.schedulerweb.zones.model.TemperatureGradientMeasurement')
+@patch('boilerio.schedulerweb.zones.get_db')
+def test_gradient_measurement_batch_returns_count(get_db, measurement_cls,
+                                                  noauth_client):
+    measurement = {'zone_id': 1, 'when': '2020-01-01T00:00:00',
+                   'delta': 10.0, 'gradient': 1.5, 'stderr': 0.1,
+                   'npoints': 20}
+    save = measurement_cls.return_value.save
+    rv = noauth_client.post('/zones/gradient_measurements',
+                            json=[measurement, measurement],
+                            headers={'X-Requested-With': 'test'})
+    assert rv.status_code == HTTPStatus.CREATED
+    assert rv.json == {'stored': 2}
+    assert save.call_count == 2
+    measurement_cls.assert_called_with(1, '2020-01-01T00:00:00', 10.0, 1.5,
+                                       0.1, 20)
+    get_db.return_value.commit.assert_called_once()
@@ -1,3 +1,5 @@
+import datetime
+from decimal import Decimal
 from unittest.mock import MagicMock
 
 import pytest
@@ -28,3 +30,88 @@ def test_sensor_from_db_missing_raises():
     conn = _stub_connection(None)
     with pytest.raises(ValueError):
         model.Sensor.from_db(conn, 99)
+
+
+def test_save_controller_params_for_missing_zone_raises():
+    cursor = MagicMock()
+    cursor.rowcount = 0
+    conn = MagicMock()
+    conn.cursor.return_value = cursor
+    with pytest.raises(ValueError):
+        model.Zone.save_controller_params(conn, 99, 2.0, 0.2, 1.0, 600)
+
+
+def test_gradient_save_updates_bucket():
+    conn = MagicMock()
+    cursor = conn.cursor.return_value
+    model.TemperatureGradientMeasurement(1, None, 10.2, 1.5, 0.1, 20).save(
+        conn)
+    assert cursor.execute.call_count == 2
+    _, row = cursor.execute.call_args_list[0][0]
+    assert row[-2:] == (0.1, 20)
+    _, params = cursor.execute.call_args[0]
+    assert params['zone'] == 1
+    assert params['gradient'] == 1.5
+    assert (params['stderr'], params['npoints']) == (0.1, 20)
+
+
+def test_get_gradient_table_from_buckets():
+    now = datetime.datetime(2020, 1, 1)
+    half_life = model.TemperatureGradientMeasurement.GRADIENT_HALF_LIFE
+    conn = MagicMock()
+    # Gradients 1, 2 and 3 in one bucket, a single gradient in another:
+    conn.cursor.return_value.__iter__.return_value = iter([
+        (Decimal('10.0'), 3, 3.0, 6.0, 14.0, 2.0, 5.0, 13.0,
+         now - half_life),
+        (Decimal('10.5'), 1, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, now),
+        ])
+    table = model.TemperatureGradientMeasurement.get_gradient_table(
+        conn, 1, now=now)
+    assert table[0] == {'delta': 10.0, 'gradient': 2.0, 'variance': 1.0,
+                        'npoints': 3, 'weight': 3}
+    assert table[1]['variance'] is None
+
+
+def test_get_gradient_table_decayed():
+    now = datetime.datetime(2020, 1, 1)
+    half_life = model.TemperatureGradientMeasurement.GRADIENT_HALF_LIFE
+    conn = MagicMock()
+    conn.cursor.return_value.__iter__.return_value = iter([
+        (Decimal('10.0'), 3, 3.0, 6.0, 14.0, 2.0, 5.0, 13.0,
+         now - half_life),
+        ])
+    table = model.TemperatureGradientMeasurement.get_gradient_table(
+        conn, 1, decayed=True, now=now)
+    assert table[0]['gradient'] == pytest.approx(2.5)
+    assert table[0]['variance'] == pytest.approx(0.25)
+    # The bucket's weight has aged a half-life since it was last updated:
+    assert table[0]['weight'] == pytest.approx(1.0)
+
+
+def test_sensor_health_save_upserts():
+    conn = MagicMock()
+    cursor = conn.cursor.return_value
+    model.SensorHealth(3, datetime.datetime(2020, 1, 1), None, True, 10,
+                       60.0, 2.5, 3.1).save(conn)
+    sql, params = cursor.execute.call_args[0]
+    assert 'on conflict (sensor_id)' in sql
+    assert params == (3, datetime.datetime(2020, 1, 1), None, True, 10,
+                      60.0, 2.5, 3.1)
+
+
+def test_sensor_health_missing_raises():
+    with pytest.raises(ValueError):
+        model.SensorHealth.from_db(_stub_connection(None), 3)
+
+
+def test_get_gradient_table_weights_by_precision():
+    conn = MagicMock()
+    # Gradient 1 with weight 3 and gradient 3 with weight 1:
+    conn.cursor.return_value.__iter__.return_value = iter([
+        (Decimal('10.0'), 2, 4.0, 6.0, 12.0, 4.0, 6.0, 12.0,
+         datetime.datetime(2020, 1, 1)),
+        ])
+    table = model.TemperatureGradientMeasurement.get_gradient_table(conn, 1)
+    assert table[0]['gradient'] == pytest.approx(1.5)
+    assert table[0]['variance'] == pytest.approx(1.5)
+    assert table[0]['weight'] == 4.0
@@ -1,6 +1,6 @@
 import functools
 
-from flask import g, current_app, request
+from flask import g, current_app, jsonify, make_response, request
 from http import HTTPStatus
 
 from . import model
@@ -35,3 +35,14 @@ def csrf_protection(fn):
         else:
             return "X-Requested-With header missing", HTTPStatus.FORBIDDEN
     return protected
+
+
+def conditional_json(data):
+    """A JSON response with an ETag.
+
+    If the request's If-None-Match header has the same ETag, the response is
+    304 Not Modified with no body, so clients polling for changes can
+    cheaply find out there aren't any."""
+    response = make_response(jsonify(data))
+    response.add_etag()
+    return response.make_conditional(request)
@@ -3,7 +3,7 @@ from flask_restx import Namespace, Resource, fields, marshal
 from flask import request
 
 from . import model
-from .util import get_db, csrf_protection
+from .util import conditional_json, get_db, csrf_protection
 
 
 api = Namespace('Zones', title="Zone management")
@@ -16,16 +16,57 @@ a_zone = api.model('Zone', {
         description="Identifier of boiler relay for this zone."),
     'sensor_id': fields.Integer(
         description="Identifier of sensor for this zone.."),
+    'pid_kp': fields.Float(
+        description="Proportional gain for the zone's PID controller, or "
+        "null for the default."),
+    'pid_ki': fields.Float(
+        description="Integral gain for the zone's PID controller, or null "
+        "for the default."),
+    'pid_kd': fields.Float(
+        description="Derivative gain for the zone's PID controller, or null "
+        "for the default."),
+    'pwm_period': fields.Integer(
+        description="Boiler PWM period in seconds, or null for the "
+        "default."),
     })
 
 
 @api.route("/")
 class ListZones(Resource):
-    @api.marshal_list_with(a_zone)
+    @api.response(200, "OK", [a_zone])
+    @api.response(304, "Not modified since the ETag in If-None-Match")
     def get(self):
         db = get_db()
         zones = model.Zone.all_from_db(db)
-        return zones
+        return conditional_json(marshal(zones, a_zone))
+
+
+a_controller_params = api.model("Zone controller parameters", {
+    'pid_kp': fields.Float(description="Proportional gain"),
+    'pid_ki': fields.Float(description="Integral gain"),
+    'pid_kd': fields.Float(description="Derivative gain"),
+    'pwm_period': fields.Integer(description="PWM period in seconds"),
+    })
+
+
+@api.route("/<int:zone_id>/controller_params")
+class ControllerParams(Resource):
+    """PID gains and PWM period used by the zone's thermostat.
+
+    Unset (null) parameters fall back to the thermostat defaults."""
+    @api.expect(a_controller_params)
+    @csrf_protection
+    def post(self, zone_id):
+        params = api.payload
+        db = get_db()
+        try:
+            model.Zone.save_controller_params(
+                db, zone_id, params.get('pid_kp'), params.get('pid_ki'),
+                params.get('pid_kd'), params.get('pwm_period'))
+        except ValueError:
+            return '', 404
+        db.commit()
+        return '', 200
 
 
 an_override = api.model("Temperature target override", {
@@ -114,6 +155,17 @@ a_gradient_measurement = api.model('Temperature gradient', {
     'gradient': fields.Float(
         description="The temperature gradient in degrees C per "
         "hour."),
+    'stderr': fields.Float(
+        description="Standard error of the gradient, if known.  "
+        "Measurements with a smaller error count for more in the gradient "
+        "table."),
+    'npoints': fields.Integer(
+        description="Number of readings the gradient was fitted to, if "
+        "known."),
+    })
+a_zone_gradient_measurement = api.inherit(
+    'Zone temperature gradient measurement', a_gradient_measurement, {
+    'zone_id': fields.Integer(description="Zone the measurement is for."),
     })
 a_gradient_average = api.model('Temperature gradient average', {
     'delta': fields.Float(
@@ -124,9 +176,36 @@ a_gradient_average = api.model('Temperature gradient average', {
     'npoints': fields.Integer(
         description="Number of data points contributing to the average "
         "value given."),
+    'variance': fields.Float(
+        description="Variance of the gradient measurements, or null if "
+        "there are too few."),
+    'weight': fields.Float(
+        description="Weight of the bucket: the total weight of its "
+        "measurements (more for those with a smaller standard error), "
+        "decayed by age if decay was requested."),
     })
 
 
+@api.route('/gradient_measurements')
+class Gradients(Resource):
+    @api.expect([a_zone_gradient_measurement])
+    @api.response(201, "Measurements stored")
+    @csrf_protection
+    def post(self):
+        """Record a batch of gradient measurements, possibly for several
+        zones, in one transaction.
+
+        Returns the number of measurements stored."""
+        db = get_db()
+        for m in api.payload:
+            tgm = model.TemperatureGradientMeasurement(
+                    m['zone_id'], m['when'], m['delta'], m['gradient'],
+                    m.get('stderr'), m.get('npoints'))
+            tgm.save(db)
+        db.commit()
+        return {'stored': len(api.payload)}, 201
+
+
 @api.route('/<int:zone_id>/gradient_measurements')
 class Gradient(Resource):
     @api.expect(a_gradient_measurement)
@@ -134,7 +213,8 @@ class Gradient(Resource):
     def post(self, zone_id):
         tgm = model.TemperatureGradientMeasurement(
                 zone_id, api.payload['when'], api.payload['delta'],
-                api.payload['gradient'])
+                api.payload['gradient'], api.payload.get('stderr'),
+                api.payload.get('npoints'))
         db = get_db()
         tgm.save(db)
         db.commit()
@@ -142,12 +222,16 @@ class Gradient(Resource):
 
 @api.route('/<int:zone_id>/gradients')
 class GradientTable(Resource):
+    @api.doc(params={
+        "decay": {'description': "Weight measurements by age, favouring "
+                  "recent ones.", 'type': bool, 'in': 'query'},
+    })
     @api.marshal_list_with(a_gradient_average)
     def get(self, zone_id):
+        decayed = request.args.get('decay', '').lower() in ('1', 'true')
         db = get_db()
-        r = model.TemperatureGradientMeasurement.get_gradient_table(
-                db, zone_id)
-        return r
+        return model.TemperatureGradientMeasurement.get_gradient_table(
+                db, zone_id, decayed)
 
 
 a_device_state = api.model('Device reported state', {
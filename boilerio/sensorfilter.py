@@ -0,0 +1,154 @@
+"""Filters deciding which sensor readings are passed on.
+
+An EmonTHSensor runs each new reading through its filters in turn.  A
+filter is called as f(reading, last), where last is the last reading passed
+on (None at first), and returns the reading to pass on (possibly changed,
+for smoothing) or None to suppress it.  Passing a reading on makes it the
+sensor's current reading and fires the sensor's callbacks: the zone state
+reports and uploads to the scheduler web service.  Filtering sensor noise
+out here saves those requests without changing what the thermostat sees
+by more than the deadband.
+"""
+
+import dataclasses
+import math
+
+
+class Deadband(object):
+    """Pass a reading on once it differs enough from the last one.
+
+    temperature (degrees C) and humidity (% RH) are the changes that must be
+    exceeded.  If max_interval is set, a reading is passed on at least that
+    often (in seconds) even if it hasn't changed, so a steady value is still
+    recorded."""
+
+    def __init__(self, temperature=0.1, humidity=1.0, max_interval=None):
+        self.temperature = temperature
+        self.humidity = humidity
+        self.max_interval = max_interval
+
+    def _temperature_threshold(self, change):
+        return self.temperature
+
+    def _passed(self, change):
+        pass
+
+    def __call__(self, reading, last):
+        if last is None:
+            return reading
+        change = reading.temperature - last.temperature
+        if (abs(change) > self._temperature_threshold(change) or
+                abs(reading.relative_humidity - last.relative_humidity) >
+                self.humidity or
+                (self.max_interval is not None and
+                 reading.received - last.received >= self.max_interval)):
+            self._passed(change)
+            return reading
+        return None
+
+
+class Hysteresis(Deadband):
+    """A deadband that's wider for changes of direction.
+
+    A temperature change in the same direction as the last one passed on
+    needs to exceed 'temperature'; a reversal needs to exceed 'reverse'.
+    This stops a reading flickering between two values near a boundary
+    from being passed on every time, while a steady rise or fall is still
+    followed closely."""
+
+    def __init__(self, temperature=0.05, reverse=0.15, humidity=1.0,
+                 max_interval=None):
+        super().__init__(temperature, humidity, max_interval)
+        self.reverse = reverse
+        self._direction = 0
+
+    def _temperature_threshold(self, change):
+        if change * self._direction < 0:
+            return self.reverse
+        return self.temperature
+
+    def _passed(self, change):
+        if abs(change) > self._temperature_threshold(change):
+            self._direction = 1 if change > 0 else -1
+
+
+class RateLimit(object):
+    """Pass at most one reading on every min_interval seconds."""
+
+    def __init__(self, min_interval=60):
+        self.min_interval = min_interval
+
+    def __call__(self, reading, last):
+        if last is None or reading.received - last.received >= \
+                self.min_interval:
+            return reading
+        return None
+
+
+class Smoothing(object):
+    """Exponentially smooth the temperature and humidity.
+
+    time_constant is in seconds, so readings arriving at irregular
+    intervals are weighted by how long ago they were taken."""
+
+    def __init__(self, time_constant=120):
+        self.time_constant = time_constant
+        self._received = None
+        self._temperature = None
+        self._humidity = None
+
+    def __call__(self, reading, last):
+        if self._received is None:
+            self._temperature = reading.temperature
+            self._humidity = reading.relative_humidity
+        else:
+            elapsed = max(0, reading.received - self._received)
+            alpha = 1 - math.exp(-elapsed / self.time_constant)
+            self._temperature += alpha * (reading.temperature -
+                                          self._temperature)
+            self._humidity += alpha * (reading.relative_humidity -
+                                       self._humidity)
+        self._received = reading.received
+        return dataclasses.replace(reading, temperature=self._temperature,
+                                   relative_humidity=self._humidity)
+
+
+def from_config(conf, sensor_id):
+    """The filters for a sensor, from the config file.
+
+    Settings are read from the [sensor <id>] section, falling back to
+    [sensors]:
+        smoothing: time constant in seconds for Smoothing.
+        deadband, humidity_deadband: thresholds for Deadband.
+        hysteresis: the reversal threshold; uses Hysteresis instead of
+            Deadband.
+        max_interval: seconds after which an unchanged reading is passed on.
+        min_interval: seconds for RateLimit.
+    With none set, only unchanged readings are suppressed."""
+    sections = ['sensor %s' % sensor_id, 'sensors']
+
+    def get(option):
+        for section in sections:
+            if conf.has_option(section, option):
+                return conf.getfloat(section, option)
+        return None
+
+    filters = []
+    smoothing = get('smoothing')
+    if smoothing:
+        filters.append(Smoothing(smoothing))
+
+    deadband = get('deadband') or 0
+    humidity = get('humidity_deadband') or 0
+    hysteresis = get('hysteresis')
+    max_interval = get('max_interval')
+    if hysteresis is not None:
+        filters.append(Hysteresis(deadband, hysteresis, humidity,
+                                  max_interval))
+    else:
+        filters.append(Deadband(deadband, humidity, max_interval))
+
+    min_interval = get('min_interval')
+    if min_interval:
+        filters.append(RateLimit(min_interval))
+    return filters
@@ -0,0 +1,245 @@
+"""Liveness and health of a fleet of sensors.
+
+SensorHealthRegistry is told about every reading a sensor sends (seen())
+and keeps each sensor's deadline, when it becomes stale if nothing more
+arrives, in a binary heap indexed by sensor.  A reading moves its sensor's
+entry in O(log n), and check() only has to look at the earliest deadline,
+so it costs nothing per sensor when none have gone stale.  Callbacks are
+made only on transitions: when a sensor goes stale, and when a stale
+sensor is heard from again.
+"""
+
+import logging
+import math
+from dataclasses import dataclass
+
+from .clock import SYSTEM_CLOCK
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class _ExpiryHeap(object):
+    """A min-heap of deadlines, with at most one entry per key.
+
+    _index maps each key to its entry's position in _heap, so a key's
+    deadline can be changed or removed without searching."""
+
+    __slots__ = ('_heap', '_index')
+
+    def __init__(self):
+        self._heap = []
+        self._index = {}
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def set(self, key, deadline):
+        """Add key, or move it to a new deadline."""
+        i = self._index.get(key)
+        if i is None:
+            i = len(self._heap)
+            self._heap.append((deadline, key))
+            self._index[key] = i
+            self._sift_up(i)
+            return
+        old = self._heap[i][0]
+        self._heap[i] = (deadline, key)
+        if deadline < old:
+            self._sift_up(i)
+        else:
+            self._sift_down(i)
+
+    def peek(self):
+        """The (deadline, key) that expires first."""
+        return self._heap[0]
+
+    def pop(self):
+        """Remove and return the (deadline, key) that expires first."""
+        return self._remove_at(0)
+
+    def discard(self, key):
+        i = self._index.get(key)
+        if i is not None:
+            self._remove_at(i)
+
+    def _remove_at(self, i):
+        heap = self._heap
+        entry = heap[i]
+        del self._index[entry[1]]
+        last = heap.pop()
+        if i < len(heap):
+            heap[i] = last
+            self._index[last[1]] = i
+            self._sift_down(i)
+            self._sift_up(i)
+        return entry
+
+    def _sift_up(self, i):
+        heap, index = self._heap, self._index
+        entry = heap[i]
+        while i > 0:
+            parent = (i - 1) // 2
+            if heap[parent][0] <= entry[0]:
+                break
+            heap[i] = heap[parent]
+            index[heap[i][1]] = i
+            i = parent
+        heap[i] = entry
+        index[entry[1]] = i
+
+    def _sift_down(self, i):
+        heap, index = self._heap, self._index
+        n = len(heap)
+        entry = heap[i]
+        while True:
+            child = 2 * i + 1
+            if child >= n:
+                break
+            if child + 1 < n and heap[child + 1][0] < heap[child][0]:
+                child += 1
+            if entry[0] <= heap[child][0]:
+                break
+            heap[i] = heap[child]
+            index[heap[i][1]] = i
+            i = child
+        heap[i] = entry
+        index[entry[1]] = i
+
+
+@dataclass
+class SensorHealth(object):
+    sensor_id: int
+    # Wall-clock and monotonic times of the last reading:
+    last_seen: object = None
+    last_received: float = None
+    messages: int = 0
+    # Smoothed interval between readings, and its standard deviation (the
+    # jitter), in seconds:
+    mean_interval: float = None
+    jitter: float = None
+    battery_voltage: float = None
+    stale: bool = False
+
+    @property
+    def message_rate(self):
+        """Readings per hour."""
+        if not self.mean_interval:
+            return None
+        return 3600 / self.mean_interval
+
+    def as_dict(self):
+        return {
+            'sensor_id': self.sensor_id,
+            'last_seen': (self.last_seen.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+                          if self.last_seen is not None else None),
+            'messages': self.messages,
+            'message_rate': self.message_rate,
+            'jitter': self.jitter,
+            'battery_voltage': self.battery_voltage,
+            'stale': self.stale,
+        }
+
+
+class SensorHealthRegistry(object):
+    """Tracks when each sensor was last heard from, and how it's doing.
+
+    A sensor is stale if nothing has been received from it for
+    stale_period seconds (by default, the period after which a Thermostat
+    stops using a reading).  Call check() regularly to find sensors that
+    have gone stale; callbacks are called as cb(health) with the sensor's
+    SensorHealth when its 'stale' flag changes.  It isn't thread-safe: use
+    it from the thread that processes sensor readings."""
+
+    STALE_PERIOD = 600
+    # Weight of each new interval in the smoothed interval statistics:
+    INTERVAL_SMOOTHING = 0.1
+
+    def __init__(self, stale_period=STALE_PERIOD, clock=SYSTEM_CLOCK):
+        self.stale_period = stale_period
+        self._clock = clock
+        self._sensors = {}
+        self._deadlines = _ExpiryHeap()
+        self._callbacks = []
+
+    def __iter__(self):
+        return iter(self._sensors.values())
+
+    def __getitem__(self, sensor_id):
+        return self._sensors[sensor_id]
+
+    def get(self, sensor_id):
+        """The SensorHealth for a sensor, or None if it isn't tracked."""
+        return self._sensors.get(sensor_id)
+
+    def add_callback(self, cb):
+        self._callbacks.append(cb)
+
+    def add(self, sensor_id):
+        """Start tracking a sensor, which goes stale if it isn't heard from."""
+        if sensor_id not in self._sensors:
+            self._sensors[sensor_id] = SensorHealth(sensor_id)
+            self._deadlines.set(sensor_id,
+                                self._clock.monotonic() + self.stale_period)
+        return self._sensors[sensor_id]
+
+    def remove(self, sensor_id):
+        """Stop tracking a sensor."""
+        self._sensors.pop(sensor_id, None)
+        self._deadlines.discard(sensor_id)
+
+    def seen(self, sensor_id, reading):
+        """Record a tempsensor.SensorReading received from a sensor."""
+        health = self._sensors.get(sensor_id)
+        if health is None:
+            health = self.add(sensor_id)
+        if health.last_received is not None:
+            self._update_interval(health,
+                                  reading.received - health.last_received)
+        health.last_seen = reading.when
+        health.last_received = reading.received
+        health.messages += 1
+        if reading.battery_voltage is not None:
+            health.battery_voltage = reading.battery_voltage
+        self._deadlines.set(sensor_id, reading.received + self.stale_period)
+        if health.stale:
+            health.stale = False
+            self._notify(health)
+
+    def _update_interval(self, health, interval):
+        if health.mean_interval is None:
+            health.mean_interval = interval
+            health.jitter = 0.0
+            return
+        alpha = self.INTERVAL_SMOOTHING
+        diff = interval - health.mean_interval
+        health.mean_interval += alpha * diff
+        health.jitter = math.sqrt(
+            (1 - alpha) * (health.jitter ** 2 + alpha * diff * diff))
+
+    def check(self, now=None):
+        """Mark sensors whose deadline has passed as stale.
+
+        now: the current monotonic time; defaults to the clock's."""
+        if now is None:
+            now = self._clock.monotonic()
+        deadlines = self._deadlines
+        while deadlines and deadlines.peek()[0] < now:
+            _, sensor_id = deadlines.pop()
+            health = self._sensors[sensor_id]
+            health.stale = True
+            self._notify(health)
+
+    def _notify(self, health):
+        logger.info("Sensor %s is %s", health.sensor_id,
+                    "stale" if health.stale else "back")
+        for cb in self._callbacks:
+            try:
+                cb(health)
+            except Exception as e:
+                logger.error("Callback %s raised exception %s", cb, e,
+                             exc_info=e)
@@ -1,69 +1,142 @@
-import json
+import collections
+import dataclasses
 import datetime
 import logging
 from dataclasses import dataclass
 
+from . import codec
+from . import sensorfilter
+from .clock import SYSTEM_CLOCK
+
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-@dataclass
+@dataclass(frozen=True)
 class SensorReading(object):
+    # 'when' is the wall-clock time of the reading, for reporting; 'received'
+    # is the monotonic time it arrived, used for staleness checks.
     when: datetime.datetime
     temperature: float
     relative_humidity: float
+    received: float
+    battery_voltage: float = None
 
     def __str__(self):
         return "<SensorReading: %f deg C %f RH at %s>" % (self.temperature, self.relative_humidity, self.when)
 
 
 class EmonTHSensor(object):
-    """A temperature sensor from OpenEnergyMonitor."""
+    """A temperature sensor from OpenEnergyMonitor.
+
+    MQTT messages arrive on the network thread, which only parses them and
+    queues the (immutable) readings.  The thread that uses the sensor, such
+    as the control loop, calls process_readings() to take them: only then
+    are 'reading' and the callbacks updated, so callbacks run on that
+    thread and never hold up the network thread.  Up to MAILBOX_SIZE
+    readings are kept between calls; beyond that the oldest are dropped.
+
+    Readings are only passed on if they get through the sensor's filters
+    (see sensorfilter.py); by default, readings that haven't changed are
+    suppressed.  A suppressed reading still refreshes the 'received' time
+    of the current reading, as it shows the sensor is alive.
+    """
+
+    MAILBOX_SIZE = 16
 
-    def __init__(self, sensor_id, locator):
+    def __init__(self, sensor_id, locator, clock=SYSTEM_CLOCK, filters=None,
+                 health=None):
         self.reading = None
+        # A sensorhealth.SensorHealthRegistry told about every reading:
+        self._health = health
+        if health is not None:
+            health.add(sensor_id)
+        # The last reading passed on, as the filters compare against it:
+        self._passed = None
+        if filters is None:
+            filters = [sensorfilter.Deadband(0, 0)]
+        self._filters = filters
+        self._clock = clock
         self.sensor_id = sensor_id
         self.locator = locator
         self._callbacks = []
+        # deque's append and popleft are atomic, so no lock is needed:
+        self._mailbox = collections.deque(maxlen=self.MAILBOX_SIZE)
 
     def register_mqtt_callbacks(self, mqttc):
         logger.debug("Registering callback for %d at %s" %
                      (self.sensor_id, self.locator))
         mqttc.message_callback_add(self.locator, self._temp_callback)
 
+    def register(self, dispatcher):
+        """Receive messages through a dispatch.MqttDispatcher."""
+        dispatcher.add(self.locator, self.handle_message)
+
+    def unregister(self, dispatcher):
+        dispatcher.remove(self.locator, self.handle_message)
+
     def add_callback(self, cb):
         self._callbacks.append(cb)
 
+    def remove_callback(self, cb):
+        self._callbacks.remove(cb)
+
     def _temp_callback(self, client, userdata, msg):
         """Handle MQTT message from emon."""
+        if self.locator != msg.topic:
+            return
         try:
-            if self.locator != msg.topic:
-                return
+            data = codec.decode(msg.topic, msg.payload)
+        except ValueError:
+            logger.error("Couldn't parse message for %s", str(self))
+            return
+        self.handle_message(msg.topic, data)
 
-            data = json.loads(msg.payload)
+    def handle_message(self, topic, data):
+        """Handle a decoded message from emon."""
+        try:
             if 'temperature' not in data:
                 return
 
             temp = float(data['temperature'])
             rh = float(data['humidity'])
-
-            # If the value didn't change, don't signal an update:
-            if self.reading and (
-                    temp == self.reading.temperature and
-                    rh == self.reading.relative_humidity):
-                return
-
-            now = datetime.datetime.now()
-            self.reading = SensorReading(now, temp, rh)
+            battery = data.get('battery')
+            if battery is not None:
+                battery = float(battery)
+            self._mailbox.append(SensorReading(
+                self._clock.now(), temp, rh, self._clock.monotonic(),
+                battery))
         except Exception:
             logger.critical("Exception escaped from MQTT handler for %s",
                             str(self), exc_info=True)
 
-        # Call callbacks, making sure any escaping exceptions don't cause
-        # subsequent callbacks to fail:
-        logger.debug("Temperature update: %s", str(self.reading))
-        for cb in self._callbacks:
-            try:
-                cb(self)
-            except Exception as e:
-                logger.error("Callback %s raised exception %s", cb, e, exc_info=e)
+    def process_readings(self):
+        """Take the readings received since the last call.
+
+        Updates 'reading' and calls the callbacks for each new value."""
+        mailbox = self._mailbox
+        while mailbox:
+            received = mailbox.popleft()
+            if self._health is not None:
+                self._health.seen(self.sensor_id, received)
+            reading = received
+            for f in self._filters:
+                reading = f(reading, self._passed)
+                if reading is None:
+                    break
+            if reading is None:
+                if self.reading is not None:
+                    self.reading = dataclasses.replace(
+                        self.reading, received=received.received)
+                continue
+            self._passed = self.reading = reading
+
+            # Call callbacks, making sure any escaping exceptions don't cause
+            # subsequent callbacks to fail:
+            logger.debug("Temperature update: %s", str(self.reading))
+            for cb in self._callbacks:
+                try:
+                    cb(self)
+                except Exception as e:
+                    logger.error("Callback %s raised exception %s", cb, e,
+                                 exc_info=e)
@@ -0,0 +1,52 @@
+import pytest
+
+from .. import autotune
+
+
+def test_fit_recovers_first_order_model():
+    # Gradient (C/hour) of a room 30C above outside at full heat with a 20
+    # hour time constant is (30 - delta) / 20:
+    table = [{'delta': d, 'gradient': (30 - d) / 20, 'npoints': 3}
+             for d in (5.0, 5.5, 10.0, 12.5)]
+    gain, time_constant = autotune.fit_gain_and_time_constant(table)
+    assert gain == pytest.approx(30)
+    assert time_constant == pytest.approx(20 * 3600)
+
+
+def test_fit_needs_more_than_one_bucket():
+    with pytest.raises(autotune.InsufficientData):
+        autotune.fit_gain_and_time_constant(
+            [{'delta': 5.0, 'gradient': 1.0, 'npoints': 10}])
+
+
+def test_dead_time_is_time_to_measurable_rise():
+    readings = [(t, 18.0) for t in range(0, 600, 60)]
+    readings += [(600 + t, 18.0 + t / 1000) for t in range(0, 1200, 60)]
+    events = [(0, False), (300, True), (3000, False)]
+    # Heating on at 300s; the first reading 0.1C warmer is at 720s:
+    assert autotune.estimate_dead_time(readings, events) == 420
+
+
+def test_slower_rooms_get_longer_pwm_periods():
+    fast = autotune.ProcessModel(30, 10 * 3600, 300)
+    slow = autotune.ProcessModel(30, 100 * 3600, 300)
+    assert (autotune.tune(slow).pwm_period >
+            autotune.tune(fast).pwm_period)
+    params = autotune.tune(fast, pwm_period=600)
+    assert params.pwm_period == 600
+    assert (autotune.tune(slow, max_ripple=0.1).pwm_period >
+            autotune.tune(slow).pwm_period)
+    assert params.pid_kp > 0 and params.pid_ki > 0 and params.pid_kd > 0
+
+
+def test_tuned_params_dont_cycle_more_than_defaults():
+    for time_constant in (10, 100):
+        process = autotune.ProcessModel(35, time_constant * 3600, 600)
+        default = autotune.simulate(process)
+        for max_ripple in (autotune.MAX_RIPPLE, 0.05):
+            params = autotune.tune(process, max_ripple=max_ripple)
+            tuned = autotune.simulate(process, params)
+            assert tuned.cycles_per_hour <= default.cycles_per_hour
+    # The heavy room cycles less with a longer period:
+    assert params.pwm_period > autotune.default_params().pwm_period
+    assert tuned.cycles_per_hour < default.cycles_per_hour
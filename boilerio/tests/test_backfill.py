@@ -0,0 +1,36 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from .. import backfill
+from ..monitor import Monitor
+
+
+def test_find_gradients_replays_heating_runs():
+    start = datetime(2020, 1, 1)
+
+    def at(seconds):
+        return start + timedelta(seconds=seconds)
+
+    # Heating on at 0s and off at 2400s, with the room warming at 3C/hour
+    # after a 10 minute warm-up:
+    history = [(at(0), 'On', None, 5.0)]
+    history += [(at(t), None, 18.0 + 3.0 * max(0, t - 600) / 3600, None)
+                for t in range(60, 2400, 60)]
+    history += [(at(2400), 'Off', None, 5.0),
+                (at(2460), None, 19.5, None)]
+
+    results = list(backfill.find_gradients(history, Monitor()))
+    assert len(results) == 1
+    when, gradient = results[0]
+    assert when == at(2400)
+    assert gradient.delta == pytest.approx(13.05)
+    assert gradient.gradient == pytest.approx(3.0)
+
+
+def test_find_gradients_ignores_pwm_runs():
+    start = datetime(2020, 1, 1)
+    history = [(start, 'PWM', None, 5.0)]
+    history += [(start + timedelta(seconds=t), None, 18.0 + t / 3600, None)
+                for t in range(60, 3600, 60)]
+    assert list(backfill.find_gradients(history)) == []
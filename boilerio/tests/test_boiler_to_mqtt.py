@@ -0,0 +1,51 @@
+from types import SimpleNamespace
+
+from .. import boiler_to_mqtt
+from ..clock import VirtualClock
+from ..commandqueue import CommandQueue
+from ..relaystate import RelayStateTable
+
+TOPIC = 'heating/zone/demand'
+
+
+def send(queue, payload, relay_state=None):
+    boiler_to_mqtt.on_message(
+        None, {'demand_topic': TOPIC, 'command_queue': queue,
+               'relay_state': relay_state},
+        SimpleNamespace(topic=TOPIC, payload=payload))
+
+
+def test_valid_commands_are_queued_with_normalised_ids():
+    queue = CommandQueue()
+    send(queue, b'{"command": "O", "thermostat": "47793"}')
+    assert queue.pop() == {'command': 'O', 'thermostat': '0xbab1'}
+    send(queue, b'{"command": "L", "thermostat": 47793}')
+    assert queue.pop() == {'command': 'L', 'thermostat': '0xbab1'}
+
+
+def test_invalid_commands_are_not_queued():
+    queue = CommandQueue()
+    send(queue, b'{"command": "Z", "thermostat": "0x1"}')
+    send(queue, b'{"command": "O"}')
+    send(queue, b'{"command": "O", "thermostat": "nope"}')
+    send(queue, b'not json')
+    assert len(queue) == 0
+
+
+def test_reports_update_relay_state_and_are_retained():
+    published = []
+    client = SimpleNamespace(
+        publish=lambda *args, **kwargs: published.append((args, kwargs)))
+    relay_state = RelayStateTable(600, VirtualClock())
+    publish = boiler_to_mqtt.make_publisher(client, 'info', relay_state)
+    publish('ISSUE', '0xbab1', 'ON')
+    publish('ISSUE', '0xbab1', 'LEARN')
+    assert [(args[0], kwargs['retain']) for args, kwargs in published] == \
+        [('info/0xbab1', True), ('info/0xbab1', False)]
+
+    queue = CommandQueue()
+    send(queue, b'{"command": "O", "thermostat": "0xbab1"}', relay_state)
+    send(queue, b'{"command": "O", "thermostat": "0xbab1"}', relay_state)
+    assert queue.pop() == {'command': 'O', 'thermostat': '0xbab1'}
+    assert queue.pop() is None
+    assert relay_state.suppressed == 1
@@ -0,0 +1,16 @@
+from datetime import datetime, timedelta
+
+from ..clock import SYSTEM_CLOCK, VirtualClock
+
+
+def test_virtual_clock_wall_time_follows_monotonic_time():
+    start = datetime(2020, 3, 29, 0, 30)
+    clock = VirtualClock(start)
+    clock.advance(90)
+    assert clock.monotonic() == 90
+    assert clock.now() == start + timedelta(seconds=90)
+
+
+def test_system_clock_is_monotonic():
+    first = SYSTEM_CLOCK.monotonic()
+    assert SYSTEM_CLOCK.monotonic() >= first
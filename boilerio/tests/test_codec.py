@@ -0,0 +1,87 @@
+import configparser
+from types import SimpleNamespace
+
+import pytest
+
+from .. import codec
+from .. import dispatch
+from ..clock import VirtualClock
+from ..tempsensor import EmonTHSensor
+
+
+@pytest.fixture(autouse=True)
+def topic_codecs():
+    yield
+    codec._topic_codecs.clear()
+
+
+def test_json_is_the_default():
+    assert codec.for_topic('emon/emonth1') is codec.JsonCodec
+    assert codec.decode('emon/emonth1', b'{"temperature": 20.5}') == {
+        'temperature': 20.5}
+    assert codec.decode('a/b', codec.encode('a/b', {'x': [1, 2]})) == {
+        'x': [1, 2]}
+
+
+def test_codec_not_guessed_from_topic():
+    # Existing topics ending in a codec's name are still JSON:
+    for topic in ('emon/emonth', 'a/msgpack'):
+        assert codec.for_topic(topic) is codec.JsonCodec
+
+
+def test_codecs_from_config():
+    conf = configparser.RawConfigParser()
+    conf.read_dict({'codecs': {'emonth': 'emon/emonth1 emon/emonth2',
+                               'msgpack': 'a/b'}})
+    codec.from_config(conf)
+    assert codec.for_topic('emon/emonth2') is codec.EmonTHCodec
+    assert codec.for_topic('a/b') is codec.MsgpackCodec
+    assert codec.for_topic('emon/emonth3') is codec.JsonCodec
+
+    conf.set('codecs', 'protobuf', 'a/c')
+    with pytest.raises(ValueError):
+        codec.from_config(conf)
+
+
+def test_emonth_round_trip():
+    codec.set_codec('emon/emonth1/emonth', 'emonth')
+    reading = {'temperature': -2.35, 'humidity': 54.1, 'battery': 3.1}
+    payload = codec.encode('emon/emonth1/emonth', reading)
+    assert len(payload) == 6
+    assert codec.decode('emon/emonth1/emonth', payload) == pytest.approx(
+        reading)
+
+
+@pytest.mark.parametrize('topic, payload', [
+    ('emon/emonth1', b'{'),
+    ('emon/emonth1/emonth', b'\x01\x02'),
+])
+def test_malformed_payload_raises_value_error(topic, payload):
+    codec.set_codec('emon/emonth1/emonth', 'emonth')
+    with pytest.raises(ValueError):
+        codec.decode(topic, payload)
+
+
+def test_msgpack():
+    codec.set_codec('a/msgpack', 'msgpack')
+    if codec.msgpack is None:
+        with pytest.raises(codec.CodecUnavailable):
+            codec.decode('a/msgpack', b'\x80')
+    else:
+        payload = codec.encode('a/msgpack', {'temperature': 20.5})
+        assert codec.decode('a/msgpack', payload) == {'temperature': 20.5}
+
+
+def test_sensor_reads_binary_topic():
+    codec.set_codec('emon/emonth1/emonth', 'emonth')
+    clock = VirtualClock()
+    sensor = EmonTHSensor(1, 'emon/emonth1/emonth', clock)
+    dispatcher = dispatch.MqttDispatcher()
+    sensor.register(dispatcher)
+    dispatcher.on_message(None, None, SimpleNamespace(
+        topic='emon/emonth1/emonth',
+        payload=codec.EmonTHCodec.encode(
+            {'temperature': 19.25, 'humidity': 50, 'battery': 3})))
+    sensor.process_readings()
+    assert sensor.reading.temperature == pytest.approx(19.25)
+    assert sensor.reading.relative_humidity == pytest.approx(50)
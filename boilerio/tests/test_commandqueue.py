@@ -0,0 +1,92 @@
+import threading
+
+from .. import commandqueue
+from ..clock import VirtualClock
+
+
+def cmd(command, thermostat):
+    return {'command': command, 'thermostat': thermostat}
+
+
+def drain(queue):
+    result = []
+    while True:
+        request = queue.pop()
+        if request is None:
+            return result
+        result.append((request['command'], request['thermostat']))
+
+
+def test_fifo_across_thermostats_with_latest_command_each():
+    queue = commandqueue.CommandQueue()
+    queue.put(cmd('O', '0x1'))
+    queue.put(cmd('O', '0x2'))
+    queue.put(cmd('X', '0x1'))
+    queue.put(cmd('O', '0x3'))
+    assert drain(queue) == [('X', '0x1'), ('O', '0x2'), ('O', '0x3')]
+    assert queue.stats.coalesced == 1
+
+
+def test_learn_packets_wait_for_demand():
+    queue = commandqueue.CommandQueue()
+    for i in range(5):
+        queue.put(cmd('L', '0x9'))
+    queue.put(cmd('L', '0x8'))
+    queue.put(cmd('O', '0x1'))
+    assert drain(queue) == [('O', '0x1'), ('L', '0x9'), ('L', '0x8')]
+
+
+def test_full_queue_prefers_demand():
+    queue = commandqueue.CommandQueue(max_size=2)
+    assert queue.put(cmd('L', '0x9'))
+    assert queue.put(cmd('O', '0x1'))
+    assert queue.put(cmd('O', '0x2'))
+    assert not queue.put(cmd('O', '0x3'))
+    assert not queue.put(cmd('L', '0x8'))
+    # Replacing a waiting command doesn't need room:
+    assert queue.put(cmd('X', '0x2'))
+    assert drain(queue) == [('O', '0x1'), ('X', '0x2')]
+    assert queue.stats.dropped == 3
+
+
+def test_metrics():
+    clock = VirtualClock()
+    queue = commandqueue.CommandQueue(clock=clock)
+    queue.put(cmd('O', '0x1'))
+    queue.put(cmd('O', '0x2'))
+    clock.advance(1)
+    queue.pop()
+    clock.advance(2)
+    queue.pop()
+    metrics = queue.metrics()
+    assert metrics['depth'] == 0
+    assert metrics['max_depth'] == 2
+    assert metrics['sent'] == 2
+    assert metrics['latency_mean'] == 2
+    assert metrics['latency_max'] == 3
+
+
+def test_latency_includes_time_waiting_before_replacement():
+    clock = VirtualClock()
+    queue = commandqueue.CommandQueue(clock=clock)
+    queue.put(cmd('O', '0x1'))
+    clock.advance(5)
+    queue.put(cmd('X', '0x1'))
+    clock.advance(1)
+    assert queue.pop() == cmd('X', '0x1')
+    assert queue.metrics()['latency_max'] == 6
+
+
+def test_concurrent_producers():
+    queue = commandqueue.CommandQueue(max_size=1000)
+
+    def produce(n):
+        for i in range(200):
+            queue.put(cmd('O', '0x%x%03d' % (n, i)))
+
+    threads = [threading.Thread(target=produce, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(drain(queue)) == 800
@@ -0,0 +1,84 @@
+from unittest import mock
+
+from boilerio import demand
+
+
+def test_or_policy_keeps_relay_on_for_any_zone():
+    boiler = mock.MagicMock()
+    relay = demand.RelayDemand(boiler, 'or')
+    a = relay.add_zone(1)
+    b = relay.add_zone(2)
+
+    a.on()
+    b.off()
+    relay.update(0)
+    boiler.on.assert_called_once()
+    boiler.off.assert_not_called()
+
+    # One zone's PWM off-phase doesn't cancel the other's demand:
+    a.off()
+    b.on()
+    relay.update(1)
+    boiler.off.assert_not_called()
+
+    b.off()
+    relay.update(2)
+    boiler.off.assert_called_once()
+
+
+def test_max_policy_modulates_at_highest_dutycycle():
+    boiler = mock.MagicMock()
+    relay = demand.RelayDemand(boiler, 'max', period=600)
+    relay.add_zone(1).set_dutycycle(0.25)
+    relay.add_zone(2).set_dutycycle(0.5)
+    assert relay.dutycycle == 0.5
+
+    relay.update(0)
+    boiler.on.assert_called_once()
+    relay.update(299)
+    boiler.off.assert_not_called()
+    relay.update(300)
+    boiler.off.assert_called_once()
+
+
+def test_weighted_policy():
+    relay = demand.RelayDemand(mock.MagicMock(), 'weighted')
+    relay.add_zone(1, weight=3).set_dutycycle(1)
+    relay.add_zone(2, weight=1).set_dutycycle(0)
+    assert relay.dutycycle == 0.75
+    assert demand.RelayDemand(mock.MagicMock(), 'weighted').dutycycle == 0
+
+
+def test_unknown_policy():
+    try:
+        demand.RelayDemand(mock.MagicMock(), 'and')
+    except ValueError:
+        pass
+    else:
+        assert False
+
+
+def test_minimum_on_and_off_times_and_cycle_count():
+    boiler = mock.MagicMock()
+    relay = demand.RelayDemand(boiler, 'or', min_on=120, min_off=300)
+    zone = relay.add_zone(1)
+
+    zone.on()
+    relay.update(0)
+    zone.off()
+    relay.update(60)
+    assert relay.active
+    relay.update(120)
+    assert not relay.active
+
+    zone.on()
+    relay.update(200)
+    assert not relay.active
+    relay.update(420)
+    assert relay.active
+    boiler.on.assert_called_with()
+    assert relay.cycles == 2
+    assert relay.cycles_per_hour(420) == 2
+    assert relay.cycles_per_hour(3601) == 1
+    assert relay.metrics(3601) == {'on': True, 'dutycycle': None,
+                                   'cycles': 2, 'cycles_per_hour': 1}
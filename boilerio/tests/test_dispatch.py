@@ -0,0 +1,103 @@
+import json
+import sys
+import threading
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+from .. import dispatch
+
+
+def test_trie_matches_wildcards():
+    trie = dispatch.TopicTrie()
+    for f in ('emon/emonth1', 'emon/+', 'emon/#', '#', 'heating/+/info',
+              'emon/emonth1/extra'):
+        trie.add(f, f)
+    assert set(trie.match('emon/emonth1')) == {
+        'emon/emonth1', 'emon/+', 'emon/#', '#'}
+    assert set(trie.match('emon')) == {'emon/#', '#'}
+    assert set(trie.match('heating/zone/info')) == {'heating/+/info', '#'}
+    assert set(trie.match('heating/zone/other')) == {'#'}
+    # Wildcards at the start don't match topics beginning with $:
+    assert trie.match('$SYS/broker/uptime') == ()
+
+
+def test_trie_remove():
+    trie = dispatch.TopicTrie()
+    trie.add('a/b', 1)
+    trie.add('a/+', 2)
+    assert set(trie.match('a/b')) == {1, 2}
+    trie.remove('a/+', 2)
+    assert trie.match('a/b') == (1,)
+    assert trie.filters() == ['a/b']
+
+
+def test_trie_changes_during_matching():
+    trie = dispatch.TopicTrie()
+    trie.add('emon/a', 'old')
+    stop = threading.Event()
+    errors = []
+
+    def dispatch_messages():
+        try:
+            while not stop.is_set():
+                trie.match('emon/a')
+                trie.filters()
+        except Exception as e:
+            errors.append(e)
+
+    # Switch threads as often as possible, to provoke races:
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    threads = [threading.Thread(target=dispatch_messages) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    try:
+        # Moving sensors back and forth, as a reload does:
+        for i in range(5000):
+            old, new = ('old', 'new') if i % 2 == 0 else ('new', 'old')
+            trie.remove('emon/a', old)
+            trie.add('emon/a', new)
+            trie.add('sensor%d/a' % i, i)
+            trie.remove('sensor%d/a' % i, i)
+            assert trie.match('emon/a') == (new,)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        sys.setswitchinterval(interval)
+    assert trie.match('emon/a') == ('old',)
+    assert errors == []
+
+
+def test_dispatcher_parses_once_for_many_consumers():
+    dispatcher = dispatch.MqttDispatcher()
+    seen = []
+    dispatcher.add('emon/#', lambda topic, data: seen.append(data))
+    dispatcher.add('emon/emonth1', lambda topic, data: seen.append(data))
+    dispatcher.on_message(None, None, SimpleNamespace(
+        topic='emon/emonth1', payload=json.dumps({'temperature': 20.5})))
+    assert seen == [{'temperature': 20.5}] * 2
+    assert seen[0] is seen[1]
+
+
+def test_dispatcher_isolates_failing_consumers():
+    dispatcher = dispatch.MqttDispatcher()
+    good = MagicMock()
+    dispatcher.add('a', MagicMock(side_effect=RuntimeError()))
+    dispatcher.add('a', good)
+    dispatcher.on_message(None, None, SimpleNamespace(topic='a',
+                                                      payload='{}'))
+    dispatcher.on_message(None, None, SimpleNamespace(topic='a',
+                                                      payload='{'))
+    good.assert_called_once_with('a', {})
+
+
+def test_dispatcher_subscribes_in_batches():
+    dispatcher = dispatch.MqttDispatcher()
+    for i in range(250):
+        dispatcher.add('emon/emonth%d' % i, None)
+    client = MagicMock()
+    dispatcher.subscribe(client)
+    batches = [c.args[0] for c in client.subscribe.call_args_list]
+    assert [len(b) for b in batches] == [100, 100, 50]
+    assert batches[0][0] == ('emon/emonth0', 0)
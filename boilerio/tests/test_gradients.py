@@ -0,0 +1,34 @@
+import pytest
+
+import math
+
+from ..gradients import GradientTable, LeadTimeTable
+
+
+def test_gradient_interpolation_is_weighted_by_npoints():
+    table = GradientTable([{'delta': 6.0, 'gradient': 1.0, 'npoints': 1},
+                           {'delta': 5.0, 'gradient': 2.0, 'npoints': 3}])
+    assert table.gradient_at(4.0) == 2.0
+    assert table.gradient_at(5.0) == 2.0
+    # Halfway between, the better-measured bucket dominates:
+    assert table.gradient_at(5.5) == pytest.approx(1.75)
+    assert table.gradient_at(7.0) == 1.0
+    assert GradientTable([]).gradient_at(5.0) is None
+
+
+def test_lead_time_integrates_over_heating_curve():
+    table = LeadTimeTable(GradientTable([{'delta': 5.0, 'gradient': 2.0},
+                                         {'delta': 10.0, 'gradient': 1.0}]))
+    # The gradient falls linearly from 2C/h to 1C/h, so heating takes
+    # 5 ln(2) hours:
+    assert table.lead_time(5.0, 10.0) == pytest.approx(
+        5 * math.log(2) * 3600, rel=1e-4)
+    # Beyond the table the last gradient is used:
+    assert table.lead_time(10.0, 11.0) == pytest.approx(3600)
+    assert table.lead_time(10.0, 9.0) == 0
+
+
+def test_lead_time_without_data_is_none():
+    assert LeadTimeTable(GradientTable([])).lead_time(5.0, 6.0) is None
+    table = LeadTimeTable(GradientTable([{'delta': 5.0, 'gradient': 0.0}]))
+    assert table.lead_time(5.0, 6.0) is None
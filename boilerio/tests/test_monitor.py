@@ -1,41 +1,165 @@
-from datetime import datetime, timedelta
+import json
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+import requests_mock
+
 from boilerio import monitor
+from boilerio.clock import VirtualClock
 
 def test_none_to_on_transition_no_reading():
     """Test that when the boiler turns on for the first time that
     a temperature reading provided shortly afterwards doesn't cause
     a gradient to be generated."""
     m = monitor.Monitor()
-    t = datetime(2010, 1, 1, 0, 0)
+    t = 1000.0
     m.set_outside_temperature(10, t)
     assert m.temperature_update(20, t) == None
     m.boiler_on(t)
-    assert m.temperature_update(22, t + timedelta(seconds=10)) == None
+    assert m.temperature_update(22, t + 10) == None
+
+def heat(m, start_temp, start, end, gradient, step=60):
+    """Feed readings rising at 'gradient' degrees per hour.  Returns the
+    estimates produced."""
+    results = []
+    for t in range(int(start), int(end) + 1, step):
+        temp = start_temp + gradient * (t - start) / 3600
+        r = m.temperature_update(temp, t)
+        if r is not None:
+            results.append(r)
+    return results
 
 def test_first_ten_minutes_are_ignored():
     """Check that warmup period is ignored."""
+    m = monitor.Monitor(warmup_interval_s=600)
+    t = 1000
+    m.set_outside_temperature(10, t)
+    m.boiler_on(t)
+    # Readings during warm-up don't fit the heating gradient:
+    heat(m, 20, t, t + 600, -6.0)
+    assert heat(m, 21, t + 660, t + 1800, 6.0) == []
+    r = m.boiler_off(t + 1860)
+    assert r.delta == 11
+    assert r.gradient == pytest.approx(6.0)
+    assert r.stderr == pytest.approx(0.0, abs=1e-6)
+    assert r.npoints == 20
+
+def test_short_run_gives_no_result():
     m = monitor.Monitor(warmup_interval_s=60)
-    t = datetime(2010, 1, 1, 0, 0)
+    t = 1000
     m.set_outside_temperature(10, t)
-    assert m.temperature_update(20, t) == None
     m.boiler_on(t)
-    assert m.temperature_update(21, t + timedelta(seconds=120)) == None
-    assert m.temperature_update(23, t + timedelta(seconds=1320)) == (11, 6.0)
+    heat(m, 20, t + 120, t + 600, 6.0)
+    assert m.boiler_off(t + 600) is None
 
 def test_boiler_already_on():
     """Check that multiple boiler on messages don't cause a problem."""
     m = monitor.Monitor(warmup_interval_s=60)
-    t = datetime(2010, 1, 1, 0, 0)
+    t = 1000
     m.set_outside_temperature(10, t)
+    m.boiler_on(t)
+    heat(m, 20, t + 120, t + 600, 6.0)
+    m.boiler_on(t + 601)
+    heat(m, 20.9, t + 660, t + 1320, 6.0)
+    assert m.boiler_off(t + 1321).gradient == pytest.approx(6.0)
 
-    # First update should not capture temperature because the boiler isn't on long enough
-    assert m.temperature_update(20, t) == None
+def test_long_runs_give_several_results():
+    m = monitor.Monitor(warmup_interval_s=60)
+    t = 1000
+    m.set_outside_temperature(10, t)
+    m.boiler_on(t)
+    results = heat(m, 15, t + 120, t + 120 + 2 * 3600, 3.0)
+    assert [r.delta for r in results] == pytest.approx([5, 8])
+    assert all(r.gradient == pytest.approx(3.0) for r in results)
+
+def test_noisy_readings():
+    """Noise averages out and is reflected in the standard error."""
+    m = monitor.Monitor(warmup_interval_s=60)
+    t = 1000
+    m.set_outside_temperature(10, t)
     m.boiler_on(t)
+    for i in range(40):
+        noise = 0.1 if i % 2 else -0.1
+        m.temperature_update(20 + 3.0 * i / 60 + noise, t + 120 + i * 60)
+    r = m.boiler_off(t + 120 + 40 * 60)
+    assert r.gradient == pytest.approx(3.0, abs=0.2)
+    assert 0 < r.stderr < 0.5
+
+def test_too_noisy_readings_are_discarded():
+    m = monitor.Monitor(warmup_interval_s=60, max_stderr=0.5)
+    t = 1000
+    m.set_outside_temperature(10, t)
+    m.boiler_on(t)
+    for i in range(12):
+        m.temperature_update(20 + (2 if i % 2 else -2), t + 120 + i * 60)
+    assert m.boiler_off(t + 900) is None
+
+class CountingWeather(object):
+    def __init__(self, temperature):
+        self.temperature = temperature
+        self.calls = 0
+
+    def get_weather(self):
+        self.calls += 1
+        return {'temperature': self.temperature}
+
+
+def message(topic, payload):
+    return SimpleNamespace(topic=topic, payload=json.dumps(payload))
+
+
+def test_mqtt_monitor_routes_messages_to_zones():
+    clock = VirtualClock()
+    results = []
+    m = monitor.MqttMonitor(
+        CountingWeather(10), lambda *r: results.append(r),
+        warmup_interval_s=30, clock=clock)
+    m.add_zone(1, 'relay/1', 'sensor/1')
+    m.add_zone(2, 'relay/2', 'sensor/2')
+    assert m.topics() == ['relay/1', 'relay/2', 'sensor/1', 'sensor/2']
+
+    m.on_message(None, None, message('relay/1', {'cmd': 'ON'}))
+    for i in range(21):
+        clock.advance(60)
+        m.on_message(None, None,
+                     message('sensor/1', {'temperature': 21 + i / 10}))
+        m.on_message(None, None, message('sensor/2', {'temperature': 15 + i}))
+    assert results == []
+    m.on_message(None, None, message('relay/1', {'cmd': 'OFF'}))
+    assert len(results) == 1
+    zone_id, when, delta, gradient, stderr, npoints = results[0]
+    assert (zone_id, when) == (1, clock.now())
+    assert delta == pytest.approx(11)
+    assert gradient == pytest.approx(6.0)
+    assert stderr == pytest.approx(0, abs=1e-6)
+    assert npoints > 2
+
+
+def test_mqtt_monitor_ignores_bad_messages():
+    m = monitor.MqttMonitor(CountingWeather(10), None, clock=VirtualClock())
+    m.add_zone(1, 'relay/1', 'sensor/1')
+    m.on_message(None, None, message('sensor/1', {'humidity': 50}))
+    m.on_message(None, None, SimpleNamespace(topic='relay/1', payload='{'))
+
+
+def test_gradient_uploader_batches_and_retries():
+    uploader = monitor.GradientUploader('http://foo', None, max_batch=2,
+                                        max_pending=3)
+    when = datetime(2020, 1, 1)
+    for zone_id in range(4):
+        uploader.add(zone_id, when, 10.0, 1.0, 0.1, 20)
 
-    # Next update should be captured:
-    m.boiler_on(t + timedelta(seconds=119))
-    assert m.temperature_update(21, t + timedelta(seconds=120)) == None
+    with requests_mock.Mocker() as m:
+        m.post('http://foo/zones/gradient_measurements', status_code=500)
+        assert not uploader.flush()
+        m.post('http://foo/zones/gradient_measurements', status_code=200)
+        assert uploader.flush()
+        assert uploader.flush()
 
-    # Final update should produce a result:
-    m.boiler_on(t + timedelta(seconds=1319))
-    assert m.temperature_update(23, t + timedelta(seconds=1320)) == (11, 6.0)
+        # The oldest measurement was dropped; the rest went in two posts:
+        posted = [r.json() for r in m.request_history[1:]]
+        assert [[g['zone_id'] for g in batch] for batch in posted] == \
+            [[1, 2], [3]]
+        assert (posted[1][0]['stderr'], posted[1][0]['npoints']) == (0.1, 20)
+        assert m.request_history[1].headers['X-Requested-With'] == 'device'
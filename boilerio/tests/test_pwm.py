@@ -1,30 +1,30 @@
+import random
 from unittest import mock
-from datetime import datetime, timedelta
 from boilerio import pwm
 
 def test_start_off():
     mock_device = mock.MagicMock()
-    c = pwm.PWM(0, timedelta(0, 600), mock_device)
-    now = datetime.now()
+    c = pwm.PWM(0, 600, mock_device)
+    now = 1000.0
     c.update(now)
     mock_device.off.assert_called()
     mock_device.on.assert_not_called()
 
 def test_start_on():
     mock_device = mock.MagicMock()
-    c = pwm.PWM(0.5, timedelta(0, 600), mock_device)
-    now = datetime.now()
+    c = pwm.PWM(0.5, 600, mock_device)
+    now = 1000.0
     c.update(now)
     mock_device.off.assert_not_called()
     mock_device.on.assert_called()
 
 def test_device_modulated():
     mock_device = mock.MagicMock()
-    period = timedelta(0,600)
-    off_before = timedelta(0,301)
-    c = pwm.PWM(0.5, timedelta(0, 600), mock_device)
+    period = 600
+    off_before = 301
+    c = pwm.PWM(0.5, 600, mock_device)
 
-    now = datetime.now()
+    now = 1000.0
     c.update(now)
     mock_device.off.assert_not_called()
     mock_device.on.assert_called()
@@ -32,3 +32,109 @@ def test_device_modulated():
     now += off_before
     c.update(now)
     mock_device.off.assert_called()
+
+def test_phase_aligns_cycles():
+    mock_device = mock.MagicMock()
+    c = pwm.PWM(0.5, 600, mock_device, phase=200)
+
+    # Mid-way through the cycle that began at 800, past its on-phase:
+    c.update(1150.0)
+    mock_device.off.assert_called()
+    mock_device.on.assert_not_called()
+
+    # The next cycle begins at 1400:
+    c.update(1399.0)
+    mock_device.on.assert_not_called()
+    c.update(1400.0)
+    mock_device.on.assert_called()
+
+def test_minimum_on_and_off_times():
+    c = pwm.PWM(0.1, 600, mock.MagicMock(), min_on=120, min_off=120)
+    assert c.on_period == 0
+    c.setDutyCycle(0.5)
+    assert c.on_period == 300
+    c.setDutyCycle(0.9)
+    assert c.on_period == 600
+
+def test_scheduler_staggers_on_phases():
+    scheduler = pwm.PWMScheduler(min_on=60)
+    a = pwm.PWM(0, 600, mock.MagicMock())
+    b = pwm.PWM(0, 600, mock.MagicMock())
+    scheduler.add(a)
+    scheduler.add(b)
+    assert a.min_on == 60
+
+    a.setDutyCycle(0.25)
+    b.setDutyCycle(0.5)
+    assert (a.phase, b.phase) == (0, 150)
+    a.setDutyCycle(0.75)
+    assert (a.phase, b.phase) == (0, 450)
+
+    scheduler.remove(a)
+    assert b.phase == 0
+
+def test_phased_duty_cycle_applies_from_next_cycle():
+    mock_device = mock.MagicMock()
+    c = pwm.PWM(0.5, 600, mock_device, phase=0, min_on=60)
+    c.update(1200.0)
+    mock_device.on.assert_called_once()
+
+    # A shorter on-phase waits for the next cycle:
+    c.setDutyCycle(0.1)
+    c.update(1300.0)
+    mock_device.off.assert_not_called()
+    c.update(1500.0)
+    mock_device.off.assert_called_once()
+    c.update(1800.0)
+    assert mock_device.on.call_count == 2
+    c.update(1860.0)
+    assert mock_device.off.call_count == 2
+
+    # Turning off applies at once, after min_on:
+    c.update(2400.0)
+    c.setDutyCycle(0)
+    c.update(2430.0)
+    assert mock_device.off.call_count == 2
+    c.update(2460.0)
+    assert mock_device.off.call_count == 3
+
+class PulseRecorder(object):
+    """A device recording the length of each on-pulse."""
+
+    def __init__(self):
+        self.now = 0
+        self.on_since = None
+        self.pulses = []
+
+    def on(self):
+        if self.on_since is None:
+            self.on_since = self.now
+
+    def off(self):
+        if self.on_since is not None:
+            self.pulses.append(self.now - self.on_since)
+            self.on_since = None
+
+def test_scheduler_with_jittering_duty_cycles():
+    rng = random.Random(1)
+    scheduler = pwm.PWMScheduler(min_on=60)
+    devices = [PulseRecorder(), PulseRecorder()]
+    pwms = [pwm.PWM(0, 600, device) for device in devices]
+    for p in pwms:
+        scheduler.add(p)
+
+    hours = 6
+    for now in range(hours * 3600):
+        for device in devices:
+            device.now = now
+        if now % 5 == 0:
+            for p in pwms:
+                p.setDutyCycle(rng.uniform(0.2, 0.4))
+        for p in pwms:
+            p.update(now)
+
+    # Phases change only at cycle boundaries, so there's at most one pulse
+    # per cycle, and none shorter than min_on:
+    for device in devices:
+        assert len(device.pulses) <= hours * 6
+        assert min(device.pulses) >= 60
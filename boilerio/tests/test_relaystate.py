@@ -0,0 +1,49 @@
+from .. import relaystate
+from ..clock import VirtualClock
+
+
+def cmd(command, thermostat):
+    return {'command': command, 'thermostat': thermostat}
+
+
+def test_repeats_are_suppressed_within_the_refresh_window():
+    clock = VirtualClock()
+    table = relaystate.RelayStateTable(600, clock)
+    assert table.should_send(cmd('O', '0x1'))
+    table.update('ISSUE', '1', 'ON')
+    assert table.state('0x1') == 'ON'
+    clock.advance(120)
+    assert not table.should_send(cmd('O', '0x1'))
+    clock.advance(480)
+    assert table.should_send(cmd('O', '0x1'))
+    assert table.suppressed == 1
+
+
+def test_unconfirmed_or_changed_commands_are_sent():
+    clock = VirtualClock()
+    table = relaystate.RelayStateTable(600, clock)
+    # No ISSUE yet (e.g. the transceiver didn't acknowledge it):
+    assert table.should_send(cmd('O', '0x1'))
+    assert table.should_send(cmd('O', '0x1'))
+    table.update('ISSUE', '0x1', 'ON')
+    assert table.should_send(cmd('X', '0x1'))
+    table.update('ISSUE', '0x1', 'OFF')
+    # A real thermostat turned the relay back on:
+    table.update('RECV', '0x1', 'ON')
+    assert table.should_send(cmd('X', '0x1'))
+    assert table.suppressed == 0
+
+
+def test_learn_packets_are_always_sent():
+    table = relaystate.RelayStateTable(600, VirtualClock())
+    table.update('ISSUE', '0x1', 'LEARN')
+    assert table.state('0x1') is None
+    assert table.should_send(cmd('L', '0x1'))
+    assert table.should_send(cmd('L', '0x1'))
+
+
+def test_zero_window_sends_everything():
+    table = relaystate.RelayStateTable(0, VirtualClock())
+    table.should_send(cmd('O', '0x1'))
+    table.update('ISSUE', '0x1', 'ON')
+    assert table.should_send(cmd('O', '0x1'))
@@ -0,0 +1,133 @@
+import os
+import pty
+import select
+import threading
+import time
+
+import pytest
+import serial
+
+from .. import router
+from .. import transceiver
+from ..transceiver import COMMAND_NAMES
+
+
+def cmd(command, thermostat):
+    return {'command': command, 'thermostat': thermostat}
+
+
+def make_router(names=('a', 'b'), routes=None):
+    devices = [router.Device(name, None) for name in names]
+    reports = []
+    return (router.Router(devices, lambda *r: reports.append(r), routes),
+            devices, reports)
+
+
+def waiting(device):
+    return [r['thermostat'] for r in device.commands.drain()]
+
+
+def test_configured_then_learned_then_least_loaded():
+    r, (a, b), reports = make_router(routes={'0x1': 'b'})
+    r.put(cmd('O', '0x1'))
+    r._report(a, 'RECV', '0x2', 'ON')
+    r.put(cmd('O', '0x2'))
+    r.put(cmd('O', '0x3'))
+    r.put(cmd('O', '0x4'))
+    assert waiting(a) == ['0x2', '0x3']
+    assert waiting(b) == ['0x1', '0x4']
+    assert reports == [('RECV', '0x2', 'ON')]
+
+
+def test_unknown_device_in_routes():
+    with pytest.raises(ValueError):
+        make_router(routes={'0x1': 'c'})
+
+
+def test_new_route_replaces_command_waiting_elsewhere():
+    r, (a, b), _ = make_router()
+    r.put(cmd('O', '0x1'))
+    assert len(a.commands) == 1
+    r._report(b, 'RECV', '0x1', 'ON')
+    r.put(cmd('X', '0x1'))
+    assert waiting(a) == []
+    assert b.commands.pop() == cmd('X', '0x1')
+
+
+def test_fail_over_when_acknowledgements_stop():
+    r, (a, b), _ = make_router(routes={'0x1': 'a', '0x2': 'a'})
+    r.put(cmd('O', '0x1'))
+    r.put(cmd('O', '0x2'))
+    sent = a.commands.pop()
+    for _ in range(a.FAILURE_THRESHOLD):
+        r._result(a, sent, False)
+    assert waiting(a) == []
+    assert waiting(b) == ['0x2', '0x1']
+    # While a is skipped, even routed commands go to b:
+    r.put(cmd('X', '0x1'))
+    assert waiting(b) == ['0x1']
+
+
+def fake_transceiver(master, stop):
+    """Acknowledges commands written to a pty."""
+    buffer = b''
+    while not stop.is_set():
+        if not select.select([master], [], [], 0.05)[0]:
+            continue
+        buffer += os.read(master, 1024)
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            line = line.decode()
+            os.write(master, ('ISSUE %s %s\n' % (
+                line[1:], COMMAND_NAMES[line[0]])).encode())
+
+
+def test_devices_on_ptys_fail_over(monkeypatch):
+    monkeypatch.setattr(transceiver.Transceiver, 'ACK_TIMEOUT', 0.05)
+    stop = threading.Event()
+    ptys = [pty.openpty() for _ in range(2)]
+
+    def opener(slave):
+        return lambda: serial.Serial(os.ttyname(slave), 57600, timeout=0)
+
+    devices = [router.Device(name, opener(slave))
+               for name, (_, slave) in zip('ab', ptys)]
+    acked = []
+    r = router.Router(devices, lambda *report: acked.append(report),
+                      routes={'0x1': 'b'})
+    # Only a's transceiver answers:
+    threads = [threading.Thread(target=fake_transceiver,
+                                args=(ptys[0][0], stop))]
+    threads[0].start()
+    threads += r.start(stop)
+    try:
+        r.put(cmd('O', '0x1'))
+        r.put(cmd('O', '0x2'))
+        deadline = time.monotonic() + 5
+        while len(acked) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        for master, slave in ptys:
+            os.close(master)
+            os.close(slave)
+    assert sorted(acked) == [('ISSUE', '0x1', 'ON'), ('ISSUE', '0x2', 'ON')]
+    assert r.metrics()['b']['timeouts'] == devices[1].FAILURE_THRESHOLD
+    assert r.metrics()['b']['failed']
+
+
+def test_port_failure_fails_over():
+    stop = threading.Event()
+
+    def broken():
+        stop.set()
+        raise serial.SerialException("gone")
+
+    a = router.Device('a', broken)
+    b = router.Device('b', None)
+    r = router.Router([a, b], lambda *report: None, routes={'0x1': 'a'})
+    r.put(cmd('O', '0x1'))
+    r.run_device(a, stop)
+    assert waiting(b) == ['0x1']
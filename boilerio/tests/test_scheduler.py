@@ -1,11 +1,17 @@
 # Note that this file should probably be split into two along with
 # separation of scheduler policy from the scheduler app.
 
+import configparser
+import json
 from datetime import time, datetime
+from .. import dispatch
 from .. import scheduler
+from .. import sensorhealth
 from ..schedulerweb import model
 import requests_mock
 import requests.exceptions
+from unittest.mock import MagicMock
+import pytest
 
 EMPTY_SCHEDULE_RESPONSE = """{
    "schedule": {
@@ -36,6 +42,139 @@ def test_no_exception_if_request_fails():
         zc = scheduler.AllZoneController('https://scheduler/api', None, [])
         zc.iteration(None)
 
+def test_sensor_readings_taken_each_iteration():
+    sensor = MagicMock()
+    with requests_mock.Mocker() as m:
+        m.get("https://scheduler/api/schedule", status_code=401)
+        zc = scheduler.AllZoneController('https://scheduler/api', None, [],
+                                         sensors=[sensor])
+        zc.iteration(None)
+    sensor.process_readings.assert_called_once_with()
+
+def test_sensor_health_checked_each_iteration():
+    health = MagicMock()
+    with requests_mock.Mocker() as m:
+        m.get("https://scheduler/api/schedule", status_code=401)
+        zc = scheduler.AllZoneController('https://scheduler/api', None, [],
+                                         health=health)
+        zc.iteration(None)
+    health.check.assert_called_once()
+
+def make_factory():
+    conf = configparser.ConfigParser()
+    conf.read_dict({'heating': {'demand_request_topic': 'demand'}})
+    return scheduler.ZoneFactory(
+        'https://scheduler/api', None, conf, MagicMock(),
+        dispatch.MqttDispatcher(), MagicMock(),
+        sensorhealth.SensorHealthRegistry(), MagicMock())
+
+def test_reload_changes_only_what_changed():
+    factory = make_factory()
+    for sensor_id in (1, 2):
+        factory.new_sensor(sensor_id, 'emon/%d' % sensor_id)
+    kept = factory.add_zone(model.Zone(1, 'Kept', '0x1', 1))
+    moved = factory.add_zone(model.Zone(2, 'Moved', '0x2', 1))
+    removed = factory.add_zone(model.Zone(3, 'Removed', '0x3', 2))
+    zc = scheduler.AllZoneController(
+        'https://scheduler/api', None, [kept, moved, removed],
+        factory=factory)
+
+    sensors = [{'sensor_id': 1, 'locator': 'emon/one'},
+               {'sensor_id': 3, 'locator': 'emon/3'}]
+    zones = [{'zone_id': 1, 'name': 'Kept', 'boiler_relay': '0x1',
+              'sensor_id': 1},
+             {'zone_id': 2, 'name': 'Moved', 'boiler_relay': '0x2',
+              'sensor_id': 3},
+             {'zone_id': 4, 'name': 'Added', 'boiler_relay': '0x1',
+              'sensor_id': 3}]
+    with requests_mock.Mocker() as m:
+        m.get('https://scheduler/api/sensor/', json=sensors,
+              headers={'ETag': '"s1"'})
+        m.get('https://scheduler/api/zones', json=zones,
+              headers={'ETag': '"z1"'})
+        zc.reload()
+
+        assert zc.zone_controllers[:2] == [kept, moved]
+        assert [c.zone.zone_id for c in zc.zone_controllers] == [1, 2, 4]
+        assert moved.thermostat._sensor is factory.sensors[3]
+        assert sorted(factory.sensors) == [1, 3]
+        assert factory.sensors[1].locator == 'emon/one'
+        assert sorted(factory.dispatcher.filters()) == ['emon/3', 'emon/one']
+        assert sorted(factory.relays) == ['0x1', '0x2']
+        assert [z.zone_id for z in factory.relays['0x1'].zones] == [1, 4]
+        # The removed zone's relay was turned off:
+        factory.mqttc.publish.assert_called_with(
+            'demand', json.dumps({'thermostat': '0x3', 'command': 'X'}))
+
+        # Unchanged since the last reload:
+        m.get('https://scheduler/api/sensor/', status_code=304,
+              request_headers={'If-None-Match': '"s1"'})
+        m.get('https://scheduler/api/zones', status_code=304,
+              request_headers={'If-None-Match': '"z1"'})
+        zc.reload()
+        assert [c.zone.zone_id for c in zc.zone_controllers] == [1, 2, 4]
+
+def test_reload_retried_after_failing_part_way():
+    factory = make_factory()
+    for sensor_id in (1, 2):
+        factory.new_sensor(sensor_id, 'emon/%d' % sensor_id)
+    zone = factory.add_zone(model.Zone(1, 'Zone', '0x1', 2))
+    zc = scheduler.AllZoneController(
+        'https://scheduler/api', None, [zone], factory=factory)
+
+    with requests_mock.Mocker() as m:
+        m.get('https://scheduler/api/sensor/', json=[
+            {'sensor_id': 1, 'locator': 'emon/1'}], headers={'ETag': '"s1"'})
+        m.get('https://scheduler/api/zones',
+              exc=requests.exceptions.ConnectionError)
+        with pytest.raises(requests.exceptions.ConnectionError):
+            zc.reload()
+        assert sorted(factory.sensors) == [1, 2]
+
+        # The sensors are fetched again, and sensor 2 removed once no zone
+        # uses it:
+        m.get('https://scheduler/api/zones', json=[
+            {'zone_id': 1, 'name': 'Zone', 'boiler_relay': '0x1',
+             'sensor_id': 1}], headers={'ETag': '"z1"'})
+        zc.reload()
+        assert 'If-None-Match' not in m.request_history[-2].headers
+        assert sorted(factory.sensors) == [1]
+        assert zc.zone_controllers[0].thermostat._sensor is \
+            factory.sensors[1]
+
+def test_malformed_reload_keeps_zones():
+    factory = make_factory()
+    factory.new_sensor(1, 'emon/1')
+    zone = factory.add_zone(model.Zone(1, 'Zone', '0x1', 1))
+    zc = scheduler.AllZoneController(
+        'https://scheduler/api', None, [zone], factory=factory)
+
+    with requests_mock.Mocker() as m:
+        m.get('https://scheduler/api/schedule', status_code=401)
+        m.get('https://scheduler/api/sensor/', status_code=304)
+        m.get('https://scheduler/api/zones', json=[{'zone_id': 1}])
+        zc.request_reload()
+        zc.iteration(None)
+    assert zc.zone_controllers == [zone]
+
+def test_reload_rebuilds_zone_with_new_controller_params():
+    factory = make_factory()
+    factory.new_sensor(1, 'emon/1')
+    zone = factory.add_zone(model.Zone(1, 'Zone', '0x1', 1))
+    zc = scheduler.AllZoneController(
+        'https://scheduler/api', None, [zone], factory=factory)
+
+    with requests_mock.Mocker() as m:
+        m.get('https://scheduler/api/sensor/', status_code=304)
+        m.get('https://scheduler/api/zones', json=[
+            {'zone_id': 1, 'name': 'Zone', 'boiler_relay': '0x1',
+             'sensor_id': 1, 'pwm_period': 900}])
+        zc.reload()
+    assert zc.zone_controllers[0] is not zone
+    assert zc.zone_controllers[0].zone.pwm_period == 900
+    assert factory.relays['0x1'].zones == [zc.zone_controllers[0].boiler]
+    factory.mqttc.publish.assert_not_called()
+
 #
 # Scheduler policy tests
 #
@@ -152,3 +291,19 @@ def test_scheduler_from_json_empty_schedule():
     """Check policy creation from JSON with empty schedule."""
     scheduler.SchedulerTemperaturePolicy.from_json(
         EMPTY_SCHEDULE_RESPONSE)
+
+def test_next_change_wraps_to_next_week():
+    schedule = scheduler.SchedulerTemperaturePolicy(
+        model.FullSchedule([
+            (0, time(7, 0), 1, 20),
+            (0, time(22, 0), 1, 15),
+            (0, time(8, 0), 2, 18)]),
+        [])
+
+    monday_morning = datetime(2017, 1, 2, 6, 0)
+    monday_night = datetime(2017, 1, 2, 23, 0)
+    assert schedule.next_change(monday_morning, 1) == \
+        (datetime(2017, 1, 2, 7, 0), 20)
+    assert schedule.next_change(monday_night, 1) == \
+        (datetime(2017, 1, 9, 7, 0), 20)
+    assert schedule.next_change(monday_night, 3) is None
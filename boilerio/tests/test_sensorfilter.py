@@ -0,0 +1,89 @@
+import configparser
+import datetime
+
+import pytest
+
+from .. import sensorfilter
+from ..tempsensor import SensorReading
+
+WHEN = datetime.datetime(2000, 1, 1)
+
+
+def reading(temperature, received, humidity=50.0):
+    return SensorReading(WHEN, temperature, humidity, received)
+
+
+def run(f, temperatures, interval=60):
+    """The temperatures passed on by filter f."""
+    last = None
+    passed = []
+    for i, t in enumerate(temperatures):
+        result = f(reading(t, i * interval), last)
+        if result is not None:
+            last = result
+            passed.append(result.temperature)
+    return passed
+
+
+def test_deadband_suppresses_noise():
+    f = sensorfilter.Deadband(0.1)
+    assert run(f, [20.0, 20.05, 19.95, 20.08, 20.15, 20.3]) == [
+        20.0, 20.15, 20.3]
+
+
+def test_deadband_passes_humidity_changes():
+    f = sensorfilter.Deadband(0.1, 1.0)
+    last = reading(20.0, 0)
+    assert f(reading(20.0, 60, humidity=50.5), last) is None
+    assert f(reading(20.0, 60, humidity=52), last) is not None
+
+
+def test_deadband_max_interval():
+    f = sensorfilter.Deadband(0.1, max_interval=300)
+    assert run(f, [20.0] * 11) == [20.0] * 3
+
+
+def test_hysteresis_suppresses_flicker_but_follows_trends():
+    f = sensorfilter.Hysteresis(0.05, 0.15)
+    assert run(f, [20.0, 20.1, 20.0, 20.1, 20.0, 20.2, 20.3, 20.2]) == [
+        20.0, 20.1, 20.2, 20.3]
+    # A large enough reversal is followed:
+    assert run(f, [20.0, 20.1, 19.9]) == [20.0, 20.1, 19.9]
+
+
+def test_rate_limit():
+    f = sensorfilter.RateLimit(120)
+    assert run(f, [1, 2, 3, 4, 5]) == [1, 3, 5]
+
+
+def test_smoothing_uses_elapsed_time():
+    f = sensorfilter.Smoothing(60)
+    assert f(reading(20.0, 0), None).temperature == 20.0
+    smoothed = f(reading(21.0, 60), None)
+    assert smoothed.temperature == pytest.approx(20.632, abs=1e-3)
+    assert smoothed.received == 60
+
+
+def test_from_config():
+    conf = configparser.RawConfigParser()
+    conf.read_string("""
+[sensors]
+deadband = 0.1
+min_interval = 60
+
+[sensor 2]
+smoothing = 120
+hysteresis = 0.2
+""")
+    default = sensorfilter.from_config(conf, 1)
+    assert [type(f) for f in default] == [sensorfilter.Deadband,
+                                          sensorfilter.RateLimit]
+    assert default[0].temperature == 0.1
+    custom = sensorfilter.from_config(conf, 2)
+    assert [type(f) for f in custom] == [sensorfilter.Smoothing,
+                                         sensorfilter.Hysteresis,
+                                         sensorfilter.RateLimit]
+    assert custom[1].reverse == 0.2
+    # Nothing configured: only unchanged readings are suppressed.
+    empty = sensorfilter.from_config(configparser.RawConfigParser(), 1)
+    assert run(empty[0], [20.0, 20.0, 20.01]) == [20.0, 20.01]
@@ -0,0 +1,84 @@
+import random
+
+import pytest
+
+from .. import sensorhealth
+from ..clock import VirtualClock
+from ..tempsensor import EmonTHSensor, SensorReading
+
+
+def test_expiry_heap_orders_moved_and_removed_keys():
+    rng = random.Random(1)
+    heap = sensorhealth._ExpiryHeap()
+    deadlines = {}
+    for _ in range(1000):
+        key = rng.randrange(50)
+        if rng.random() < 0.1:
+            heap.discard(key)
+            deadlines.pop(key, None)
+        else:
+            deadlines[key] = rng.random()
+            heap.set(key, deadlines[key])
+    assert len(heap) == len(deadlines)
+    popped = [heap.pop() for _ in range(len(heap))]
+    assert popped == sorted((d, k) for k, d in deadlines.items())
+
+
+def reading(clock, battery=None):
+    return SensorReading(clock.now(), 20.0, 50.0, clock.monotonic(), battery)
+
+
+def test_callbacks_only_on_transitions():
+    clock = VirtualClock()
+    registry = sensorhealth.SensorHealthRegistry(600, clock)
+    events = []
+    registry.add_callback(lambda h: events.append((h.sensor_id, h.stale)))
+    registry.add(1)
+    registry.add(2)
+
+    for _ in range(20):
+        clock.advance(60)
+        registry.seen(1, reading(clock))
+        registry.check()
+    # Sensor 2 was never heard from:
+    assert events == [(2, True)]
+
+    clock.advance(601)
+    registry.check()
+    registry.check()
+    assert events == [(2, True), (1, True)]
+
+    registry.seen(1, reading(clock))
+    registry.seen(1, reading(clock))
+    assert events == [(2, True), (1, True), (1, False)]
+    assert not registry[1].stale and registry[2].stale
+
+
+def test_rate_jitter_and_battery():
+    clock = VirtualClock()
+    registry = sensorhealth.SensorHealthRegistry(clock=clock)
+    for i in range(100):
+        clock.advance(50 if i % 2 else 70)
+        registry.seen(1, reading(clock, battery=3.0 - i / 1000))
+    health = registry[1]
+    assert health.messages == 100
+    assert health.message_rate == pytest.approx(60, rel=0.05)
+    assert health.jitter == pytest.approx(10, rel=0.1)
+    assert health.battery_voltage == pytest.approx(2.901)
+    assert health.as_dict()['last_seen'] == clock.now().strftime(
+        "%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def test_sensor_reports_every_reading():
+    clock = VirtualClock()
+    registry = sensorhealth.SensorHealthRegistry(clock=clock)
+    sensor = EmonTHSensor(1, 'emon/emonth1', clock, health=registry)
+    for _ in range(3):
+        sensor.handle_message(sensor.locator, {
+            'temperature': 20.0, 'humidity': 50.0, 'battery': 3.1})
+        clock.advance(60)
+    sensor.process_readings()
+    # Unchanged readings aren't passed on, but are still counted:
+    assert registry[1].messages == 3
+    assert registry[1].battery_voltage == 3.1
+    assert sensor.reading.battery_voltage == 3.1
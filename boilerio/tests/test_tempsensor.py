@@ -1,6 +1,8 @@
 """Tests for the tempsensor module."""
 
+from .. import sensorfilter
 from .. import tempsensor
+from ..clock import VirtualClock
 from unittest import mock
 
 
@@ -21,7 +23,10 @@ def test_callback_with_correct_temperature():
     # When: Simulate MQTT callback:
     ts._temp_callback(None, None, msg)
 
-    # Then:
+    # Then: nothing changes until the readings are processed:
+    cb.assert_not_called()
+    assert ts.reading is None
+    ts.process_readings()
     cb.assert_called_with(ts)
     assert ts.reading.temperature == 12.5
     assert ts.reading.relative_humidity == 60.0
@@ -31,7 +36,7 @@ def test_failed_callback_doesnt_cause_leaked_exception():
     # Given
     msg = mock.MagicMock()
     msg.topic = LOCATOR
-    msg.payload = '{"temperature": 12.5}'
+    msg.payload = '{"temperature": 12.5, "humidity": 60.0}'
 
     ts = tempsensor.EmonTHSensor(SENSOR_ID, LOCATOR)
     cb = mock.MagicMock(side_effect=RuntimeError())
@@ -39,6 +44,7 @@ def test_failed_callback_doesnt_cause_leaked_exception():
 
     # When/Then: simulate MQTT callback - this should not raise:
     ts._temp_callback(None, None, msg)
+    ts.process_readings()
 
     cb.assert_called_with(ts)
 
@@ -47,7 +53,7 @@ def test_all_callbacks_run_even_if_one_fails():
     # Given
     msg = mock.MagicMock()
     msg.topic = LOCATOR
-    msg.payload = '{"temperature": 12.5}'
+    msg.payload = '{"temperature": 12.5, "humidity": 60.0}'
 
     ts = tempsensor.EmonTHSensor(SENSOR_ID, LOCATOR)
     cb = mock.MagicMock(side_effect=RuntimeError())
@@ -57,6 +63,38 @@ def test_all_callbacks_run_even_if_one_fails():
 
     # When/Then: simulate MQTT callback - this should not raise:
     ts._temp_callback(None, None, msg)
+    ts.process_readings()
 
     cb.assert_called_once()
-    cb2.assert_called_once()
\ No newline at end of file
+    cb2.assert_called_once()
+
+def test_burst_of_readings_is_processed_in_order():
+    ts = tempsensor.EmonTHSensor(SENSOR_ID, LOCATOR)
+    seen = []
+    ts.add_callback(lambda s: seen.append(s.reading.temperature))
+    for temp in (12.0, 12.5, 12.5, 13.0):
+        msg = mock.MagicMock()
+        msg.topic = LOCATOR
+        msg.payload = '{"temperature": %s, "humidity": 60.0}' % temp
+        ts._temp_callback(None, None, msg)
+
+    ts.process_readings()
+
+    # Repeated values are ignored:
+    assert seen == [12.0, 12.5, 13.0]
+
+def test_filtered_readings_keep_the_reading_fresh():
+    clock = VirtualClock()
+    ts = tempsensor.EmonTHSensor(SENSOR_ID, LOCATOR, clock,
+                                 filters=[sensorfilter.Deadband(0.1)])
+    cb = mock.Mock()
+    ts.add_callback(cb)
+    for temp in (20.0, 20.05, 19.95):
+        ts.handle_message(LOCATOR, {'temperature': temp, 'humidity': 60.0})
+        ts.process_readings()
+        clock.advance(60)
+
+    # Only the first is passed on, but the reading was received recently:
+    cb.assert_called_once_with(ts)
+    assert ts.reading.temperature == 20.0
+    assert ts.reading.received == clock.monotonic() - 60
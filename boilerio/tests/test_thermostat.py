@@ -1,5 +1,5 @@
-import datetime
 import pytest
+from ..clock import VirtualClock
 from ..thermostat import Thermostat
 from ..tempsensor import SensorReading
 
@@ -28,39 +28,58 @@ def sensor():
 def boiler():
     yield FakeBoiler()
 
+@pytest.fixture
+def clock():
+    yield VirtualClock(monotonic=100000)
+
 @pytest.fixture
 def thermostat(boiler, sensor):
     yield Thermostat(boiler, sensor)
 
-def test_start_off_if_above_temperature(thermostat, boiler, sensor):
-    now = datetime.datetime.now()
-    temp_reading = SensorReading(now, 20, 60)
+def reading_at(clock, temp):
+    return SensorReading(clock.now(), temp, 60, clock.monotonic())
+
+def test_start_off_if_above_temperature(thermostat, boiler, sensor, clock):
+    now = clock.monotonic()
+    temp_reading = reading_at(clock, 20)
     sensor.set_temp(temp_reading)
     thermostat.set_target_temperature(15)
     thermostat.interval_elapsed(now)
     assert boiler.last_command == 'X'
 
-def test_start_on_if_below_temperature(thermostat, boiler, sensor):
-    now = datetime.datetime.now()
-    temp_reading = SensorReading(now, 15, 60)
+def test_start_on_if_below_temperature(thermostat, boiler, sensor, clock):
+    now = clock.monotonic()
+    temp_reading = reading_at(clock, 15)
     sensor.set_temp(temp_reading)
     thermostat.set_target_temperature(20)
     thermostat.interval_elapsed(now)
     assert boiler.last_command == 'O'
 
-def test_start_pwn_if_at_temperature(thermostat, boiler, sensor):
-    now = datetime.datetime.now()
-    temp_reading = SensorReading(now, 20, 60)
+def test_start_pwn_if_at_temperature(thermostat, boiler, sensor, clock):
+    now = clock.monotonic()
+    temp_reading = reading_at(clock, 20)
     sensor.set_temp(temp_reading)
     thermostat.set_target_temperature(20)
     thermostat.interval_elapsed(now)
     # not ideal:
     assert thermostat._measurement_begin == now
 
-def test_stale_temperature(thermostat, boiler, sensor):
-    now = datetime.datetime.now()
-    temp_reading = SensorReading(now - datetime.timedelta(0, 60 * 60), 15, 60)
+def test_stale_temperature(thermostat, boiler, sensor, clock):
+    temp_reading = reading_at(clock, 15)
+    clock.advance(60 * 60)
     sensor.set_temp(temp_reading)
     thermostat.set_target_temperature(20)
-    thermostat.interval_elapsed(now)
+    thermostat.interval_elapsed(clock.monotonic())
     assert boiler.last_command == 'X'
+
+def test_state_change_callback_only_fires_on_change(boiler, sensor, clock):
+    changes = []
+    thermostat = Thermostat(boiler, sensor,
+                            lambda mode, dutycycle: changes.append(
+                                (mode, dutycycle)))
+    sensor.set_temp(reading_at(clock, 15))
+    thermostat.set_target_temperature(20)
+    for _ in range(5):
+        clock.advance(1)
+        thermostat.interval_elapsed(clock.monotonic())
+    assert changes == [(Thermostat.MODE_ON, 1)]
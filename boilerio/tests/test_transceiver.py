@@ -0,0 +1,123 @@
+import os
+import pty
+import time
+
+import pytest
+import serial
+
+from .. import transceiver
+from ..clock import VirtualClock
+from ..commandqueue import CommandQueue
+
+
+def test_line_reader_reassembles_lines():
+    reader = transceiver.LineReader()
+    assert reader.feed(b'ISSUE 0x1') == []
+    assert reader.partial
+    assert reader.feed(b'A ON\r\nRECV 0x2 OFF\nRE') == [
+        'ISSUE 0x1A ON', 'RECV 0x2 OFF']
+    assert reader.feed(b'CV 0x3 ON\n') == ['RECV 0x3 ON']
+    assert not reader.partial
+
+
+def test_line_reader_discards_runaway_input():
+    reader = transceiver.LineReader()
+    reader.feed(b'x' * (reader.MAX_LINE + 1))
+    assert not reader.partial
+
+
+def test_parse_line():
+    assert transceiver.parse_line('ISSUE 0xBAB1 ON') == (
+        'ISSUE', '0xBAB1', 'ON')
+    for line in ('ISSUE 0x1', 'SEND 0x1 ON', 'RECV 0x1 TOGGLE'):
+        with pytest.raises(ValueError):
+            transceiver.parse_line(line)
+
+
+@pytest.fixture
+def device():
+    """A Transceiver on a pty, with the master end standing in for the
+    hardware."""
+    master, slave = pty.openpty()
+    port = serial.Serial(os.ttyname(slave), 57600, timeout=0)
+    clock = VirtualClock()
+    commands = CommandQueue(clock=clock)
+    reports = []
+    t = transceiver.Transceiver(port, commands,
+                                lambda *report: reports.append(report), clock)
+    yield t, master, commands, reports, clock
+    t.close()
+    port.close()
+    os.close(master)
+    os.close(slave)
+
+
+def read_commands(master):
+    time.sleep(0.01)
+    return os.read(master, 1024).decode().split()
+
+
+def test_commands_wait_for_acknowledgement(device):
+    t, master, commands, reports, clock = device
+    commands.put({'command': 'O', 'thermostat': '0xbab1'})
+    commands.put({'command': 'X', 'thermostat': '0x2'})
+    t.poll(0)
+    assert read_commands(master) == ['O0xbab1']
+
+    # The second is sent as soon as the first is acknowledged:
+    clock.advance(0.1)
+    os.write(master, b'ISSUE 0xBAB1 ON\r\n')
+    t.poll(1)
+    assert reports == [('ISSUE', '0xBAB1', 'ON')]
+    assert read_commands(master) == ['X0x2']
+    assert t.stats.acked == 1
+    assert t.stats.ack_latency_max == pytest.approx(0.1)
+
+
+def test_queued_command_wakes_poll(device):
+    t, master, commands, reports, clock = device
+    begin = time.monotonic()
+    commands.put({'command': 'O', 'thermostat': '0x1'})
+    t.poll(5)
+    t.poll(0)
+    assert time.monotonic() - begin < 1
+    assert read_commands(master) == ['O0x1']
+
+
+def test_partial_line_holds_writes(device):
+    t, master, commands, reports, clock = device
+    os.write(master, b'RECV 0x5 O')
+    t.poll(1)
+    commands.put({'command': 'O', 'thermostat': '0x1'})
+    t.poll(0)
+    os.write(master, b'N\n')
+    t.poll(1)
+    assert reports == [('RECV', '0x5', 'ON')]
+    assert read_commands(master) == ['O0x1']
+
+
+def test_unacknowledged_command_is_retried_once(device):
+    t, master, commands, reports, clock = device
+    commands.put({'command': 'O', 'thermostat': '0x1'})
+    t.poll(0)
+    for _ in range(3):
+        clock.advance(t.ACK_TIMEOUT)
+        t.poll(0)
+    assert read_commands(master) == ['O0x1', 'O0x1']
+    assert t.stats.timeouts == 2
+    assert len(commands) == 0
+
+
+def test_new_command_gets_its_own_retries(device):
+    t, master, commands, reports, clock = device
+    commands.put({'command': 'O', 'thermostat': '0x1'})
+    t.poll(0)
+    clock.advance(t.ACK_TIMEOUT)
+    t._expire()
+    # The retry is replaced by a new command before it's sent:
+    commands.put({'command': 'X', 'thermostat': '0x1'})
+    for _ in range(3):
+        t.poll(0)
+        clock.advance(t.ACK_TIMEOUT)
+    assert read_commands(master) == ['O0x1', 'X0x1', 'X0x1']
+    assert len(commands) == 0
@@ -1,5 +1,7 @@
 from ..update_sensor import TempSensorUpdater
 from ..tempsensor import SensorReading
+from ..sensorhealth import SensorHealthRegistry
+from ..clock import VirtualClock
 from unittest.mock import MagicMock
 from datetime import datetime
 import requests_mock
@@ -13,8 +15,12 @@ class MockSensor:
     def add_callback(self, callback):
         self.callback = callback
 
+    def remove_callback(self, callback):
+        if self.callback == callback:
+            self.callback = None
+
     def update(self, when, temp, humidity):
-        self.reading = SensorReading(when, temp, humidity)
+        self.reading = SensorReading(when, temp, humidity, 0.0)
         self.callback(self)
 
 def test_adding_sensor_register_a_callback():
@@ -38,6 +44,7 @@ def test_sensor_update_causes_updates_to_be_published():
     with requests_mock.Mocker() as m:
         m.post('http://foo/sensor/1/readings', status_code=200)
         sensor.update(datetime.now(), 15.0, 50.0)
+        updater.post_pending()
 
         # Then: the update is posted to the backend
         assert m.call_count == 2
@@ -52,6 +59,76 @@ def test_sensor_update_doesnt_leak_exception_on_failed_post():
     with requests_mock.Mocker() as m:
         m.post('http://foo/sensor/1/readings', status_code=401)
         sensor.update(datetime.now(), 15.0, 50.0)
+        updater.post_pending()
 
         # Then: the update is posted to the backend
-        assert m.called
\ No newline at end of file
+        assert m.called
+
+def test_battery_voltage_posted_when_it_changes():
+    updater = TempSensorUpdater('http://foo', None)
+    sensor = MockSensor()
+    updater.add_sensor(sensor)
+
+    with requests_mock.Mocker() as m:
+        m.post('http://foo/sensor/1/readings', status_code=200)
+        for battery in (3.1, 3.08, 3.0):
+            sensor.reading = SensorReading(datetime.now(), 15.0, 50.0, 0.0,
+                                           battery)
+            sensor.callback(sensor)
+        updater.post_pending()
+
+        metrics = [r.json()['metric_type'] for r in m.request_history]
+        assert metrics.count('battery_voltage') == 2
+        assert len(metrics) == 8
+
+
+def test_health_posted_on_transitions_and_with_readings():
+    clock = VirtualClock()
+    registry = SensorHealthRegistry(600, clock)
+    registry.add(1)
+    updater = TempSensorUpdater('http://foo', None, clock)
+    updater.add_health(registry)
+    sensor = MockSensor()
+    updater.add_sensor(sensor)
+
+    with requests_mock.Mocker() as m:
+        m.post('http://foo/sensor/1/readings', status_code=200)
+        health = m.post('http://foo/sensor/1/health', status_code=200)
+        for _ in range(10):
+            clock.advance(60)
+            sensor.update(datetime.now(), 15.0, 50.0)
+        # Only every HEALTH_REPORT_INTERVAL:
+        updater.post_pending()
+        assert health.call_count == 2
+
+        clock.advance(601)
+        registry.check()
+        updater.post_pending()
+        assert health.call_count == 3
+        assert health.last_request.json()['stale'] is True
+
+
+def test_untracked_and_removed_sensors():
+    clock = VirtualClock()
+    registry = SensorHealthRegistry(600, clock)
+    updater = TempSensorUpdater('http://foo', None, clock)
+    updater.add_health(registry)
+    sensor = MockSensor()
+    updater.add_sensor(sensor)
+
+    with requests_mock.Mocker() as m:
+        m.post('http://foo/sensor/1/readings', status_code=200)
+        health = m.post('http://foo/sensor/1/health', status_code=200)
+        # The registry isn't tracking the sensor, so only readings are
+        # posted:
+        sensor.reading = SensorReading(datetime.now(), 15.0, 50.0, 0.0, 3.0)
+        sensor.callback(sensor)
+        updater.post_pending()
+        assert m.call_count == 3
+        assert health.call_count == 0
+
+    assert updater._battery_posted == {1: 3.0}
+    updater.remove_sensor(sensor)
+    assert sensor.callback is None
+    assert 1 not in updater._battery_posted
+    assert 1 not in updater._health_posted
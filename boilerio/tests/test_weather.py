@@ -1,11 +1,18 @@
 import requests_mock
 import requests.exceptions
 import pytest
-import datetime
+import configparser
+import fcntl
+import http.server
 import json
-from datetime import timedelta
+import threading
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest.mock import MagicMock
 
+from .. import tempsensor
 from .. import weather
+from ..clock import VirtualClock
 
 def test_simple_result():
     """Check that the weather info can be parsed."""
@@ -45,18 +52,21 @@ def test_caching_weather_actually_caches():
 
     with requests_mock.Mocker() as m:
         m.get(weather.WEATHER_API_ENDPOINT, text=sample_good_output)
-        caching_weather = weather.CachingWeather('apikey', 'Girton,GB', timedelta(hours=1))
-        now = datetime.datetime.now()
+        clock = VirtualClock()
+        caching_weather = weather.CachingWeather(
+            'apikey', 'Girton,GB', timedelta(hours=1), clock=clock)
 
         # Two requests within the cachign interval should return the same value, even if the online
         # content has changed:
-        caching_weather.get_weather(now_fn=lambda: (now))
+        caching_weather.get_weather()
         m.get(weather.WEATHER_API_ENDPOINT, text=sample_good_output2)
-        r2 = caching_weather.get_weather(now_fn=lambda: (now + timedelta(minutes=1)))
+        clock.advance(60)
+        r2 = caching_weather.get_weather()
         assert r2 == sample_good_rv
 
         # Outside the caching interval, the new value should be returned:
-        r3 = caching_weather.get_weather(now_fn=lambda: (now + timedelta(hours=2)))
+        clock.advance(2 * 3600)
+        r3 = caching_weather.get_weather()
         assert r3 == sample_good_rv2
 
 
@@ -72,3 +82,299 @@ class TestErrorCases(object):
                 weather.get_weather('apikey', 'Girton,GB')
             with pytest.raises(weather.WeatherServiceError):
                 weather.Weather('apikey', 'Girton,GB').get_weather()
+
+
+def owm_response(temp):
+    return json.dumps({'main': {'temp': temp, 'humidity': 76},
+                       'sys': {'sunrise': 1546243745, 'sunset': 1546271815}})
+
+
+class TestSharedCachingWeather(object):
+    def make(self, path, clock):
+        return weather.SharedCachingWeather(
+            'apikey', 'Girton,GB', str(path), timedelta(minutes=20), clock)
+
+    def get_weather(self, w):
+        """Get the weather and wait for any refresh it started."""
+        result = w.get_weather()
+        if w._refresh_thread is not None:
+            w._refresh_thread.join()
+        return result
+
+    def test_shared_between_instances(self, tmp_path):
+        clock = VirtualClock()
+        with requests_mock.Mocker() as m:
+            m.get(weather.WEATHER_API_ENDPOINT, text=owm_response(5.0))
+            # Nothing cached at first; fetched in the background:
+            w = self.make(tmp_path / 'w', clock)
+            self.get_weather(w)
+            assert w.get_weather()['temperature'] == 5.0
+
+            assert self.make(tmp_path / 'w', clock).get_weather()[
+                'temperature'] == 5.0
+            assert m.call_count == 1
+
+    def test_stale_while_revalidate(self, tmp_path):
+        clock = VirtualClock()
+        with requests_mock.Mocker() as m:
+            m.get(weather.WEATHER_API_ENDPOINT, text=owm_response(5.0))
+            w = self.make(tmp_path / 'w', clock)
+            self.get_weather(w)
+
+            # Once stale, the cached value is returned while it's refreshed:
+            fetching = threading.Event()
+
+            def slow_response(request, context):
+                fetching.wait(5)
+                return owm_response(7.0)
+
+            m.get(weather.WEATHER_API_ENDPOINT, text=slow_response)
+            clock.advance(30 * 60)
+            assert w.get_weather()['temperature'] == 5.0
+            fetching.set()
+            w._refresh_thread.join()
+            assert w.get_weather()['temperature'] == 7.0
+            assert m.call_count == 2
+
+    def test_only_one_process_refreshes(self, tmp_path):
+        clock = VirtualClock()
+        with requests_mock.Mocker() as m:
+            m.get(weather.WEATHER_API_ENDPOINT, text=owm_response(5.0))
+            w = self.make(tmp_path / 'w', clock)
+            self.get_weather(w)
+            clock.advance(30 * 60)
+            with open(str(tmp_path / 'w') + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                w._refresh()
+            assert m.call_count == 1
+
+    def test_unusable_cache_directory(self, tmp_path):
+        clock = VirtualClock()
+        with requests_mock.Mocker() as m:
+            m.get(weather.WEATHER_API_ENDPOINT, text=owm_response(5.0))
+            # Fetched and cached in memory:
+            w = self.make(tmp_path / 'missing' / 'w', clock)
+            self.get_weather(w)
+            assert w.get_weather()['temperature'] == 5.0
+            clock.advance(w.RELOAD_INTERVAL)
+            assert self.get_weather(w)['temperature'] == 5.0
+            assert m.call_count == 1
+
+            clock.advance(30 * 60)
+            m.get(weather.WEATHER_API_ENDPOINT, text=owm_response(7.0))
+            self.get_weather(w)
+            assert w.get_weather()['temperature'] == 7.0
+
+    def test_failures_back_off_and_keep_last_value(self, tmp_path):
+        clock = VirtualClock()
+        with requests_mock.Mocker() as m:
+            m.get(weather.WEATHER_API_ENDPOINT, text=owm_response(5.0))
+            self.get_weather(self.make(tmp_path / 'w', clock))
+
+            # A restarted process uses the last value while the service is
+            # down, and stops trying after repeated failures:
+            m.get(weather.WEATHER_API_ENDPOINT,
+                  exc=requests.exceptions.ConnectTimeout)
+            clock.advance(30 * 60)
+            w = self.make(tmp_path / 'w', clock)
+            for _ in range(10):
+                assert self.get_weather(w)['temperature'] == 5.0
+                clock.advance(w.RELOAD_INTERVAL)
+            # Three failures open the breaker for a minute, then one retry:
+            assert m.call_count == 1 + 4
+
+
+def test_circuit_breaker_backs_off_exponentially():
+    clock = VirtualClock()
+    breaker = weather.CircuitBreaker(failure_threshold=2, base_delay=60,
+                                     clock=clock)
+    breaker.failed()
+    assert breaker.allow()
+    breaker.failed()
+    assert not breaker.allow()
+    clock.advance(60)
+    assert breaker.allow()
+    breaker.failed()
+    clock.advance(60)
+    assert not breaker.allow()
+    clock.advance(60)
+    assert breaker.allow()
+    breaker.succeeded()
+    breaker.failed()
+    assert breaker.allow()
+
+
+class FailingWeather(object):
+    def __init__(self):
+        self.calls = 0
+
+    def get_weather(self):
+        self.calls += 1
+        raise requests.exceptions.ConnectionError()
+
+
+def test_weather_chain_falls_back():
+    clock = VirtualClock()
+    failing = FailingWeather()
+    fallback = MagicMock()
+    fallback.get_weather.return_value = {'temperature': 3.0}
+    chain = weather.WeatherChain([failing, fallback], clock)
+    for _ in range(10):
+        assert chain.get_weather() == {'temperature': 3.0}
+    assert failing.calls == 3
+
+    # With no provider available the last result is used:
+    fallback.get_weather.return_value = None
+    assert chain.get_weather() == {'temperature': 3.0}
+
+
+class ForecastStandIn(object):
+    """A local HTTP server standing in for the forecast API."""
+
+    def __init__(self, body):
+        responses = self.requests = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                responses.append(self.path)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(body.encode())
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      Handler)
+        self.endpoint = 'http://127.0.0.1:%d/forecast' % \
+            self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def refreshed(forecast):
+    """Start any forecast refresh that's due and wait for it."""
+    forecast.forecast()
+    if forecast._refresh_thread is not None:
+        forecast._refresh_thread.join()
+
+
+def test_forecast_interpolates_timeline():
+    clock = VirtualClock(start=datetime(2020, 1, 1, 12, 0))
+    t0 = clock.now().timestamp()
+    stand_in = ForecastStandIn(json.dumps({'list': [
+        {'dt': int(t0) + 3 * 3600, 'main': {'temp': 8.0}},
+        {'dt': int(t0), 'main': {'temp': 2.0}},
+        ]}))
+    try:
+        forecast = weather.Forecast('apikey', 'Girton,GB', stand_in.endpoint,
+                                    refresh_interval=timedelta(hours=6),
+                                    clock=clock)
+        refreshed(forecast)
+        assert forecast.get_weather() == {'temperature': 2.0}
+        assert forecast.temperature_at(
+            datetime(2020, 1, 1, 13, 30)) == pytest.approx(5.0)
+        assert forecast.temperature_at(datetime(2020, 1, 2)) == 8.0
+
+        # Only refreshed once refresh_interval has passed:
+        clock.advance(5 * 3600)
+        refreshed(forecast)
+        assert len(stand_in.requests) == 1
+        clock.advance(3600)
+        refreshed(forecast)
+        assert len(stand_in.requests) == 2
+        assert 'q=Girton%2CGB' in stand_in.requests[0]
+    finally:
+        stand_in.close()
+
+
+def test_forecast_is_fetched_in_the_background():
+    clock = VirtualClock()
+    with requests_mock.Mocker() as m:
+        fetching = threading.Event()
+
+        def slow_response(request, context):
+            fetching.wait(5)
+            return json.dumps({'hourly': [{'dt': 0, 'temp': 4.0}]})
+
+        m.get(weather.FORECAST_API_ENDPOINT, text=slow_response)
+        forecast = weather.Forecast('apikey', 'Girton,GB', clock=clock)
+        # Unknown until the first forecast arrives, without waiting for it:
+        assert forecast.get_weather() is None
+        assert forecast.get_weather() is None
+        fetching.set()
+        forecast._refresh_thread.join()
+        assert forecast.get_weather() == {'temperature': 4.0}
+        assert m.call_count == 1
+
+
+def test_forecast_keeps_last_timeline_on_error():
+    clock = VirtualClock()
+    with requests_mock.Mocker() as m:
+        m.get(weather.FORECAST_API_ENDPOINT, json={'hourly': [
+            {'dt': 0, 'temp': 4.0}]})
+        forecast = weather.Forecast('apikey', 'Girton,GB', clock=clock)
+        refreshed(forecast)
+        assert forecast.get_weather() == {'temperature': 4.0}
+
+        m.get(weather.FORECAST_API_ENDPOINT, exc=requests.exceptions.Timeout)
+        clock.advance(7 * 3600)
+        refreshed(forecast)
+        assert forecast.get_weather() == {'temperature': 4.0}
+
+        # Retried after 15 minutes, then backing off:
+        for _ in range(4):
+            clock.advance(15 * 60)
+            refreshed(forecast)
+        assert m.call_count == 1 + 3
+
+
+def test_forecast_from_config_uses_coordinates():
+    conf = configparser.ConfigParser()
+    conf.read_dict({'weather': {
+        'forecast': 'true', 'apikey': 'apikey',
+        'forecast_endpoint': 'https://example.com/onecall',
+        'lat': '52.24', 'lon': '0.08'}})
+    forecast = weather.forecast_from_config(conf, VirtualClock())
+    with requests_mock.Mocker() as m:
+        m.get('https://example.com/onecall', json={'hourly': [
+            {'dt': 0, 'temp': 4.0}]})
+        refreshed(forecast)
+        assert m.last_request.qs == {'lat': ['52.24'], 'lon': ['0.08'],
+                                     'apikey': ['apikey'],
+                                     'units': ['metric']}
+    assert forecast.get_weather() == {'temperature': 4.0}
+
+    conf.set('weather', 'forecast', 'false')
+    assert weather.forecast_from_config(conf) is None
+
+
+def test_outdoor_sensor_weather():
+    clock = VirtualClock()
+    sensor = tempsensor.EmonTHSensor(0, 'emon/outside', clock)
+    w = weather.SensorWeather(sensor, max_age=600, clock=clock)
+    assert w.get_weather() is None
+
+    sensor._temp_callback(None, None, SimpleNamespace(
+        topic='emon/outside',
+        payload=json.dumps({'temperature': 4.5, 'humidity': 80})))
+    assert w.get_weather()['temperature'] == 4.5
+    clock.advance(601)
+    assert w.get_weather() is None
+
+
+def test_weather_from_config():
+    conf = configparser.ConfigParser()
+    conf.read_dict({'weather': {
+        'providers': 'sensor, openweathermap',
+        'outdoor_sensor': 'emon/outside',
+        'apikey': 'apikey', 'location': 'Girton,GB'}})
+    chain, sensors = weather.from_config(conf)
+    assert [s.locator for s in sensors] == ['emon/outside']
+    assert [type(p) for p, _ in chain.providers] == [
+        weather.SensorWeather, weather.SharedCachingWeather]
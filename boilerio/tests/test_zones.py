@@ -21,6 +21,7 @@ def test_time_to_target_returns_None_until_initialized():
             zone, boiler, sensor, thermostat, 'https://scheduler/api', None,
             weather
         )
+        zc.reported_state.current_outside_temp = 5
 
         # There is no gradient table or last recorded temperature:
         assert zc.get_time_to_target() is None
@@ -35,7 +36,102 @@ def test_time_to_target_returns_None_until_initialized():
         assert zc.get_time_to_target() is None
 
         # Now set a gradient table and check the correct value is used:
-        # XXX shouldn't be setting the gradient table directly...
         gradient_table = [{'delta': 5.0, 'gradient': 1.0}]
         zc.gradient_table = gradient_table
         assert zc.get_time_to_target() == timedelta(hours=5)
+
+def test_reported_state_only_flagged_on_change():
+    zone = MagicMock()
+    boiler = MagicMock()
+    thermostat = MagicMock()
+    zc = zones.ZoneController(
+        zone, boiler, MagicMock(), thermostat, 'https://scheduler/api',
+        None, MagicMock()
+    )
+    zc.do_update_state = False
+
+    zc.thermostat_state_callback('On', 1)
+    assert zc.do_update_state
+    boiler.set_dutycycle.assert_called_with(1)
+    assert zc.reported_state.to_dict()['state'] == 'On'
+
+    zc.do_update_state = False
+    zc.thermostat_state_callback('On', 1)
+    assert not zc.do_update_state
+
+def test_optimum_start_brings_forward_scheduled_increase():
+    zone = MagicMock()
+    zone.zone_id = 1
+    sensor = MagicMock()
+    sensor.reading.temperature = 16.0
+    zc = zones.ZoneController(
+        zone, MagicMock(), sensor, MagicMock(), 'https://scheduler/api', None,
+        MagicMock(), optimum_start=True
+    )
+    zc.gradient_table = [{'delta': 10.0, 'gradient': 2.0}]
+    zc.reported_state.current_outside_temp = 6.0
+
+    scheduler = MagicMock()
+    scheduler.target_overridden.return_value = False
+    scheduler.next_change.return_value = (datetime(2020, 1, 6, 7, 0), 20.0)
+
+    # Heating 16C -> 20C at 2C/hour takes 2 hours:
+    assert zc.optimum_start_target(
+        scheduler, datetime(2020, 1, 6, 4, 30), 15.0) == 15.0
+    assert zc.optimum_start_target(
+        scheduler, datetime(2020, 1, 6, 5, 30), 15.0) == 20.0
+
+def test_optimum_start_uses_forecast():
+    zone = MagicMock()
+    zone.zone_id = 1
+    sensor = MagicMock()
+    sensor.reading.temperature = 16.0
+    forecast = MagicMock()
+    # Colder later, so heating will be slower than now:
+    forecast.temperature_at.return_value = 0.0
+    zc = zones.ZoneController(
+        zone, MagicMock(), sensor, MagicMock(), 'https://scheduler/api', None,
+        MagicMock(), optimum_start=True, forecast=forecast
+    )
+    zc.gradient_table = [{'delta': 10.0, 'gradient': 2.0},
+                         {'delta': 20.0, 'gradient': 1.0}]
+    zc.reported_state.current_outside_temp = 6.0
+
+    scheduler = MagicMock()
+    scheduler.target_overridden.return_value = False
+    scheduler.next_change.return_value = (datetime(2020, 1, 6, 7, 0), 20.0)
+
+    # At 6C outside this would take two hours; at 0C it takes longer:
+    assert zc.optimum_start_target(
+        scheduler, datetime(2020, 1, 6, 4, 30), 15.0) == 20.0
+    forecast.temperature_at.assert_called_with(datetime(2020, 1, 6, 5, 45))
+
+def test_optimum_start_latches_once_preheating():
+    zone = MagicMock()
+    zone.zone_id = 1
+    sensor = MagicMock()
+    sensor.reading.temperature = 16.0
+    zc = zones.ZoneController(
+        zone, MagicMock(), sensor, MagicMock(), 'https://scheduler/api', None,
+        MagicMock(), optimum_start=True
+    )
+    zc.gradient_table = [{'delta': 10.0, 'gradient': 2.0}]
+    zc.reported_state.current_outside_temp = 6.0
+
+    scheduler = MagicMock()
+    scheduler.target_overridden.return_value = False
+    scheduler.next_change.return_value = (datetime(2020, 1, 6, 7, 0), 20.0)
+
+    assert zc.optimum_start_target(
+        scheduler, datetime(2020, 1, 6, 5, 30), 15.0) == 20.0
+    # The room warms, so the lead time is now shorter than the time left:
+    sensor.reading.temperature = 19.0
+    assert zc.optimum_start_target(
+        scheduler, datetime(2020, 1, 6, 5, 31), 15.0) == 20.0
+
+    # The schedule changes:
+    scheduler = MagicMock()
+    scheduler.target_overridden.return_value = False
+    scheduler.next_change.return_value = (datetime(2020, 1, 6, 8, 0), 20.0)
+    assert zc.optimum_start_target(
+        scheduler, datetime(2020, 1, 6, 5, 32), 15.0) == 15.0
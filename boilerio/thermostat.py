@@ -1,4 +1,3 @@
-import datetime
 import logging
 
 from boilerio import pid, pwm
@@ -8,9 +7,12 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 class TemperatureSetting(object):
+    __slots__ = ('_target', '_zone_min', '_zone_max')
+
     def __init__(self, target, zone_width=0.6):
         self._target = target
-        self._zone_width = zone_width
+        self._zone_min = target - zone_width / 2
+        self._zone_max = target + zone_width / 2
 
     @property
     def target(self):
@@ -18,20 +20,21 @@ class TemperatureSetting(object):
 
     @property
     def target_zone_min(self):
-        return self._target - self._zone_width / 2
+        return self._zone_min
 
     @property
     def target_zone_max(self):
-        return self._target + self._zone_width / 2
+        return self._zone_max
 
 class Thermostat(object):
     """A thermostat: turns boiler on/off based on temperature input."""
 
-    STALE_PERIOD = datetime.timedelta(0, 600)
+    # Periods are in seconds.
+    STALE_PERIOD = 600
 
     # The period of one on-off cycle when maintaining/monitoring the average
     # temperature.
-    PWM_PERIOD = datetime.timedelta(0, 600)
+    PWM_PERIOD = 600
 
     PID_KP = 2.8
     PID_KI = 0.3
@@ -42,33 +45,70 @@ class Thermostat(object):
     MODE_OFF = "Off"
     MODE_STALE = "Stale"
 
-    def __init__(self, boiler, sensor, state_change_callback=None):
+    # Thermostats are ticked once per second per zone, so avoid a per-instance
+    # __dict__ and keep the state in plain attributes that can be compared
+    # without building temporary objects.
+    __slots__ = ('_boiler', '_pid', '_pwm_control', '_pwm_period',
+                 '_state_change_callback', '_measurement_begin',
+                 '_measurement_end', '_sensor', '_target', '_mode',
+                 '_dutycycle', '_stale_reading', '_stale_after')
+
+    def __init__(self, boiler, sensor, state_change_callback=None,
+                 pid_kp=None, pid_ki=None, pid_kd=None, pwm_period=None,
+                 pwm_scheduler=None):
         """Initialise thermostat object.
 
-        boiler: an object with 'on' and 'off' methods"""
+        boiler: an object with 'on' and 'off' methods
+        pid_kp, pid_ki, pid_kd, pwm_period: per-zone controller parameters;
+            the class defaults are used for any left as None.
+        pwm_scheduler: a pwm.PWMScheduler to stagger this thermostat's PWM
+            cycles with others'."""
         self._boiler = boiler
-        self._pid = pid.PID(None, self.PID_KP, self.PID_KI, self.PID_KD)
-        self._pwm_control = pwm.PWM(0, self.PWM_PERIOD, boiler)
+        self._pid = pid.PID(
+            None,
+            self.PID_KP if pid_kp is None else pid_kp,
+            self.PID_KI if pid_ki is None else pid_ki,
+            self.PID_KD if pid_kd is None else pid_kd)
+        self._pwm_period = self.PWM_PERIOD if pwm_period is None else pwm_period
+        self._pwm_control = pwm.PWM(0, self._pwm_period, boiler)
+        if pwm_scheduler is not None:
+            pwm_scheduler.add(self._pwm_control)
         self._state_change_callback = state_change_callback
         self._measurement_begin = None
+        self._measurement_end = None
         self._sensor = sensor
         self._target = None
-        self._state = {'mode': self.MODE_STALE, 'dutycycle': 0}
+        self._mode = self.MODE_STALE
+        self._dutycycle = 0
+        # The reading the stale deadline below was computed for:
+        self._stale_reading = None
+        self._stale_after = None
 
     def _update_state(self, mode, dutycycle):
         """Updates local state and notifies observers if there was a change."""
         # Using word 'mode' here to avoid confusion
-        state = {'mode': mode, 'dutycycle': dutycycle}
-        if state != self._state:
-            logger.debug("%s: State change: %s -> %s",
-                         str(self), self._state, state)
-            self._state = state
+        if mode != self._mode or dutycycle != self._dutycycle:
+            logger.debug("%s: State change: %s/%s -> %s/%s", str(self),
+                         self._mode, self._dutycycle, mode, dutycycle)
+            self._mode = mode
+            self._dutycycle = dutycycle
             if self._state_change_callback is not None:
-                self._state_change_callback(state['mode'], state['dutycycle'])
+                self._state_change_callback(mode, dutycycle)
 
     def set_state_change_callback(self, state_change_callback):
         self._state_change_callback = state_change_callback
 
+    def set_sensor(self, sensor):
+        """Take readings from a different sensor, keeping the controller
+        state."""
+        self._sensor = sensor
+        self._stale_reading = None
+
+    @property
+    def pwm(self):
+        """The pwm.PWM used to maintain the target temperature."""
+        return self._pwm_control
+
     @property
     def target(self):
         return self._target.target if self._target else None
@@ -76,7 +116,7 @@ class Thermostat(object):
     @property
     def is_heating(self):
         """True when we're heating up to a temperature (not maintaining/off)."""
-        return self._state['mode'] == self.MODE_ON
+        return self._mode == self.MODE_ON
 
     def set_target_temperature(self, target):
         """Set a target temperature.
@@ -87,28 +127,42 @@ class Thermostat(object):
             self._target = TemperatureSetting(target)
             self._pid.reset(target)
 
+    def _reading_is_stale(self, reading, now):
+        # The deadline only changes when a new reading arrives, so compute it
+        # once per reading rather than doing datetime arithmetic every tick.
+        if reading is not self._stale_reading:
+            self._stale_reading = reading
+            self._stale_after = reading.received + self.STALE_PERIOD
+        return self._stale_after < now
+
     def interval_elapsed(self, now):
         """Act on time interval passing.
 
-        now: the current datetime"""
-        if (self._sensor.reading is None or self._target is None or
-                self._sensor.reading.when < (now - self.STALE_PERIOD)):
+        now: the current monotonic time in seconds (see boilerio.clock)"""
+        reading = self._sensor.reading
+        target = self._target
+        if (reading is None or target is None or
+                self._reading_is_stale(reading, now)):
             # Reading is stale: turn off the boiler:
             self._update_state(self.MODE_STALE, 0)
             self._boiler.off()
-        elif self._sensor.reading.temperature < self._target.target_zone_min:
+            return
+
+        temperature = reading.temperature
+        if temperature < target.target_zone_min:
             # Reading is valid and below target range:
             self._update_state(self.MODE_ON, 1)
             self._boiler.on()
-        elif (self._sensor.reading.temperature > self._target.target_zone_min and
-              self._sensor.reading.temperature <= self._target.target_zone_max):
+        elif (temperature > target.target_zone_min and
+              temperature <= target.target_zone_max):
             # Reading is valid and within the target range:
             # New measurement cycle?
             if (self._measurement_begin is None or
-                    self._measurement_begin + self.PWM_PERIOD < now):
+                    self._measurement_end < now):
                 self._measurement_begin = now
+                self._measurement_end = now + self._pwm_period
                 # Adjust duty cycle:
-                pid_output = self._pid.update(self._sensor.reading.temperature)
+                pid_output = self._pid.update(temperature)
                 self._pwm_control.setDutyCycle(pid_output)
 
                 logger.debug("PID output: %f", pid_output)
@@ -119,7 +173,7 @@ class Thermostat(object):
 
             self._update_state(self.MODE_PWM, self._pwm_control.dutycycle)
             self._pwm_control.update(now)
-        elif self._sensor.reading.temperature > self._target.target_zone_max:
+        elif temperature > target.target_zone_max:
             # Reading is valid and above the target range:
             self._update_state(self.MODE_OFF, 0)
             self._boiler.off()
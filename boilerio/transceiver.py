@@ -0,0 +1,254 @@
+"""Serial I/O with a Danfoss RF transceiver (see thermostat.git).
+
+Commands are written as '<O|X|L><thermostat>\\n'.  The transceiver reports
+what it transmits and hears as lines 'ISSUE <thermostat> <ON|OFF|LEARN>'
+and 'RECV <thermostat> <ON|OFF|LEARN>'; the ISSUE line for a command we
+wrote is its acknowledgement.
+
+Transceiver reads whatever bytes are waiting into a buffer, splits out the
+complete lines, and writes the next queued command as soon as the line is
+idle: no partial line is being received and the last command has been
+acknowledged (or given up on).  It waits in select() on both the serial
+port and a pipe that the command queue writes to when a command is added,
+so a new command is written straight away rather than after a read
+timeout.
+"""
+
+import fcntl
+import logging
+import os
+import select
+
+from .clock import SYSTEM_CLOCK
+
+logger = logging.getLogger(__name__)
+
+BANNER = "Danfoss thermostat transceiver"
+DIRECTIONS = ('ISSUE', 'RECV')
+# Commands written, and the names the transceiver reports them by:
+COMMAND_NAMES = {'O': 'ON', 'X': 'OFF', 'L': 'LEARN'}
+
+
+def parse_line(line):
+    """Parse a report from the transceiver.
+
+    Returns (direction, thermostat, command name), or raises ValueError."""
+    direction, tid, cmd = line.split()
+    if direction not in DIRECTIONS:
+        raise ValueError("Unknown direction {}".format(direction))
+    if cmd not in COMMAND_NAMES.values():
+        raise ValueError("Unknown command {}".format(cmd))
+    return direction, tid, cmd
+
+
+def thermostat_key(tid):
+    """A thermostat ID as an integer, however it was written."""
+    return int(tid, 16)
+
+
+class LineReader(object):
+    """Splits a byte stream into lines.
+
+    Bytes are buffered until a newline arrives.  A line longer than
+    MAX_LINE is discarded, so noise on the line can't grow the buffer
+    without limit."""
+
+    MAX_LINE = 256
+
+    __slots__ = ('_buffer',)
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    @property
+    def partial(self):
+        """True if part of a line has been received."""
+        return bool(self._buffer)
+
+    def feed(self, data):
+        """Add received bytes; returns the lines they complete."""
+        buffer = self._buffer
+        buffer += data
+        if b'\n' not in data:
+            if len(buffer) > self.MAX_LINE:
+                logger.error("Discarding %d bytes with no newline",
+                             len(buffer))
+                buffer.clear()
+            return []
+        *lines, rest = buffer.split(b'\n')
+        self._buffer = bytearray(rest)
+        return [line.decode('utf-8', 'replace').strip() for line in lines]
+
+
+class Transceiver(object):
+    """Sends queued commands to a transceiver and passes on its reports.
+
+    port: a serial port opened with timeout=0 (a pyserial Serial, or
+        anything with fileno(), in_waiting, read() and write()).
+    commands: the commandqueue.CommandQueue to send from.
+    on_report: called as on_report(direction, thermostat, command name) for
+        each report from the transceiver.
+    on_result: if given, called as on_result(request, acknowledged) when
+        each command written is acknowledged or times out.
+
+    A command not acknowledged within ACK_TIMEOUT seconds is put back on
+    the queue, unless a newer one for the same thermostat is waiting, up to
+    MAX_RETRIES times."""
+
+    ACK_TIMEOUT = 1.0
+    MAX_RETRIES = 1
+
+    def __init__(self, port, commands, on_report, clock=SYSTEM_CLOCK,
+                 on_result=None):
+        self._port = port
+        self._commands = commands
+        self._on_report = on_report
+        self._on_result = on_result
+        self._clock = clock
+        self._reader = LineReader()
+        # (request, thermostat key, command name, time sent):
+        self._in_flight = None
+        # Thermostat key -> (request being retried, retries so far):
+        self._retries = {}
+        self.stats = TransceiverStats()
+
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        commands.add_listener(self.wake)
+
+    def close(self):
+        self._commands.remove_listener(self.wake)
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    def wake(self):
+        """Interrupt a poll() that's waiting; safe from any thread."""
+        try:
+            os.write(self._wake_w, b'\0')
+        except BlockingIOError:
+            # Already woken.
+            pass
+
+    @property
+    def idle(self):
+        return self._in_flight is None and not self._reader.partial
+
+    def poll(self, timeout=None):
+        """Do one round of I/O, waiting up to timeout seconds for input.
+
+        Returns after handling whatever arrived, or on timeout."""
+        self._expire()
+        self._send_next()
+        if self._in_flight is not None:
+            deadline = self._in_flight[3] + self.ACK_TIMEOUT
+            wait = max(0, deadline - self._clock.monotonic())
+            timeout = wait if timeout is None else min(timeout, wait)
+
+        readable, _, _ = select.select([self._port, self._wake_r], [], [],
+                                       timeout)
+        if self._wake_r in readable:
+            try:
+                os.read(self._wake_r, 4096)
+            except BlockingIOError:
+                pass
+        if self._port in readable:
+            data = self._port.read(self._port.in_waiting or 1)
+            for line in self._reader.feed(data):
+                self._handle_line(line)
+        self._expire()
+        self._send_next()
+
+    def _send_next(self):
+        if not self.idle:
+            return
+        request = self._commands.pop()
+        if request is None:
+            return
+        key = thermostat_key(request['thermostat'])
+        retrying = self._retries.get(key)
+        if retrying is not None and retrying[0] is not request:
+            # A new command for the thermostat; it gets its own retries:
+            del self._retries[key]
+        self._port.write("{}{}\n".format(
+            request['command'], request['thermostat']).encode())
+        self._in_flight = (request, key, COMMAND_NAMES[request['command']],
+                           self._clock.monotonic())
+        self.stats.sent += 1
+        logger.debug("Pushed command %s", str(request))
+
+    def _expire(self):
+        in_flight = self._in_flight
+        if in_flight is None or (self._clock.monotonic() <
+                                 in_flight[3] + self.ACK_TIMEOUT):
+            return
+        self._in_flight = None
+        self.stats.timeouts += 1
+        request, key = in_flight[0], in_flight[1]
+        retrying = self._retries.get(key)
+        retries = retrying[1] if retrying is not None else 0
+        if retries < self.MAX_RETRIES and \
+                self._commands.put(request, replace=False):
+            self._retries[key] = (request, retries + 1)
+            logger.warning("No acknowledgement for %s; retrying", request)
+        else:
+            self._retries.pop(key, None)
+            logger.error("No acknowledgement for %s", request)
+        if self._on_result is not None:
+            self._on_result(request, False)
+
+    def _handle_line(self, line):
+        if not line:
+            return
+        if line == BANNER:
+            logger.info("Device welcome banner received: Operating normally")
+            return
+        try:
+            direction, tid, cmd = parse_line(line)
+            key = thermostat_key(tid)
+        except ValueError:
+            logger.error("Couldn't parse input: %s", line)
+            return
+
+        in_flight = self._in_flight
+        if (direction == 'ISSUE' and in_flight is not None and
+                key == in_flight[1] and cmd == in_flight[2]):
+            self._in_flight = None
+            self._retries.pop(key, None)
+            self.stats.add_ack(self._clock.monotonic() - in_flight[3])
+            if self._on_result is not None:
+                self._on_result(in_flight[0], True)
+
+        self._on_report(direction, tid, cmd)
+
+
+class TransceiverStats(object):
+    """Counters for a Transceiver.
+
+    Acknowledgement latency is from writing a command to its ISSUE echo."""
+
+    __slots__ = ('sent', 'acked', 'timeouts', 'ack_latency_total',
+                 'ack_latency_max')
+
+    def __init__(self):
+        self.sent = 0
+        self.acked = 0
+        self.timeouts = 0
+        self.ack_latency_total = 0.0
+        self.ack_latency_max = 0.0
+
+    def add_ack(self, latency):
+        self.acked += 1
+        self.ack_latency_total += latency
+        self.ack_latency_max = max(self.ack_latency_max, latency)
+
+    @property
+    def ack_latency_mean(self):
+        return self.ack_latency_total / self.acked if self.acked else None
+
+    def as_dict(self):
+        result = {name: getattr(self, name) for name in self.__slots__
+                  if name != 'ack_latency_total'}
+        result['ack_latency_mean'] = self.ack_latency_mean
+        return result
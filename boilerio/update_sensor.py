@@ -1,6 +1,10 @@
 import requests
 import logging
 import datetime
+import queue
+import threading
+
+from .clock import SYSTEM_CLOCK
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -8,15 +12,57 @@ logger.setLevel(logging.DEBUG)
 
 
 class TempSensorUpdater(object):
-    def __init__(self, api_url, auth):
+    """Posts sensor readings to the scheduler web service.
+
+    Sensor callbacks only queue the reading; the posts are made by a
+    background thread (see start()) so a slow server doesn't hold up the
+    caller.  If more than MAX_PENDING posts are waiting, new ones are
+    dropped.
+
+    Battery voltage is posted with a reading when it has changed by more
+    than BATTERY_DEADBAND since it was last posted.  With add_health(), each
+    sensor's health is posted when it goes stale or comes back, and with
+    its readings at most every HEALTH_REPORT_INTERVAL seconds."""
+
+    MAX_PENDING = 1000
+    BATTERY_DEADBAND = 0.05
+    HEALTH_REPORT_INTERVAL = 300
+
+    def __init__(self, api_url, auth, clock=SYSTEM_CLOCK):
         self.api_url = api_url
         self.auth = auth
+        self._clock = clock
+        self._pending = queue.Queue(self.MAX_PENDING)
+        self._battery_posted = {}
+        self._health = None
+        self._health_posted = {}
 
     def add_sensor(self, sensor):
         sensor.add_callback(self._sensor_callback)
 
-    def _mk_sensor_url(self, sensor):
-        return self.api_url + ('/sensor/%d/readings' % sensor.sensor_id)
+    def remove_sensor(self, sensor):
+        """Stop posting a sensor's readings."""
+        sensor.remove_callback(self._sensor_callback)
+        self._battery_posted.pop(sensor.sensor_id, None)
+        self._health_posted.pop(sensor.sensor_id, None)
+
+    def add_health(self, registry):
+        """Post health from a sensorhealth.SensorHealthRegistry."""
+        self._health = registry
+        registry.add_callback(self._queue_health)
+
+    def _mk_sensor_url(self, sensor_id):
+        return self.api_url + ('/sensor/%d/readings' % sensor_id)
+
+    def _mk_health_url(self, sensor_id):
+        return self.api_url + ('/sensor/%d/health' % sensor_id)
+
+    def _queue(self, fn, *args):
+        try:
+            self._pending.put_nowait((fn, args))
+        except queue.Full:
+            logger.error("Too many updates waiting to be posted; dropping "
+                         "update for sensor %d", args[0])
 
     def _publish_updated_value(self, url: str, metric_type: str, when: datetime.datetime, value: float) -> None:
         data = {
@@ -25,16 +71,75 @@ class TempSensorUpdater(object):
             'value': value,
         }
 
-        r = requests.post(url, json=data, auth=self.auth, headers={'X-Requested-With': 'device'})
+        r = requests.post(url, json=data, auth=self.auth, headers={'X-Requested-With': 'device'}, timeout=10)
         r.raise_for_status()
 
     def _sensor_callback(self, sensor):
+        sensor_id = sensor.sensor_id
+        reading = sensor.reading
+        battery = reading.battery_voltage
+        post_battery = battery is not None and abs(
+            battery - self._battery_posted.get(sensor_id, 0)) > \
+            self.BATTERY_DEADBAND
+        if post_battery:
+            self._battery_posted[sensor_id] = battery
+        self._queue(self._post, sensor_id, reading, post_battery)
+
+        if self._health is not None:
+            now = self._clock.monotonic()
+            last = self._health_posted.get(sensor_id)
+            health = self._health.get(sensor_id)
+            if health is not None and (
+                    last is None or now - last >= self.HEALTH_REPORT_INTERVAL):
+                self._queue_health(health)
+
+    def _queue_health(self, health):
+        self._health_posted[health.sensor_id] = self._clock.monotonic()
+        # Post a snapshot, as the registry carries on changing:
+        self._queue(self._post_health, health.sensor_id, health.as_dict())
+
+    def _post(self, sensor_id, reading, post_battery=False):
         try:
-            sensor_url = self._mk_sensor_url(sensor)
+            sensor_url = self._mk_sensor_url(sensor_id)
             self._publish_updated_value(
-                sensor_url, 'temperature', sensor.reading.when, sensor.reading.temperature)
+                sensor_url, 'temperature', reading.when, reading.temperature)
             self._publish_updated_value(
-                sensor_url, 'humidity', sensor.reading.when, sensor.reading.relative_humidity)
+                sensor_url, 'humidity', reading.when, reading.relative_humidity)
+            if post_battery:
+                self._publish_updated_value(
+                    sensor_url, 'battery_voltage', reading.when,
+                    reading.battery_voltage)
         except Exception as e:
             logger.error("Failed to post update for sensor %d: %s",
-                         sensor.sensor_id, str(e))
+                         sensor_id, str(e))
+
+    def _post_health(self, sensor_id, health):
+        try:
+            r = requests.post(self._mk_health_url(sensor_id), json=health,
+                              auth=self.auth,
+                              headers={'X-Requested-With': 'device'},
+                              timeout=10)
+            r.raise_for_status()
+        except Exception as e:
+            logger.error("Failed to post health for sensor %d: %s",
+                         sensor_id, str(e))
+
+    def post_pending(self):
+        """Post the updates queued so far."""
+        while True:
+            try:
+                fn, args = self._pending.get_nowait()
+            except queue.Empty:
+                return
+            fn(*args)
+
+    def _run(self):
+        while True:
+            fn, args = self._pending.get()
+            fn(*args)
+
+    def start(self):
+        """Start posting from a background thread."""
+        thread = threading.Thread(target=self._run, name='sensor-updater',
+                                  daemon=True)
+        thread.start()
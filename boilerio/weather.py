@@ -1,12 +1,26 @@
-import requests
+import bisect
+import fcntl
+import json
 import logging
-from datetime import datetime, timedelta
+import os
+import tempfile
+import threading
+from array import array
+from datetime import timedelta
+
+import requests
+
+from .breaker import CircuitBreaker
+from .clock import SYSTEM_CLOCK
+from .tempsensor import EmonTHSensor
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 WEATHER_API_ENDPOINT = 'https://api.openweathermap.org/data/2.5/weather'
+FORECAST_API_ENDPOINT = 'https://api.openweathermap.org/data/2.5/forecast'
+WEATHER_CACHE_FILE = '/var/lib/boilerio/weather.json'
 
 class WeatherServiceError(Exception):
     pass
@@ -59,21 +73,406 @@ class CachingWeather(Weather):
 
     Used to avoid excessive API calls when the data doesn't change very
     often anyway."""
-    def __init__(self, apikey, location, cache_time=timedelta(hours=1)):
+    def __init__(self, apikey, location, cache_time=timedelta(hours=1),
+                 clock=SYSTEM_CLOCK):
         super(CachingWeather, self).__init__(apikey, location)
+        self._clock = clock
         self._last_updated = None
-        self._cache_time = cache_time
+        self._cache_time = cache_time.total_seconds()
         self._last_result = None
 
-    def get_weather(self, now_fn=lambda: datetime.now()):
+    def get_weather(self):
         """Fetch weather from cache (if not timed out) or online."""
-        now = now_fn()
+        now = self._clock.monotonic()
         if (self._last_result is None or self._last_updated is None or
             self._last_updated + self._cache_time < now):
             try:
                 self._last_result = super(CachingWeather, self).get_weather()
                 self._last_updated = now
-            except WeatherServiceError as e:
+            except (WeatherServiceError,
+                    requests.exceptions.RequestException) as e:
                 logger.info("Failed to get updated weather information, using "
                         "cached result")
         return self._last_result
+
+
+class SharedCachingWeather(Weather):
+    """Weather cache shared by all the boilerio daemons on a host.
+
+    The last result is kept in a JSON file.  get_weather() answers from it
+    straight away, even once it is older than cache_time, and starts a
+    refresh in a background thread, so callers never wait for the weather
+    service.  It returns None only if nothing has ever been fetched.  An
+    flock on a lock file next to the cache makes sure only one process
+    refreshes at a time; the others pick up its result from the file.
+    Failing refreshes are retried with exponential backoff (see
+    CircuitBreaker).
+
+    The cache age is measured in wall-clock time since the file is shared
+    between processes and outlives them: after a restart the last known
+    value is used until a refresh succeeds.
+    """
+
+    # Seconds between checks of the cache file for updates by other
+    # processes.
+    RELOAD_INTERVAL = 10
+
+    def __init__(self, apikey, location, path=WEATHER_CACHE_FILE,
+                 cache_time=timedelta(minutes=20), clock=SYSTEM_CLOCK):
+        super(SharedCachingWeather, self).__init__(apikey, location)
+        self.path = path
+        self._cache_time = cache_time.total_seconds()
+        self._clock = clock
+        # (result, wall-clock timestamp it was fetched at), replaced as a
+        # whole so the refresh thread can update it safely:
+        self._cached = None
+        self._mtime = None
+        self._next_reload = None
+        self._refreshing = threading.Lock()
+        self._refresh_thread = None
+        self._breaker = CircuitBreaker(clock=clock)
+
+    def _fresh(self):
+        cached = self._cached
+        return (cached is not None and
+                self._clock.now().timestamp() - cached[1] < self._cache_time)
+
+    def _load(self):
+        """Read the cache file if it has changed."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self._mtime:
+                return
+            with open(self.path) as f:
+                data = json.load(f)
+            self._cached = (data['weather'], data['fetched'])
+            self._mtime = mtime
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Couldn't read weather cache %s: %s", self.path, e)
+
+    def _store(self, result):
+        fetched = self._clock.now().timestamp()
+        try:
+            with tempfile.NamedTemporaryFile(
+                    'w', dir=os.path.dirname(self.path) or '.',
+                    delete=False) as f:
+                json.dump({'fetched': fetched, 'weather': result}, f)
+            os.replace(f.name, self.path)
+            self._mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            logger.warning("Couldn't write weather cache %s: %s", self.path, e)
+        self._cached = (result, fetched)
+
+    def _refresh(self):
+        """Fetch the weather unless another process is already doing so.
+
+        If the lock file can't be opened, e.g. because the cache directory
+        doesn't exist, the weather is fetched anyway and cached only in
+        this process.  Returns False if fetching failed."""
+        try:
+            lock = open(self.path + '.lock', 'a')
+        except OSError as e:
+            logger.warning("Couldn't open weather cache lock, so not "
+                           "sharing the weather: %s", e)
+            return self._fetch()
+        with lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            except OSError as e:
+                logger.warning("Couldn't lock weather cache: %s", e)
+                return self._fetch()
+            # Another process may have refreshed the cache meanwhile:
+            self._load()
+            if self._fresh():
+                return True
+            return self._fetch()
+
+    def _fetch(self):
+        try:
+            result = super(SharedCachingWeather, self).get_weather()
+        except Exception as e:
+            logger.error("Failed to refresh weather: %s", e)
+            return False
+        self._store(result)
+        return True
+
+    def _start_refresh(self):
+        if not self._refreshing.acquire(blocking=False):
+            return
+
+        def refresh():
+            try:
+                if self._refresh():
+                    self._breaker.succeeded()
+                else:
+                    self._breaker.failed()
+            finally:
+                self._refreshing.release()
+
+        self._refresh_thread = threading.Thread(
+            target=refresh, name='weather-refresh', daemon=True)
+        self._refresh_thread.start()
+
+    def get_weather(self):
+        """Return the cached weather, refreshing it if stale."""
+        now = self._clock.monotonic()
+        if self._next_reload is None or now >= self._next_reload:
+            self._next_reload = now + self.RELOAD_INTERVAL
+            self._load()
+            if not self._fresh() and self._breaker.allow():
+                self._start_refresh()
+        cached = self._cached
+        return None if cached is None else cached[0]
+
+
+class ForecastTimeline(object):
+    """Forecast outside temperatures, interpolated linearly between points.
+
+    times are UNIX times; temperature_at() takes a datetime, as given by
+    the clock.  Before the first and after the last point the nearest
+    forecast temperature is used."""
+
+    __slots__ = ('times', 'temperatures')
+
+    def __init__(self, points):
+        """points: an iterable of (UNIX time, temperature)."""
+        points = sorted(points)
+        self.times = array('d', (t for t, _ in points))
+        self.temperatures = array('d', (temp for _, temp in points))
+
+    def __len__(self):
+        return len(self.times)
+
+    def temperature_at(self, when):
+        """Forecast temperature at a datetime, or None if there's no
+        forecast."""
+        times = self.times
+        if not times:
+            return None
+        t = when.timestamp()
+        i = bisect.bisect_right(times, t)
+        if i == 0:
+            return self.temperatures[0]
+        if i == len(times):
+            return self.temperatures[-1]
+        t0, temp0 = times[i - 1], self.temperatures[i - 1]
+        return temp0 + ((self.temperatures[i] - temp0) *
+                        (t - t0) / (times[i] - t0))
+
+
+def get_forecast(apikey, city, endpoint=FORECAST_API_ENDPOINT,
+                 coordinates=None):
+    """Return a ForecastTimeline of the forecast for a city.
+
+    coordinates: (latitude, longitude) to use instead of the city name; the
+    One Call API only accepts these.
+
+    Understands both the 3-hourly /data/2.5/forecast response ('list') and
+    the hourly One Call response ('hourly')."""
+    params = {'apikey': apikey, 'units': 'metric'}
+    if coordinates is not None:
+        params['lat'], params['lon'] = coordinates
+    else:
+        params['q'] = city
+    r = requests.get(endpoint, params=params, timeout=10)
+    if r.status_code != 200:
+        logger.error("Couldn't get forecast: response %s; code %d",
+                     r.text, r.status_code)
+        raise WeatherServiceError(r)
+
+    result = r.json()
+    try:
+        if 'hourly' in result:
+            points = [(e['dt'], float(e['temp'])) for e in result['hourly']]
+        else:
+            points = [(e['dt'], float(e['main']['temp']))
+                      for e in result['list']]
+    except (KeyError, TypeError, ValueError) as e:
+        logger.error("Couldn't parse forecast: %s (response %s)", e, r.text)
+        raise WeatherServiceError(r)
+    return ForecastTimeline(points)
+
+
+class Forecast(Weather):
+    """Weather forecast for a fixed location and apikey.
+
+    The forecast is refreshed every refresh_interval in a background
+    thread, so temperature_at() never waits for the weather service: it
+    interpolates the last forecast fetched, and returns None until the
+    first one arrives.  Failing refreshes are retried after retry_interval,
+    backing off exponentially up to refresh_interval (see CircuitBreaker).
+    get_weather() gives the forecast temperature for now, so a Forecast can
+    be used in place of a Weather."""
+
+    def __init__(self, apikey, location, endpoint=FORECAST_API_ENDPOINT,
+                 refresh_interval=timedelta(hours=6),
+                 retry_interval=timedelta(minutes=15), clock=SYSTEM_CLOCK,
+                 coordinates=None):
+        super(Forecast, self).__init__(apikey, location)
+        self.endpoint = endpoint
+        self.coordinates = coordinates
+        self._refresh_interval = refresh_interval.total_seconds()
+        self._clock = clock
+        self._timeline = ForecastTimeline([])
+        self._next_refresh = None
+        self._refreshing = threading.Lock()
+        self._refresh_thread = None
+        self._breaker = CircuitBreaker(
+            failure_threshold=1, base_delay=retry_interval.total_seconds(),
+            max_delay=self._refresh_interval, clock=clock)
+
+    def _start_refresh(self):
+        if not self._refreshing.acquire(blocking=False):
+            return
+
+        def refresh():
+            try:
+                self._timeline = get_forecast(
+                    self.apikey, self.location, self.endpoint,
+                    self.coordinates)
+            except Exception as e:
+                logger.error("Failed to update forecast: %s", e)
+                self._breaker.failed()
+            else:
+                self._breaker.succeeded()
+                self._next_refresh = (self._clock.monotonic() +
+                                      self._refresh_interval)
+            finally:
+                self._refreshing.release()
+
+        self._refresh_thread = threading.Thread(
+            target=refresh, name='forecast-refresh', daemon=True)
+        self._refresh_thread.start()
+
+    def forecast(self):
+        """The last ForecastTimeline fetched, starting a refresh if due."""
+        if ((self._next_refresh is None or
+                self._clock.monotonic() >= self._next_refresh) and
+                self._breaker.allow()):
+            self._start_refresh()
+        return self._timeline
+
+    def temperature_at(self, when):
+        """Forecast temperature at a datetime, or None if unknown."""
+        return self.forecast().temperature_at(when)
+
+    def get_weather(self):
+        temperature = self.temperature_at(self._clock.now())
+        return None if temperature is None else {'temperature': temperature}
+
+
+def forecast_from_config(conf, clock=SYSTEM_CLOCK):
+    """The Forecast configured in the [weather] section, or None.
+
+    It's enabled by 'forecast', and fetched from 'forecast_endpoint' for
+    'lat' and 'lon' if given, otherwise for 'location'.  The One Call
+    endpoint needs 'lat' and 'lon'."""
+    if not conf.getboolean('weather', 'forecast', fallback=False):
+        return None
+    coordinates = None
+    if conf.has_option('weather', 'lat'):
+        coordinates = (conf.getfloat('weather', 'lat'),
+                       conf.getfloat('weather', 'lon'))
+    return Forecast(
+        conf.get('weather', 'apikey'),
+        conf.get('weather', 'location', fallback=None),
+        conf.get('weather', 'forecast_endpoint',
+                 fallback=FORECAST_API_ENDPOINT),
+        clock=clock, coordinates=coordinates)
+
+
+class WeatherChain(object):
+    """Weather from the first of several providers that has it.
+
+    Providers are Weather-like objects tried in order, so a local or cached
+    source can come first and others act as fallbacks.  A provider that
+    raises is skipped, with backoff, by a CircuitBreaker; one returning
+    None just has nothing to offer yet.  If none has the weather, the last
+    result is returned again.  get_weather() never raises, and returns
+    None only if no provider has ever had the weather."""
+
+    def __init__(self, providers, clock=SYSTEM_CLOCK):
+        self.providers = [(provider, CircuitBreaker(clock=clock))
+                          for provider in providers]
+        self._last_result = None
+
+    def get_weather(self):
+        for provider, breaker in self.providers:
+            if not breaker.allow():
+                continue
+            try:
+                result = provider.get_weather()
+            except Exception as e:
+                breaker.failed()
+                logger.error("Weather provider %s failed: %s",
+                             type(provider).__name__, e)
+                continue
+            breaker.succeeded()
+            if result is not None:
+                self._last_result = result
+                return result
+        return self._last_result
+
+
+class SensorWeather(object):
+    """Outside temperature from a local sensor, e.g. an outdoor emonTH.
+
+    Readings arrive over MQTT as they are taken, so this is both more
+    up-to-date than a weather service and free to query.  get_weather()
+    takes the sensor's new readings (see EmonTHSensor.process_readings), so
+    should always be called from the same thread.  It returns None if the
+    sensor hasn't reported for max_age seconds, so a WeatherChain moves on
+    to its next provider."""
+
+    def __init__(self, sensor, max_age=600, clock=SYSTEM_CLOCK):
+        self.sensor = sensor
+        self.max_age = max_age
+        self._clock = clock
+
+    def get_weather(self):
+        self.sensor.process_readings()
+        reading = self.sensor.reading
+        if (reading is None or
+                self._clock.monotonic() - reading.received > self.max_age):
+            return None
+        return {'temperature': reading.temperature,
+                'humidity': reading.relative_humidity}
+
+
+def from_config(conf, clock=SYSTEM_CLOCK):
+    """Build the weather source configured in the [weather] section.
+
+    'providers' is a comma-separated list of the sources to try, in order:
+        sensor: an outdoor sensor publishing to the MQTT topic
+            'outdoor_sensor'.
+        openweathermap: OpenWeatherMap for 'apikey' and 'location', through
+            the shared cache at 'cache_file'.
+    The default is openweathermap alone.
+
+    Returns (WeatherChain, list of sensors), where the caller needs to
+    register the sensors for MQTT messages, e.g. with a
+    dispatch.MqttDispatcher."""
+    providers = []
+    sensors = []
+    names = conf.get('weather', 'providers', fallback='openweathermap')
+    for name in (n.strip() for n in names.split(',')):
+        if name == 'sensor':
+            # Not a scheduler sensor, so it has no sensor_id:
+            sensor = EmonTHSensor(0, conf.get('weather', 'outdoor_sensor'),
+                                  clock)
+            sensors.append(sensor)
+            providers.append(SensorWeather(sensor, clock=clock))
+        elif name == 'openweathermap':
+            providers.append(SharedCachingWeather(
+                conf.get('weather', 'apikey'),
+                conf.get('weather', 'location'),
+                conf.get('weather', 'cache_file',
+                         fallback=WEATHER_CACHE_FILE),
+                cache_time=timedelta(minutes=20), clock=clock))
+        elif name:
+            raise ValueError("Unknown weather provider %s" % name)
+    return WeatherChain(providers, clock), sensors
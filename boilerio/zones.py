@@ -2,22 +2,61 @@ from datetime import timedelta
 import logging
 import requests
 
+from .clock import SYSTEM_CLOCK
+from .gradients import GradientTable, LeadTimeTable
+
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
+class ReportedState(object):
+    """The state a zone controller reports to the scheduler web service."""
+
+    __slots__ = ('time_to_target', 'state', 'target', 'current_temp',
+                 'current_outside_temp', 'dutycycle', 'target_overridden')
+
+    def __init__(self):
+        self.time_to_target = None
+        self.state = 'Unknown'
+        self.target = None
+        self.current_temp = None
+        self.current_outside_temp = None
+        self.dutycycle = None
+        self.target_overridden = None
+
+    def to_dict(self):
+        """Convert to a dictionary (for sending as JSON)."""
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __str__(self):
+        return str(self.to_dict())
+
+
 class ZoneController(object):
     """Connect a schedule, thermostat, and temperature sensor."""
 
+    # Never start heating for a scheduled change earlier than this:
+    MAX_PREHEAT = timedelta(hours=4)
+
     def __init__(self, zone, boiler, sensor, thermostat_obj, scheduler_url,
                  auth, weather,
-                 gradient_table_update_frequency=timedelta(hours=1)):
+                 gradient_table_update_frequency=timedelta(hours=1),
+                 clock=SYSTEM_CLOCK, optimum_start=False, forecast=None):
         """Initialize a zone controller.
 
         Note that the weather is updated on each iteration so the weather
-        object needs to do caching to avoid frequent API calls."""
+        object needs to do caching to avoid frequent API calls.  Its
+        get_weather() may return None if the weather is unknown, but
+        shouldn't block or raise (see weather.WeatherChain).
+
+        With optimum_start, heating for a scheduled increase in target
+        starts early enough to reach the new target at the scheduled time,
+        based on the zone's gradient table and the outside temperature.
+        If a weather.Forecast is given, the outside temperature forecast
+        for the preheat period is used rather than the current one."""
         self.zone = zone
+        self._clock = clock
         self.boiler = boiler
         self.thermostat = thermostat_obj
         self.thermostat.set_state_change_callback(self.thermostat_state_callback)
@@ -25,76 +64,144 @@ class ZoneController(object):
         self.scheduler_url = scheduler_url
         self.scheduler_auth = auth
 
-        self.reported_state = {
-                'time_to_target': None,
-                'state': 'Unknown',
-                'target': None,
-                'current_temp': None,
-                'current_outside_temp': None,
-                'dutycycle': None,
-                'target_overridden': None,
-                }
+        self.reported_state = ReportedState()
         self.do_update_state = True
         self._sensor.add_callback(self.temperature_change)
         self.gradient_table = []
         self.last_gradient_table_update = None
-        self.gradient_table_update_frequency = gradient_table_update_frequency
+        self.optimum_start = optimum_start
+        # (policy, when, temperature) of the next scheduled change, cached
+        # until the policy is replaced or the change happens:
+        self._next_change = None
+        # (when, temperature) of the change being preheated for, if any:
+        self._preheating = None
+        self.gradient_table_update_frequency = \
+            gradient_table_update_frequency.total_seconds()
         self.weather = weather
+        self.forecast = forecast
+
+    def set_sensor(self, sensor):
+        """Move the zone (and its thermostat) to a different sensor."""
+        self._sensor.remove_callback(self.temperature_change)
+        self._sensor = sensor
+        self.thermostat.set_sensor(sensor)
+        sensor.add_callback(self.temperature_change)
+        if sensor.reading is not None:
+            self.temperature_change(sensor)
+
+    def close(self):
+        """Stop following the zone's sensor."""
+        self._sensor.remove_callback(self.temperature_change)
 
     def thermostat_state_callback(self, new_state, dutycycle):
-        self._update_state(state=new_state, dutycycle=dutycycle)
+        # A demand.ZoneDemand combines the duty cycles of zones sharing a
+        # relay:
+        set_dutycycle = getattr(self.boiler, 'set_dutycycle', None)
+        if set_dutycycle is not None:
+            set_dutycycle(dutycycle)
+        self._update_state('state', new_state)
+        self._update_state('dutycycle', dutycycle)
 
     def temperature_change(self, sensor):
-        self._update_state(current_temp=sensor.reading.temperature)
-
-    def _update_state(self, **kwargs):
-        """Updates state with arguments passed."""
-        new_state = self.reported_state.copy()
-        new_state.update(**kwargs)
-        if new_state != self.reported_state:
-            self.reported_state = new_state
+        self._update_state('current_temp', sensor.reading.temperature)
+
+    def _update_state(self, field, value):
+        """Updates a single reported state field, noting if it changed."""
+        if getattr(self.reported_state, field) != value:
+            setattr(self.reported_state, field, value)
             self.do_update_state = True
-            logger.debug("State change: %s", str(kwargs))
+            logger.debug("State change: %s=%s", field, value)
+
+    @property
+    def gradient_table(self):
+        """The zone's GradientTable.
+
+        May be set from a list of dictionaries as served by
+        /zones/<id>/gradients."""
+        return self._gradient_table
+
+    @gradient_table.setter
+    def gradient_table(self, gradient_table):
+        self._gradient_table = GradientTable(gradient_table)
+        self.lead_times = LeadTimeTable(self._gradient_table)
+
+    def _upcoming_change(self, scheduler, now):
+        cached = self._next_change
+        if cached is None or cached[0] is not scheduler or cached[1] <= now:
+            upcoming = scheduler.next_change(now, self.zone.zone_id)
+            if upcoming is None:
+                self._next_change = (scheduler, now + self.MAX_PREHEAT, None)
+            else:
+                self._next_change = (scheduler,) + upcoming
+            cached = self._next_change
+        return cached[1], cached[2]
+
+    def optimum_start_target(self, scheduler, now, target):
+        """Bring forward the next scheduled target if we need to preheat.
+
+        Once preheating starts it continues until the change is reached,
+        or the schedule no longer has it; otherwise the lead time, which
+        shrinks as the room warms, would switch the target back and forth.
+
+        Returns the target the thermostat should use."""
+        if scheduler.target_overridden(now, self.zone.zone_id):
+            self._preheating = None
+            return target
+        when, next_target = self._upcoming_change(scheduler, now)
+        if self._preheating is not None:
+            if (self._preheating == (when, next_target) and
+                    target is not None and next_target > target):
+                return next_target
+            self._preheating = None
+        reading = self._sensor.reading
+        outside = self.reported_state.current_outside_temp
+        if self.forecast is not None and next_target is not None:
+            # Forecast for the middle of the longest possible preheat:
+            forecast = self.forecast.temperature_at(
+                now + min(when - now, self.MAX_PREHEAT) / 2)
+            if forecast is not None:
+                outside = forecast
+        if (next_target is None or target is None or next_target <= target or
+                reading is None or outside is None or
+                when - now > self.MAX_PREHEAT):
+            return target
+
+        lead_time = self.lead_times.lead_time(reading.temperature - outside,
+                                              next_target - outside)
+        if lead_time is None or (when - now).total_seconds() > lead_time:
+            return target
+        logger.info("Preheating zone %d for %s at %s", self.zone.zone_id,
+                    next_target, when)
+        self._preheating = (when, next_target)
+        return next_target
 
     def get_time_to_target(self):
         """Estimate time to reach temperature target.
 
         Returns a timedelta object."""
-        # This algorithm overestimates the time taken because it uses the
-        # gradient at the start of heating, whereas it should be using an
-        # integral over time.
-
         # If we're not heating, just return nothing:
+        outside = self.reported_state.current_outside_temp
         if (not self.thermostat.is_heating or
-            self._sensor.reading is None or
+            self._sensor.reading is None or outside is None or
             self.thermostat.target < self._sensor.reading.temperature):
             return None
         else:
-            outside = self.weather.get_weather()
-            delta_t = self._sensor.reading.temperature - outside['temperature']
-
-            # Find a gradient where the delta between inside and out was
-            # closest to the current temperature:
-            match = None
-            for gradient in self.gradient_table:
-                if match is None:
-                    match = gradient
-                elif (abs(gradient['delta'] - delta_t)
-                        < abs(match['delta'] - delta_t)):
-                    match = gradient
-
-            # Now use it to estimate heating time:
-            if match is None:
+            # Integrate over the heating curve from the current temperature
+            # to the target:
+            seconds = self.lead_times.lead_time(
+                self._sensor.reading.temperature - outside,
+                self.thermostat.target - outside)
+            if seconds is None:
                 return None
-            amount_to_heat = self.thermostat.target - self._sensor.reading.temperature
-            return timedelta(hours=(amount_to_heat / match['gradient']))
+            return timedelta(seconds=seconds)
 
     def report_updated_state(self):
         url = self.scheduler_url + '/zones/%d/reported_state' % self.zone.zone_id
         ttt = self.get_time_to_target()
-        self.reported_state['time_to_target'] = ttt.total_seconds() if ttt else None
+        self.reported_state.time_to_target = ttt.total_seconds() if ttt else None
         r = requests.post(url, auth=self.scheduler_auth,
-            timeout=10, json=self.reported_state, headers={'X-Requested-With': 'device'})
+            timeout=10, json=self.reported_state.to_dict(),
+            headers={'X-Requested-With': 'device'})
         if r.status_code == 200:
             logger.info("Reported new state for zone %d: %s",
                     self.zone.zone_id, str(self.reported_state))
@@ -104,37 +211,47 @@ class ZoneController(object):
                     self.zone.zone_id, url, str(self.reported_state))
 
     def iteration(self, scheduler, now):
-        """Update the zone.  Should be called once per second."""
+        """Update the zone.  Should be called once per second.
+
+        now: the current wall-clock datetime, used for schedule lookup."""
+        monotonic_now = self._clock.monotonic()
+
         # Update target temperature by polling scheduler
         target = scheduler.target(now, self.zone.zone_id)
+        if self.optimum_start:
+            target = self.optimum_start_target(scheduler, now, target)
         self._update_state(
-            target_overridden=scheduler.target_overridden(now,
-                                                          self.zone.zone_id))
+            'target_overridden',
+            scheduler.target_overridden(now, self.zone.zone_id))
         if self.thermostat.target != target:
             logger.info("Updating target temperature (%s -> %s) for zone %d",
                         str(self.thermostat.target), str(target), self.zone.zone_id)
             self.thermostat.set_target_temperature(target)
-            self._update_state(target=target)
+            self._update_state('target', target)
 
         # Update gradient table:
         if (self.last_gradient_table_update is None or
-                self.last_gradient_table_update + self.gradient_table_update_frequency < now):
+                self.last_gradient_table_update +
+                self.gradient_table_update_frequency < monotonic_now):
             r = requests.get(
                     self.scheduler_url + '/zones/%d/gradients' % self.zone.zone_id,
                     timeout=10, auth=self.scheduler_auth)
             if r.status_code == 200:
                 self.gradient_table = r.json()
-                self.last_gradient_table_update = now
+                self.last_gradient_table_update = monotonic_now
             else:
                 logger.error("Couldn't update gradients table for zone %d (status %d)",
                         self.zone.zone_id, r.status_code)
 
         # Update thermostat:
-        self.thermostat.interval_elapsed(now)
+        self.thermostat.interval_elapsed(monotonic_now)
 
-        # Update weather:
+        # Update weather, keeping the last known temperature if it's
+        # currently unavailable:
         current_weather = self.weather.get_weather()
-        self._update_state(current_outside_temp=current_weather['temperature'])
+        if current_weather is not None:
+            self._update_state('current_outside_temp',
+                               current_weather['temperature'])
 
         # Report updated state if necessary:
         if self.do_update_state:
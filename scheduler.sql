@@ -90,6 +90,26 @@ CREATE TABLE public.device_reported_state (
 
 ALTER TABLE public.device_reported_state OWNER TO postgres;
 
+--
+-- Name: gradient_bucket; Type: TABLE; Schema: public; Owner: postgres
+--
+
+CREATE TABLE public.gradient_bucket (
+    zone integer NOT NULL,
+    delta numeric NOT NULL,
+    npoints integer NOT NULL,
+    weight_sum double precision NOT NULL,
+    gradient_sum double precision NOT NULL,
+    gradient_sum_sq double precision NOT NULL,
+    decayed_weight double precision NOT NULL,
+    decayed_sum double precision NOT NULL,
+    decayed_sum_sq double precision NOT NULL,
+    decayed_at timestamp without time zone NOT NULL
+);
+
+
+ALTER TABLE public.gradient_bucket OWNER TO postgres;
+
 --
 -- Name: gradient_measurement; Type: TABLE; Schema: public; Owner: postgres
 --
@@ -99,7 +119,9 @@ CREATE TABLE public.gradient_measurement (
     "when" timestamp without time zone,
     delta double precision,
     gradient double precision,
-    zone integer NOT NULL
+    zone integer NOT NULL,
+    stderr double precision,
+    npoints integer
 );
 
 
@@ -168,6 +190,24 @@ CREATE TABLE public.sensor (
 
 ALTER TABLE public.sensor OWNER TO postgres;
 
+--
+-- Name: sensor_health; Type: TABLE; Schema: public; Owner: postgres
+--
+
+CREATE TABLE public.sensor_health (
+    sensor_id integer NOT NULL,
+    updated timestamp without time zone NOT NULL,
+    last_seen timestamp without time zone,
+    stale boolean NOT NULL,
+    messages integer,
+    message_rate double precision,
+    jitter double precision,
+    battery_voltage double precision
+);
+
+
+ALTER TABLE public.sensor_health OWNER TO postgres;
+
 --
 -- Name: sensor_reading; Type: TABLE; Schema: public; Owner: postgres
 --
@@ -248,7 +288,11 @@ CREATE TABLE public.zones (
     zone_id integer NOT NULL,
     name character varying(30),
     boiler_relay character varying(50) NOT NULL,
-    sensor_id integer
+    sensor_id integer,
+    pid_kp double precision,
+    pid_ki double precision,
+    pid_kd double precision,
+    pwm_period integer
 );
 
 
@@ -319,6 +363,14 @@ ALTER TABLE ONLY public.device_reported_state
     ADD CONSTRAINT device_reported_state_pkey PRIMARY KEY (zone_id, received);
 
 
+--
+-- Name: gradient_bucket gradient_bucket_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.gradient_bucket
+    ADD CONSTRAINT gradient_bucket_pkey PRIMARY KEY (zone, delta);
+
+
 --
 -- Name: gradient_measurement gradient_measurement_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
 --
@@ -351,6 +403,14 @@ ALTER TABLE ONLY public.sensor
     ADD CONSTRAINT sensor_pkey PRIMARY KEY (sensor_id);
 
 
+--
+-- Name: sensor_health sensor_health_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.sensor_health
+    ADD CONSTRAINT sensor_health_pkey PRIMARY KEY (sensor_id);
+
+
 --
 -- Name: sensor_reading sensor_reading_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
 --
@@ -382,6 +442,13 @@ ALTER TABLE ONLY public.zones
 CREATE INDEX sensor_reading_sensor_time ON public.sensor_reading USING btree (sensor_id, "time");
 
 
+--
+-- Name: gradient_measurement_zone; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX gradient_measurement_zone ON public.gradient_measurement USING btree (zone);
+
+
 --
 -- Name: gradient_measurement fkey_zone; Type: FK CONSTRAINT; Schema: public; Owner: postgres
 --
@@ -390,6 +457,14 @@ ALTER TABLE ONLY public.gradient_measurement
     ADD CONSTRAINT fkey_zone FOREIGN KEY (zone) REFERENCES public.zones(zone_id);
 
 
+--
+-- Name: gradient_bucket fkey_zone; Type: FK CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.gradient_bucket
+    ADD CONSTRAINT fkey_zone FOREIGN KEY (zone) REFERENCES public.zones(zone_id);
+
+
 --
 -- Name: device_reported_state fkey_zone_id; Type: FK CONSTRAINT; Schema: public; Owner: postgres
 --
@@ -406,6 +481,14 @@ ALTER TABLE ONLY public.zones
     ADD CONSTRAINT sensor_fkey FOREIGN KEY (sensor_id) REFERENCES public.sensor(sensor_id);
 
 
+--
+-- Name: sensor_health sensor_health_sensor_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.sensor_health
+    ADD CONSTRAINT sensor_health_sensor_id_fkey FOREIGN KEY (sensor_id) REFERENCES public.sensor(sensor_id);
+
+
 --
 -- Name: sensor_reading sensor_reading_sensor_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: postgres
 --
@@ -451,6 +534,13 @@ GRANT ALL ON TABLE public.device TO scheduler;
 GRANT ALL ON TABLE public.device_reported_state TO scheduler;
 
 
+--
+-- Name: TABLE gradient_bucket; Type: ACL; Schema: public; Owner: postgres
+--
+
+GRANT ALL ON TABLE public.gradient_bucket TO scheduler;
+
+
 --
 -- Name: TABLE gradient_measurement; Type: ACL; Schema: public; Owner: postgres
 --
@@ -486,6 +576,13 @@ GRANT ALL ON TABLE public.schedule TO scheduler;
 GRANT ALL ON TABLE public.sensor TO scheduler;
 
 
+--
+-- Name: TABLE sensor_health; Type: ACL; Schema: public; Owner: postgres
+--
+
+GRANT ALL ON TABLE public.sensor_health TO scheduler;
+
+
 --
 -- Name: TABLE sensor_reading; Type: ACL; Schema: public; Owner: postgres
 --